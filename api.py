@@ -28,21 +28,34 @@ if PY_VERSION < (2, 7):
     sys.exit(1)
 
 from ConfigParser import SafeConfigParser
+import array
 import base64
-import contextlib
+import bisect
+import collections
 from Crypto.Cipher import AES
+import errno
+from fractions import gcd
 import getpass
 import gzip
 import hashlib
+import heapq
+import httplib
 import inspect
 import io
+import itertools
 import json
 import logging
+import math
+import mmap
+import operator
+import os
+import random
+import socket
+import struct
 import time
 import traceback
 import threading
-from urllib2 import Request as URLRequest
-from urllib2 import urlopen, HTTPError
+import urlparse
 import weakref
 
 input = raw_input
@@ -57,6 +70,176 @@ FORCE_NO_HTTP_API = False
 
 USER_AGENT = "PyTrader"
 
+LOG_GENERAL = "general"
+LOG_TICK = "tick"
+LOG_DEPTH = "depth"
+LOG_TRADE = "trade"
+LOG_TRADE_OWN = "trade_own"
+LOG_ORDER = "order"
+LOG_STRATEGY = "strategy"
+
+DISPATCH_BLOCK = "block"
+DISPATCH_DROP_OLDEST = "drop_oldest"
+DISPATCH_COALESCE = "coalesce"
+
+
+class HttpStats():
+    """connection reuse and latency statistics of one host"""
+
+    def __init__(self):
+        self.count_requests = 0
+        self.count_connects = 0
+        self.count_reused = 0
+        self.count_reconnects = 0
+        self.count_errors = 0
+        self.latency = LatencyHistogram()
+
+    def format(self, host):
+        """return one human readable line"""
+        return "%s: requests %i, connects %i, reused %i, reconnects %i, errors %i, latency %s" % (
+            host, self.count_requests, self.count_connects, self.count_reused,
+            self.count_reconnects, self.count_errors, self.latency.format())
+
+
+class HttpPool():
+    """a pool of persistent HTTP/1.1 connections, for every host (and
+    scheme and port) it keeps up to size idle keep-alive connections
+    around. Connections that have been idle for longer than idle_timeout
+    seconds are closed instead of being used again (the servers will have
+    closed them already anyways). If a request on a reused connection fails
+    because the server has closed it in the meantime it will be repeated
+    once on a new connection, a POST only if the server can't have received
+    it (see _can_repeat())."""
+
+    def __init__(self, size=4, idle_timeout=30, timeout=60):
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self._idle = {}
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def configure(self, size, idle_timeout):
+        """change the pool size and idle timeout"""
+        with self._lock:
+            self.size = size
+            self.idle_timeout = idle_timeout
+
+    def get_stats(self):
+        """return a dict host -> HttpStats"""
+        with self._lock:
+            return dict(self._stats)
+
+    def format_stats(self):
+        """return the statistics as a list of human readable lines"""
+        return [stats.format(host) for (host, stats) in sorted(self.get_stats().items())]
+
+    def request(self, url, post=None, headers=None):
+        """send the request and return (status, headers, body). The body
+        is returned as it was sent, it is not yet unzipped. Exceptions from
+        httplib and socket will be passed on to the caller."""
+        parts = urlparse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        method = "POST" if post is not None else "GET"
+        time_start = time.time()
+        with self._lock:
+            if not parts.netloc in self._stats:
+                self._stats[parts.netloc] = HttpStats()
+            stats = self._stats[parts.netloc]
+            stats.count_requests += 1
+        (conn, reused) = self._get_connection(key, stats)
+        try:
+            sent = False
+            try:
+                conn.request(method, path, post, headers)
+                sent = True
+                response = conn.getresponse()
+            except (httplib.HTTPException, socket.error) as exc:
+                conn.close()
+                if not reused or not self._can_repeat(exc, method, sent):
+                    raise
+                # the server has closed the idle connection, try again
+                with self._lock:
+                    stats.count_reconnects += 1
+                conn = self._connect(key, stats)
+                response = self._send(conn, method, path, post, headers)
+            body = response.read()
+        except:
+            conn.close()
+            with self._lock:
+                stats.count_errors += 1
+            raise
+
+        if response.will_close:
+            conn.close()
+        else:
+            self._put_connection(key, conn)
+        with self._lock:
+            stats.latency.add(time.time() - time_start)
+        return (response.status, response, body)
+
+    @staticmethod
+    def _can_repeat(exc, method, sent):
+        """can a request that failed with exc on a reused connection be sent
+        again on a new one? Only if the stale connection failed before any
+        response could have started: no status line at all, or reset or
+        broken pipe while sending. Otherwise the server might have got and
+        processed it already, a POST (orders, signed calls with their nonce)
+        must then not be sent twice, a GET is repeated. A timeout is never
+        repeated, that would only double the waiting."""
+        if isinstance(exc, socket.timeout):
+            return False
+        if isinstance(exc, httplib.BadStatusLine):
+            line = str(exc.line)
+            if line in ("", "''") or line.startswith("No status line received"):
+                return True
+        elif isinstance(exc, socket.error) and not sent:
+            if exc.errno in (errno.ECONNRESET, errno.EPIPE):
+                return True
+        return method == "GET"
+
+    def _send(self, conn, method, path, post, headers):
+        """send the request on this connection, return the response"""
+        conn.request(method, path, post, headers)
+        return conn.getresponse()
+
+    def _get_connection(self, key, stats):
+        """return (connection, reused), take an idle one if possible"""
+        now = time.time()
+        with self._lock:
+            idle = self._idle.get(key, [])
+            while idle:
+                (conn, time_idle) = idle.pop()
+                if now - time_idle < self.idle_timeout:
+                    stats.count_reused += 1
+                    return (conn, True)
+                conn.close()
+        return (self._connect(key, stats), False)
+
+    def _connect(self, key, stats):
+        """create a new connection"""
+        (scheme, netloc) = key
+        with self._lock:
+            stats.count_connects += 1
+        if scheme == "https":
+            return httplib.HTTPSConnection(netloc, timeout=self.timeout)
+        else:
+            return httplib.HTTPConnection(netloc, timeout=self.timeout)
+
+    def _put_connection(self, key, conn):
+        """put the connection back into the pool (or close it if full)"""
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.size:
+                idle.append((conn, time.time()))
+                return
+        conn.close()
+
+
+HTTP_POOL = HttpPool()
 
 def http_request(url, post=None, headers=None):
     """request data from the HTTP API, returns the response a string. If a
@@ -65,30 +248,29 @@ def http_request(url, post=None, headers=None):
     sent 5xx http status codes even if application level errors occur
     (such as canceling the same order twice or things like that) and the
     real error message will be in the json that is returned, so the return
-    document is always much more interesting than the http status code."""
+    document is always much more interesting than the http status code.
+    The connections are kept open and reused, see HttpPool."""
 
-    def read_gzipped(response):
-        """read data from the response object,
-        unzip if necessary, return text string"""
-        if response.info().get('Content-Encoding') == 'gzip':
-            with io.BytesIO(response.read()) as buf:
+    def unzip(response, body):
+        """unzip the body if necessary, return text string"""
+        if response.getheader('Content-Encoding') == 'gzip':
+            with io.BytesIO(body) as buf:
                 with gzip.GzipFile(fileobj=buf) as unzipped:
-                    data = unzipped.read()
-        else:
-            data = response.read()
-        return data
-
-    if not headers:
-        headers = {}
-    request = URLRequest(url, post, headers)
-    request.add_header('Accept-encoding', 'gzip')
-    request.add_header('User-Agent', USER_AGENT)
+                    body = unzipped.read()
+        return body
+
+    request_headers = {
+        'Accept-Encoding': 'gzip',
+        'User-Agent': USER_AGENT
+    }
+    if post is not None:
+        request_headers['Content-Type'] = 'application/x-www-form-urlencoded'
+    if headers:
+        request_headers.update(headers)
     data = ""
     try:
-        with contextlib.closing(urlopen(request, post)) as res:
-            data = read_gzipped(res)
-    except HTTPError as err:
-        data = read_gzipped(err)
+        (_status, response, body) = HTTP_POOL.request(url, post, request_headers)
+        data = unzip(response, body)
     except Exception as exc:
         logging.debug("### exception in http_request: %s" % exc)
 
@@ -103,6 +285,224 @@ def start_thread(thread_func, name=None):
         thread.name = name
     return thread
 
+def join_thread(thread, timeout=10):
+    """wait until the thread (if any) has ended, unless it is the one
+    calling this (a slot that is stopping its own thread)"""
+    if thread and thread is not threading.current_thread():
+        thread.join(timeout)
+
+class FetchPool():
+    """a bounded pool of worker threads for the public http requests (full
+    depth, history, ticker, etc.) instead of starting a new thread for every
+    single request. Every request has a key (for example "depth:XETHXXBT")
+    and only one request per key can be queued or running at any time, if
+    the timer fires again while the previous request with the same key is
+    still pending then the new one is coalesced with it (dropped). When the
+    queue is full new requests are skipped."""
+
+    def __init__(self, num_threads=4, size=32):
+        self.num_threads = num_threads
+        self.size = size
+        self._items = collections.deque()
+        self._pending = set()
+        self._cond = threading.Condition(threading.Lock())
+        self._threads = []
+        self.count_submitted = 0
+        self.count_completed = 0
+        self.count_coalesced = 0
+        self.count_skipped = 0
+        self.count_running = 0
+
+    def configure(self, num_threads, size):
+        """change the number of threads (only if not yet started) and
+        the maximum queue size"""
+        with self._cond:
+            if not self._threads:
+                self.num_threads = max(1, num_threads)
+            self.size = max(1, size)
+
+    def submit(self, key, func, name=None):
+        """queue func() for execution, returns False if it was coalesced
+        with a pending request of the same key or if the queue is full"""
+        with self._cond:
+            if key in self._pending:
+                self.count_coalesced += 1
+                return False
+            if len(self._items) >= self.size:
+                self.count_skipped += 1
+                return False
+            if not self._threads:
+                for i in range(self.num_threads):
+                    self._threads.append(start_thread(self._thread_func, "http fetch %i" % i))
+            self._pending.add(key)
+            self._items.append((key, func))
+            self.count_submitted += 1
+            self._cond.notify()
+            return True
+
+    def get_depth(self):
+        """number of requests waiting in the queue"""
+        return len(self._items)
+
+    def get_stats(self):
+        """return a dict with the current statistics"""
+        with self._cond:
+            return {
+                "depth": len(self._items),
+                "running": self.count_running,
+                "submitted": self.count_submitted,
+                "completed": self.count_completed,
+                "coalesced": self.count_coalesced,
+                "skipped": self.count_skipped
+            }
+
+    def format_stats(self):
+        """return the statistics as a human readable line"""
+        return "fetch pool: queued %(depth)i, running %(running)i, submitted %(submitted)i, " \
+            "completed %(completed)i, coalesced %(coalesced)i, skipped %(skipped)i" % self.get_stats()
+
+    def _thread_func(self):
+        """worker thread, runs forever"""
+        while True:
+            with self._cond:
+                while not self._items:
+                    self._cond.wait()
+                (key, func) = self._items.popleft()
+                self.count_running += 1
+            try:
+                func()
+            except: # pylint: disable=W0702
+                logging.error(traceback.format_exc())
+            with self._cond:
+                self._pending.discard(key)
+                self.count_running -= 1
+                self.count_completed += 1
+
+
+FETCH_POOL = FetchPool()
+
+class TokenBucket():
+    """a token bucket rate limiter, it holds at most capacity tokens and
+    refills with rate tokens per second. consume() will block until enough
+    tokens are available. This is the same as the call counter used by some
+    exchanges, the counter increases with every call and decreases over time
+    and it must never exceed the maximum."""
+
+    def __init__(self, capacity, rate):
+        self.capacity = float(capacity)
+        self.rate = float(rate)
+        self._tokens = self.capacity
+        self._time = time.time()
+        self._lock = threading.Lock()
+        self.count_waits = 0
+        self.time_waited = 0
+
+    def _refill(self):
+        """add the tokens for the time since the last refill"""
+        now = time.time()
+        self._tokens = min(self.capacity, self._tokens + (now - self._time) * self.rate)
+        self._time = now
+
+    def get_tokens(self):
+        """number of currently available tokens"""
+        with self._lock:
+            self._refill()
+            return self._tokens
+
+    def try_consume(self, cost):
+        """take the tokens if available and return True, otherwise
+        return False immediately"""
+        with self._lock:
+            self._refill()
+            if self._tokens >= cost:
+                self._tokens -= cost
+                return True
+            return False
+
+    def consume(self, cost):
+        """take the tokens, block until they are available"""
+        cost = min(cost, self.capacity)
+        waited = 0
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= cost:
+                    self._tokens -= cost
+                    if waited:
+                        self.count_waits += 1
+                        self.time_waited += waited
+                    return
+                wait = (cost - self._tokens) / self.rate
+            time.sleep(wait)
+            waited += wait
+
+    def drain(self):
+        """empty the bucket, this is used when the server tells us that
+        we have exceeded its limit although we thought we had not"""
+        with self._lock:
+            self._refill()
+            self._tokens = 0
+
+class FixedPoint():
+    """the price and volume precision of a currency pair. Prices are
+    counted in ticks (the smallest price step) and volumes in lots (the
+    smallest volume step). The exchange clients round everything they
+    receive to this precision, so the same price is always the same float,
+    and the order book uses the integer ticks to find its levels."""
+
+    def __init__(self, price_decimals, volume_decimals):
+        self.price_decimals = price_decimals
+        self.volume_decimals = volume_decimals
+        self.mult_price = 10 ** price_decimals
+        self.mult_volume = 10 ** volume_decimals
+        self._format_price = "%%.%if" % price_decimals
+        self._format_volume = "%%.%if" % volume_decimals
+
+    def price2int(self, price):
+        """price in ticks"""
+        return int(round(price * self.mult_price))
+
+    def int2price(self, ticks):
+        """price of this number of ticks"""
+        return ticks / float(self.mult_price)
+
+    def volume2int(self, volume):
+        """volume in lots"""
+        return int(round(volume * self.mult_volume))
+
+    def int2volume(self, lots):
+        """volume of this number of lots"""
+        return lots / float(self.mult_volume)
+
+    def round_price(self, price):
+        """round a float price to the nearest tick"""
+        return round(price * self.mult_price) / self.mult_price
+
+    def round_volume(self, volume):
+        """round a float volume to the nearest lot"""
+        return round(volume * self.mult_volume) / self.mult_volume
+
+    def format_price(self, price):
+        """price as string with exactly price_decimals decimals"""
+        return self._format_price % price
+
+    def format_volume(self, volume):
+        """volume as string with exactly volume_decimals decimals"""
+        return self._format_volume % volume
+
+def get_fixed_point(config, price_decimals, volume_decimals):
+    """return the FixedPoint() for the traded pair, the exchange client
+    knows the precision of its pairs, price_decimals and volume_decimals in
+    the ini file can override it (empty means use the exchange's value)"""
+    price_str = config.get_string("api", "price_decimals")
+    volume_str = config.get_string("api", "volume_decimals")
+    if price_str != "":
+        price_decimals = int(price_str)
+    if volume_str != "":
+        volume_decimals = int(volume_str)
+    return FixedPoint(price_decimals, volume_decimals)
+
+
 def pretty_format(something):
     """pretty-format a nested dict or list for debugging purposes.
     If it happens to be a valid json string then it will be parsed first"""
@@ -131,6 +531,36 @@ class ApiConfig(SafeConfigParser):
                  ["api", "load_fulldepth", "True"],
                  ["api", "load_history", "True"],
                  ["api", "history_timeframe", "15"],
+                 ["api", "history_retention", "10000"],
+                 ["api", "history_timeframes", "1,15,60,240"],
+                 ["api", "dispatch_queue_size", "0"],
+                 ["api", "dispatch_threads", "1"],
+                 ["api", "dispatch_overflow", DISPATCH_BLOCK],
+                 ["api", "signal_stats", "False"],
+                 ["api", "http_pool_size", "4"],
+                 ["api", "http_idle_timeout", "30"],
+                 ["api", "fetch_threads", "4"],
+                 ["api", "fetch_queue_size", "32"],
+                 ["api", "kraken_call_limit", "15"],
+                 ["api", "kraken_call_decay", "0.33"],
+                 ["api", "kraken_order_limit", "60"],
+                 ["api", "kraken_order_decay", "1"],
+                 ["api", "price_decimals", ""],
+                 ["api", "checkpoint_interval", "0"],
+                 ["api", "checkpoint_max_age", "3600"],
+                 ["api", "trade_tape", "True"],
+                 ["api", "trade_tape_warmup", "172800"],
+                 ["api", "trade_tape_retention", "2592000"],
+                 ["api", "record_feed", ""],
+                 ["api", "replay_file", ""],
+                 ["api", "replay_speed", "0"],
+                 ["api", "backtest_latency", "0.25"],
+                 ["api", "backtest_fee_maker", "0.16"],
+                 ["api", "backtest_fee_taker", "0.26"],
+                 ["api", "backtest_balance_base", "10"],
+                 ["api", "backtest_balance_quote", "1"],
+                 ["api", "backtest_fill_at_touch", "False"],
+                 ["api", "volume_decimals", ""],
                  ["api", "secret_key", ""],
                  ["api", "secret_secret", ""]]
 
@@ -205,113 +635,953 @@ class ApiConfig(SafeConfigParser):
             self.save()
 
 
+class NoLock():
+    """a dummy lock that never blocks. It can be given to signals that don't
+    need their slots to be serialized at all, like the debug signals which
+    are emitted from everywhere in the application. Their slots must then do
+    their own locking if they need it (the curses console does this)."""
+
+    def acquire(self, blocking=True):
+        """always succeeds immediately"""
+        return True
+
+    def release(self):
+        """nothing to release"""
+        pass
+
+    def __enter__(self):
+        return True
+
+    def __exit__(self, *args):
+        pass
+
+
 class Signal():
     """callback functions (so called slots) can be connected to a signal and
     will be called when the signal is called (Signal implements __call__).
     The slots receive two arguments: the sender of the signal and a custom
-    data object. Two different threads won't be allowed to send signals at the
-    same time application-wide, concurrent threads will have to wait until
-    the lock is releaesed again. The lock allows recursive reentry of the same
-    thread to avoid deadlocks when a slot wants to send a signal itself."""
-
-    _lock = threading.RLock()
+    data object. Every signal has its own lock, two different threads won't
+    be allowed to send the same signal at the same time, but unrelated signals
+    can be sent concurrently. Signals whose slots operate on the same data can
+    share one lock by passing it to the constructor, Api() does this for all
+    of its own signals and for those of its OrderBook and History to keep all
+    market events of one instance strictly ordered. The lock allows recursive
+    reentry of the same thread to avoid deadlocks when a slot wants to send a
+    signal itself."""
+
+    _registry = weakref.WeakSet()
+    _lock_owners = weakref.WeakSet()
+    _stats_enabled = False
+    # changes whenever the slots of any signal change, code that caches
+    # has_slots() of some signals can compare it to see if it is still valid
+    generation = 0
     signal_error = None
 
-    def __init__(self):
+    def __init__(self, lock=None):
+        """create a new signal. lock is an optional lock object (usually a
+        threading.RLock) that is shared with other signals, if it is None
+        then the signal will create its own private lock."""
         self._functions = weakref.WeakSet()
         self._methods = weakref.WeakKeyDictionary()
+        self._coalescers = weakref.WeakKeyDictionary()
+        self._slots = None  # cached dispatch list, see _get_slots()
+        self._stats = None  # SignalStats, only used when stats are enabled
+        if lock is None:
+            lock = threading.RLock()
+        self._lock = lock
+        self._dispatcher = None
+        self._dispatch_key = None
+        self._dispatch_lossy = False
+        Signal._registry.add(self)
 
         # the Signal class itself has a static member signal_error where it
         # will send tracebacks of exceptions that might happen. Here we
         # initialize it if it does not exist already
         if not Signal.signal_error:
             Signal.signal_error = 1
-            Signal.signal_error = Signal()
-
-    def connect(self, slot):
+            Signal.signal_error = Signal(NoLock())
+
+    @staticmethod
+    def get_locks():
+        """return a list of all distinct locks that are currently in use by
+        any of the existing signals (not including the dummy NoLock objects)"""
+        locks = []
+        for signal in list(Signal._registry):
+            lock = signal._lock
+            if not isinstance(lock, NoLock) and lock not in locks:
+                locks.append(lock)
+        return locks
+
+    @staticmethod
+    def enable_stats(enabled):
+        """switch the collection of statistics (see SignalStats) on or off
+        for all signals. When it is off (the default) it costs nothing."""
+        Signal._stats_enabled = enabled
+
+    @staticmethod
+    def add_lock_owner(owner):
+        """owner has the lock of its signals in owner.lock and uses it
+        directly too (like Api), replace_lock() will replace it there also"""
+        Signal._lock_owners.add(owner)
+
+    @staticmethod
+    def replace_lock(old_lock, new_lock):
+        """replace old_lock with new_lock in all signals that are using it
+        and in the lock owners (see add_lock_owner()) that have it.
+        This is only meant to be used during shutdown to break open a lock
+        that is held forever by some stuck slot in some other thread."""
+        for signal in list(Signal._registry):
+            if signal._lock is old_lock:
+                signal._lock = new_lock
+        for owner in list(Signal._lock_owners):
+            if owner.lock is old_lock:
+                owner.lock = new_lock
+
+    def has_slots(self):
+        """return True if at least one slot is connected"""
+        return len(self._get_slots()) > 0
+
+    def set_dispatcher(self, dispatcher, key=None, lossy=False):
+        """make this signal asynchronous. From now on calling it will only
+        put it into the queue of the Dispatcher object and return immediately,
+        the slots will then be called from one of the dispatcher's threads.
+        Signals with the same key are always handled by the same thread in
+        the order they were emitted, by default the key is the signal's lock.
+        Only the events of lossy signals may be dropped or coalesced when the
+        queue is full (the dispatcher's overflow policy), use it only for
+        signals where the newest event replaces all older ones (ticker).
+        Pass None as dispatcher to make it synchronous again."""
+        self._dispatcher = dispatcher
+        if key is None:
+            key = self._lock
+        self._dispatch_key = key
+        self._dispatch_lossy = lossy
+
+    def connect(self, slot, max_rate=0, latest_only=False):
         """connect a slot to this signal. The parameter slot can be a funtion
         that takes exactly 2 arguments or a method that takes self plus 2 more
         arguments, or it can even be even another signal. the first argument
         is a reference to the sender of the signal and the second argument is
         the payload. The payload can be anything, it totally depends on the
-        sender and type of the signal."""
+        sender and type of the signal.
+        Slots that don't need to see every single event (like repainting
+        something) can be connected with max_rate (calls per second) and/or
+        latest_only, see Coalescer for details. Without these options the slot
+        will be called for every event."""
         if inspect.ismethod(slot):
-            instance = slot.__self__
+            owner = slot.__self__
             function = slot.__func__
-            if instance not in self._methods:
-                self._methods[instance] = set()
-            if function not in self._methods[instance]:
-                self._methods[instance].add(function)
+        else:
+            owner = slot
+            function = None
+
+        if max_rate or latest_only:
+            if function:
+                if owner in self._methods:
+                    self._methods[owner].discard(function)
+            else:
+                self._functions.discard(owner)
+            self._remove_coalescer(owner, function)
+            if owner not in self._coalescers:
+                self._coalescers[owner] = {}
+            self._coalescers[owner][function] = Coalescer(self, owner, function, max_rate, latest_only)
+            self._slots_changed()
+            return
+
+        self._remove_coalescer(owner, function)
+        if function:
+            if owner not in self._methods:
+                self._methods[owner] = set()
+            if function not in self._methods[owner]:
+                self._methods[owner].add(function)
         else:
             if slot not in self._functions:
                 self._functions.add(slot)
+        self._slots_changed()
 
-    def __call__(self, sender, data, error_signal_on_error=True):
+    def disconnect(self, slot):
+        """disconnect a slot that has been connected with connect() before,
+        it does nothing if the slot is not connected to this signal."""
+        if inspect.ismethod(slot):
+            owner = slot.__self__
+            function = slot.__func__
+            if owner in self._methods:
+                self._methods[owner].discard(function)
+                if not self._methods[owner]:
+                    del self._methods[owner]
+        else:
+            owner = slot
+            function = None
+            self._functions.discard(slot)
+        self._remove_coalescer(owner, function)
+        self._slots_changed()
+
+    def _remove_coalescer(self, owner, function):
+        """remove and cancel the Coalescer of this slot if there is one"""
+        if owner in self._coalescers:
+            coalescer = self._coalescers[owner].pop(function, None)
+            if coalescer:
+                coalescer.cancel()
+            if not self._coalescers[owner]:
+                del self._coalescers[owner]
+
+    def _slots_changed(self):
+        """the slots have changed, rebuild the list next time"""
+        self._slots = None
+        Signal.generation += 1
+
+    def _get_slots(self):
+        """return the list of slots to call, this list is cached and it will
+        only be rebuilt after connect(), disconnect() or when one of the slots
+        has been garbage collected. Each entry is a tuple (ref, function)
+        where ref is a weak reference to the function or to the instance of
+        the method (or to the owner of a coalesced slot) and function is the
+        unbound function to call with the instance as first argument, it is
+        None for plain functions."""
+        slots = self._slots
+        if slots is None:
+            slots = []
+            for func in self._functions:
+                slots.append((weakref.ref(func), None))
+            for instance, functions in self._methods.items():
+                for func in functions:
+                    slots.append((weakref.ref(instance), func))
+            for owner, coalescers in self._coalescers.items():
+                for coalescer in coalescers.values():
+                    slots.append((weakref.ref(owner), coalescer.post_for))
+            self._slots = slots
+        return slots
+
+    def __call__(self, sender, data, error_signal_on_error=True, _dispatched=False):
         """dispatch signal to all connected slots. This is a synchronuos
         operation, It will not return before all slots have been called.
-        Also only exactly one thread is allowed to emit signals at any time,
-        all other threads that try to emit *any* signal anywhere in the
-        application at the same time will be blocked until the lock is released
-        again. The lock will allow recursive reentry of the seme thread, this
-        means a slot can itself emit other signals before it returns (or
-        signals can be directly connected to other signals) without problems.
+        Only one thread at a time is allowed to emit this signal (or any other
+        signal sharing the same lock), other threads that try to emit it at
+        the same time will be blocked until the lock is released again. The
+        lock will allow recursive reentry of the same thread, this means a
+        slot can itself emit other signals before it returns (or signals can
+        be directly connected to other signals) without problems.
         If a slot raises an exception a traceback will be sent to the static
-        Signal.signal_error() or to logging.critical()"""
+        Signal.signal_error() or to logging.critical(), this happens after
+        the lock has been released again.
+        If the signal has a dispatcher (see set_dispatcher()) it will only be
+        queued and this will return True without waiting for the slots
+        (_dispatched is only for the dispatcher, see _dispatch())."""
+        if self._dispatcher and not _dispatched:
+            self._dispatcher.put(self, sender, data, error_signal_on_error)
+            return True
+        if Signal._stats_enabled:
+            return self._dispatch_with_stats(sender, data, error_signal_on_error)
+
+        slots = self._slots
+        if slots is None:
+            slots = self._get_slots()
+        if not slots:
+            # nobody is listening, don't even take the lock
+            return False
+
+        # this runs for every single event, hence acquire() and release()
+        # instead of the slower with statement (and not even that for a
+        # NoLock, the signals of a backtest) and no list for the errors
+        # unless there are any.
+        sent = False
+        errors = None
+        lock = self._lock
+        locking = lock.__class__ is not NoLock
+        if locking:
+            lock.acquire()
+        try:
+            for (ref, function) in slots:
+                owner = ref()
+                if owner is None:
+                    # garbage collected, rebuild the list next time
+                    self._slots_changed()
+                    continue
+                try:
+                    if function is None:
+                        owner(sender, data)
+                    else:
+                        function(owner, sender, data)
+                    sent = True
+
+                except:
+                    if errors is None:
+                        errors = []
+                    errors.append(traceback.format_exc())
+        finally:
+            if locking:
+                lock.release()
+
+        if errors:
+            self._report_errors(errors, error_signal_on_error)
+        return sent
+
+    def _dispatch(self, sender, data, error_signal_on_error):
+        """call all connected slots (synchronously) and return True
+        if at least one of them has been called successfully, also if
+        the signal has a dispatcher (this is what the dispatcher calls)"""
+        return self(sender, data, error_signal_on_error, True)
+
+    def _dispatch_with_stats(self, sender, data, error_signal_on_error):
+        """same as __call__() but also measure the time spent waiting for
+        the lock and the time spent in each slot"""
+        if not self._stats:
+            self._stats = SignalStats()
+        stats = self._stats
+
+        sent = False
+        errors = []
+        time_start = time.time()
         with self._lock:
-            sent = False
-            errors = []
-            for func in self._functions:
+            time_locked = time.time()
+            stats.count_emitted += 1
+            stats.lock_wait.add(time_locked - time_start)
+            for (ref, function) in self._get_slots():
+                owner = ref()
+                if owner is None:
+                    self._slots_changed()
+                    continue
+                time_call = time.time()
                 try:
-                    func(sender, data)
+                    if function is None:
+                        owner(sender, data)
+                    else:
+                        function(owner, sender, data)
                     sent = True
 
                 except:
                     errors.append(traceback.format_exc())
 
-            for instance, functions in self._methods.items():
-                for func in functions:
-                    try:
-                        func(instance, sender, data)
-                        sent = True
+                stats.add_slot_latency(owner, function, time.time() - time_call)
+
+        self._report_errors(errors, error_signal_on_error)
+        return sent
 
-                    except:
-                        errors.append(traceback.format_exc())
+    def _report_errors(self, errors, error_signal_on_error):
+        """send the tracebacks of failed slots to signal_error or the log"""
+        for error in errors:
+            if error_signal_on_error:
+                Signal.signal_error(self, (error), False)
+            else:
+                logging.critical(error)
+
+
+class LatencyHistogram():
+    """histogram of durations with logarithmic bins (powers of 2 in
+    microseconds), good enough for p50/p99 and very cheap to update"""
 
-            for error in errors:
-                if error_signal_on_error:
-                    Signal.signal_error(self, (error), False)
+    NUM_BINS = 40
+
+    def __init__(self):
+        self.bins = [0] * self.NUM_BINS
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, seconds):
+        """add one measured duration (in seconds)"""
+        usec = int(seconds * 1e6)
+        index = math.frexp(usec)[1] if usec > 0 else 0
+        self.bins[min(index, self.NUM_BINS - 1)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, percent):
+        """return the upper bound (in seconds) of the bin that
+        contains the given percentile of all measured durations"""
+        if not self.count:
+            return 0
+        needed = self.count * percent / 100.0
+        seen = 0
+        for index, count in enumerate(self.bins):
+            seen += count
+            if seen >= needed:
+                return min((2 ** index) / 1e6, self.max)
+        return self.max
+
+    def format(self):
+        """return p50/p99/max as a human readable string"""
+        return "p50 %.6f p99 %.6f max %.6f" % (
+            self.percentile(50), self.percentile(99), self.max)
+
+
+class SignalStats():
+    """statistics of one signal: how often it was emitted, how long it had to
+    wait for its lock and how long each of its slots took. This is collected
+    only after Signal.enable_stats(True) has been called."""
+
+    def __init__(self):
+        self.count_emitted = 0
+        self.lock_wait = LatencyHistogram()
+        self.slots = {}  # slot name -> LatencyHistogram
+
+    def add_slot_latency(self, owner, function, seconds):
+        """add the measured duration of one slot call"""
+        if function is None:
+            name = getattr(owner, "__name__", owner.__class__.__name__)
+        else:
+            name = "%s.%s" % (owner.__class__.__name__, function.__name__)
+        if name not in self.slots:
+            self.slots[name] = LatencyHistogram()
+        self.slots[name].add(seconds)
+
+    def format(self, name):
+        """return a list of human readable lines"""
+        lines = ["%s: emitted %i, lock wait %s" % (
+            name, self.count_emitted, self.lock_wait.format())]
+        for slot_name in sorted(self.slots):
+            hist = self.slots[slot_name]
+            lines.append("    %s: calls %i, %s" % (
+                slot_name, hist.count, hist.format()))
+        return lines
+
+
+class Coalescer():
+    """calls one slot of a signal no more often than necessary, this is used
+    by Signal.connect() when a slot is connected with max_rate or latest_only.
+    Events that arrive while a call is still pending are merged, only the most
+    recent (sender, data) will be delivered.
+
+    max_rate: the first event is passed on immediately but then the slot will
+    not be called again for 1/max_rate seconds, all events that arrive in the
+    meantime are merged and delivered at the end of that window.
+
+    latest_only: the slot is never called on the emitting thread, it will be
+    called from the DeliveryThread shortly afterwards (or at the end of the max_rate
+    window) with the most recent data. A burst of events that are emitted in
+    one go will therefore result in only one call.
+
+    Delayed calls are made with the signal's lock held, so they are still
+    properly ordered with all other events of that signal. The Scheduler
+    only hands them over to the DeliveryThread, waiting for the lock and a
+    slow slot (a curses repaint) must not hold up all the timers."""
+
+    def __init__(self, signal, owner, function, max_rate, latest_only):
+        self.signal = signal
+        self.interval = 1.0 / max_rate if max_rate else 0
+        self.latest_only = latest_only
+        self._owner = weakref.ref(owner)
+        self._function = function
+        self._mutex = threading.Lock()
+        self._pending = None
+        self._timer = None
+        self._time_next = 0
+
+    def post_for(self, _owner, sender, data):
+        """called by the signal with the (still alive) owner of the slot"""
+        self.post(sender, data)
+
+    def post(self, sender, data):
+        """an event for this slot, call it now or later"""
+        now = Scheduler.get().time()
+        with self._mutex:
+            self._pending = (sender, data)
+            if self._timer:
+                # a call is already scheduled, it will pick up this data
+                return
+            if not self.latest_only and now >= self._time_next:
+                self._pending = None
+                self._time_next = now + self.interval
+                call_now = True
+            else:
+                self._timer = Scheduler.get().call_at(self._time_next, self._on_timer_due)
+                call_now = False
+        if call_now:
+            self._call(sender, data)
+
+    def cancel(self):
+        """the slot has been disconnected, forget the pending event"""
+        with self._mutex:
+            self._pending = None
+            if self._timer:
+                Scheduler.get().cancel(self._timer)
+                self._timer = None
+
+    def _on_timer_due(self):
+        """called by the Scheduler, the pending event is delivered on the
+        DeliveryThread (see Scheduler.deliver()). Until then self._timer stays set, so events that
+        arrive in the meantime are still merged into it."""
+        Scheduler.get().deliver(self._on_timer)
+
+    def _on_timer(self):
+        """the window is over, deliver the pending event (if any)"""
+        with self._mutex:
+            pending = self._pending
+            self._pending = None
+            self._timer = None
+            self._time_next = Scheduler.get().time() + self.interval
+        if pending:
+            (sender, data) = pending
+            try:
+                with self.signal._lock:
+                    self._call(sender, data)
+            except:
+                Signal.signal_error(self.signal, (traceback.format_exc()), False)
+
+    def _call(self, sender, data):
+        """call the slot if it is still alive"""
+        owner = self._owner()
+        if owner is None:
+            return
+        if self._function:
+            self._function(owner, sender, data)
+        else:
+            owner(sender, data)
+
+
+class DeliveryThread():
+    """the one thread that makes the delayed calls of all Coalescer objects.
+    They need the signal's lock and the slots can be slow, so the Scheduler
+    thread only puts them into this queue and goes on with the timers."""
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self):
+        self._items = collections.deque()
+        self._cond = threading.Condition(threading.Lock())
+        self._thread = None
+        self._stopping = None  # the thread that stop() is waiting for
+
+    @staticmethod
+    def get():
+        """return the one global delivery thread instance"""
+        with DeliveryThread._instance_lock:
+            if not DeliveryThread._instance:
+                DeliveryThread._instance = DeliveryThread()
+            return DeliveryThread._instance
+
+    def put(self, func):
+        """call func() on the delivery thread as soon as possible"""
+        with self._cond:
+            self._items.append(func)
+            if not self._thread and threading.current_thread() is not self._stopping:
+                self._thread = start_thread(self._thread_func, "coalescer delivery")
+            self._cond.notify()
+
+    def stop(self):
+        """end the delivery thread (at shutdown), waiting for the call that
+        is running. The next put() starts a new one."""
+        with self._cond:
+            thread = self._stopping = self._thread
+            self._thread = None
+            self._cond.notify_all()
+        join_thread(thread)
+
+    def _thread_func(self):
+        """the delivery thread, runs until stop()"""
+        current = threading.current_thread()
+        while True:
+            with self._cond:
+                while not self._items and self._thread is current:
+                    self._cond.wait()
+                if self._thread is not current:
+                    return
+                func = self._items.popleft()
+            try:
+                func()
+            except: # pylint: disable=W0702
+                logging.error(traceback.format_exc())
+
+
+class DispatchQueue():
+    """one bounded queue of a Dispatcher and the statistics about it,
+    every dispatcher thread is draining exactly one of these queues"""
+
+    def __init__(self, size):
+        self.size = size
+        self.items = collections.deque()
+        self.cond = threading.Condition(threading.Lock())
+        self.count_enqueued = 0
+        self.count_dispatched = 0
+        self.count_dropped = 0
+        self.count_coalesced = 0
+        self.count_blocked = 0
+        self.max_depth = 0
+        self.lag = 0  # seconds, moving average
+        self.max_lag = 0
+
+
+class Dispatcher():
+    """asynchronous signal dispatcher. Signals that have been attached to it
+    with Signal.set_dispatcher() will only put (signal, sender, data) into a
+    bounded queue when they are emitted and return immediately, one or more
+    dispatcher threads will then call their slots. This way the network
+    threads never have to wait for the consumers (order book, curses, bots).
+
+    When a queue is full the overflow policy decides what happens:
+      DISPATCH_BLOCK the emitting thread will wait until there is room again
+      DISPATCH_DROP_OLDEST the oldest queued event of a lossy signal is thrown
+                           away, if there is none then the emitting thread
+                           will wait
+      DISPATCH_COALESCE when a lossy signal is emitted, the data of an already
+                        queued event of the same signal and sender is replaced
+                        with the new one, if there is no such event (or the
+                        signal is not lossy) then the emitting thread will wait.
+    Events of signals that are not lossy (see Signal.set_dispatcher()) are
+    never dropped or coalesced, whatever the policy is."""
+
+    def __init__(self, size, num_threads=1, overflow=DISPATCH_BLOCK):
+        """create the queues and start the dispatcher threads. size is the
+        maximum number of queued events per thread."""
+        if overflow not in [DISPATCH_BLOCK, DISPATCH_DROP_OLDEST, DISPATCH_COALESCE]:
+            raise Exception("Unsupported dispatch overflow policy: %s" % overflow)
+        self.overflow = overflow
+        self._terminating = False
+        self._queues = []
+        for i in range(max(1, num_threads)):
+            queue = DispatchQueue(size)
+            self._queues.append(queue)
+            start_thread(lambda queue=queue: self._thread_func(queue), "signal dispatcher %i" % i)
+
+    def stop(self):
+        """stop all dispatcher threads, pending events are discarded"""
+        self._terminating = True
+        for queue in self._queues:
+            with queue.cond:
+                queue.items.clear()
+                queue.cond.notify_all()
+
+    def put(self, signal, sender, data, error_signal_on_error=True):
+        """put the signal into the queue, this is called by Signal.__call__()"""
+        queue = self._queues[id(signal._dispatch_key) % len(self._queues)]
+        with queue.cond:
+            if len(queue.items) >= queue.size:
+                if self.overflow == DISPATCH_DROP_OLDEST and self._drop_oldest(queue):
+                    queue.count_dropped += 1
+                elif (self.overflow == DISPATCH_COALESCE and signal._dispatch_lossy
+                      and self._coalesce(queue, signal, sender, data)):
+                    queue.count_coalesced += 1
+                    return
                 else:
-                    logging.critical(error)
+                    queue.count_blocked += 1
+                    while len(queue.items) >= queue.size and not self._terminating:
+                        queue.cond.wait()
+            if self._terminating:
+                return
+            queue.items.append((signal, sender, data, error_signal_on_error, time.time()))
+            queue.count_enqueued += 1
+            queue.max_depth = max(queue.max_depth, len(queue.items))
+            queue.cond.notify_all()
+
+    def _drop_oldest(self, queue):
+        """remove the oldest queued event of a lossy signal, return False if
+        the queue does not contain any."""
+        for i in range(len(queue.items)):
+            if queue.items[i][0]._dispatch_lossy:
+                del queue.items[i]
+                return True
+        return False
 
-            return sent
+    def _coalesce(self, queue, signal, sender, data):
+        """replace the data of the newest queued event of the same signal and
+        sender (keeping its position and enqueue time) return False if the
+        queue does not contain such an event."""
+        for i in reversed(range(len(queue.items))):
+            (qsignal, qsender, _qdata, qerror, qtime) = queue.items[i]
+            if qsignal is signal and qsender is sender:
+                queue.items[i] = (qsignal, qsender, data, qerror, qtime)
+                return True
+        return False
+
+    def _thread_func(self, queue):
+        """take events from the queue and call the slots"""
+        while not self._terminating:
+            with queue.cond:
+                while not queue.items and not self._terminating:
+                    queue.cond.wait()
+                if self._terminating:
+                    break
+                (signal, sender, data, error_signal_on_error, time_enqueued) = queue.items.popleft()
+                queue.cond.notify_all()
+
+            lag = time.time() - time_enqueued
+            queue.lag = (queue.lag * 29 + lag) / 30
+            queue.max_lag = max(queue.max_lag, lag)
+            signal._dispatch(sender, data, error_signal_on_error)
+            queue.count_dispatched += 1
+
+    def get_depth(self):
+        """return the number of currently queued events"""
+        return sum(len(queue.items) for queue in self._queues)
+
+    def get_lag(self):
+        """return the (moving average) time in seconds that events had to wait
+        in the queue before being dispatched, the largest of all queues"""
+        return max(queue.lag for queue in self._queues)
+
+    def get_stats(self):
+        """return a dict with the queue statistics, summed over all queues"""
+        stats = {
+            "depth": self.get_depth(),
+            "max_depth": max(queue.max_depth for queue in self._queues),
+            "lag": self.get_lag(),
+            "max_lag": max(queue.max_lag for queue in self._queues),
+            "enqueued": 0,
+            "dispatched": 0,
+            "dropped": 0,
+            "coalesced": 0,
+            "blocked": 0
+        }
+        for queue in self._queues:
+            stats["enqueued"] += queue.count_enqueued
+            stats["dispatched"] += queue.count_dispatched
+            stats["dropped"] += queue.count_dropped
+            stats["coalesced"] += queue.count_coalesced
+            stats["blocked"] += queue.count_blocked
+        return stats
 
 
 class BaseObject():
     """This base class only exists because of the debug() method that is used
-    in many of the PyTrader objects to send debug output to the signal_debug."""
+    in many of the PyTrader objects to send debug output to the signal_debug.
+
+    Every message belongs to a category and has a level (the levels of the
+    logging module). Categories can be switched off and a minimum level can
+    be set application-wide, messages that are not wanted are dropped before
+    any string formatting happens, this is important for the messages that
+    are produced for every single trade or depth update."""
+
+    _log_level = logging.DEBUG
+    _log_disabled = set()
+
+    # the category of messages sent with debug(), subclasses may override it
+    log_category = LOG_GENERAL
 
     def __init__(self):
-        self.signal_debug = Signal()
+        self.signal_debug = Signal(NoLock())
+
+    @staticmethod
+    def set_log_level(level):
+        """drop all messages below this level (logging.DEBUG, logging.INFO,
+        etc.), this affects all objects in the application"""
+        BaseObject._log_level = level
+
+    @staticmethod
+    def set_log_category(category, enabled):
+        """enable or disable a message category (LOG_TRADE, etc.),
+        this affects all objects in the application"""
+        if enabled:
+            BaseObject._log_disabled.discard(category)
+        else:
+            BaseObject._log_disabled.add(category)
+
+    @staticmethod
+    def is_log_wanted(category, level=logging.DEBUG):
+        """would a message with this category and level be sent at all?"""
+        return level >= BaseObject._log_level and category not in BaseObject._log_disabled
 
     def debug(self, *args):
         """send a string composed of all *args to all slots that
         are connected to signal_debug or send it to the logger if
         none are connected"""
-        msg = " ".join([unicode(x) for x in args])
+        if not BaseObject.is_log_wanted(self.log_category):
+            return
+        if not self._have_log_receiver(logging.DEBUG):
+            return
+        self._send_log(logging.DEBUG, " ".join([unicode(x) for x in args]))
+
+    def log(self, category, level, fmt, *args):
+        """send a message of the given category and level. The message is
+        fmt % args but the formatting only happens if somebody is interested
+        in it, so use this (not debug()) for frequent messages."""
+        # same as is_log_wanted() but without the call, this is
+        # called for every depth and trade message
+        if level < BaseObject._log_level or category in BaseObject._log_disabled:
+            return
+        if not self._have_log_receiver(level):
+            return
+        if args:
+            msg = fmt % args
+        else:
+            msg = unicode(fmt)
+        self._send_log(level, msg)
+
+    def _have_log_receiver(self, level):
+        """is there any slot connected or would the logger write it?"""
+        if self.signal_debug.has_slots():
+            return True
+        return logging.getLogger().isEnabledFor(level)
+
+    def _send_log(self, level, msg):
+        """send the formatted message to signal_debug or to the logger"""
         if not self.signal_debug(self, (msg)):
-            logging.debug(msg)
+            logging.log(level, msg)
 
 
-class Timer(Signal):
-    """a simple timer (used for stuff like keepalive)."""
+class Scheduler():
+    """runs all Timer objects (and hands over the delayed calls of the
+    Coalescer to the DeliveryThread) on one single thread instead of starting a new thread for every single firing.
+    Scheduled calls are kept in a heap ordered by their due time and the
+    thread sleeps until the earliest one is due. The scheduled functions must
+    return quickly, everything that can take longer (http requests, etc.)
+    must be started in its own thread, as the clients are already doing."""
+
+    _instance = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self):
+        self._heap = []
+        self._cond = threading.Condition(threading.Lock())
+        self._seq = itertools.count()
+        self._thread = None
+        self._stopping = None  # the thread that stop() is waiting for
+
+    @staticmethod
+    def get():
+        """return the one global scheduler instance"""
+        with Scheduler._instance_lock:
+            if not Scheduler._instance:
+                Scheduler._instance = Scheduler()
+            return Scheduler._instance
+
+    @staticmethod
+    def install(scheduler):
+        """make scheduler the global instance (a SimulatedScheduler for a
+        backtest), all timers that are started from now on use it. Return
+        the previous one, to install it again later."""
+        with Scheduler._instance_lock:
+            previous = Scheduler._instance
+            Scheduler._instance = scheduler
+            return previous
+
+    def time(self):
+        """the current time for the timers, time.time()"""
+        return time.time()
+
+    def deliver(self, func):
+        """call func() (a delayed call of a Coalescer) as soon as possible
+        on the DeliveryThread"""
+        DeliveryThread.get().put(func)
+
+    def call_at(self, due, func):
+        """call func() at the time due (as in time.time()), return a handle
+        that can be used to cancel() it"""
+        # the sequence number keeps entries with equal due time in order
+        # and makes sure the functions themselves are never compared
+        entry = [due, next(self._seq), func]
+        with self._cond:
+            heapq.heappush(self._heap, entry)
+            if not self._thread and threading.current_thread() is not self._stopping:
+                self._thread = start_thread(self._thread_func, "scheduler")
+            if self._heap[0] is entry:
+                self._cond.notify()
+        return entry
+
+    def call_later(self, delay, func):
+        """call func() after delay seconds, return a handle for cancel()"""
+        return self.call_at(time.time() + delay, func)
+
+    def cancel(self, entry):
+        """cancel a scheduled call. The entry is only marked as canceled,
+        it will be thrown away when it reaches the top of the heap"""
+        entry[2] = None
+
+    def get_count(self):
+        """number of scheduled calls (including canceled ones not yet removed)"""
+        return len(self._heap)
+
+    def stop(self):
+        """end the scheduler thread (at shutdown), waiting for the call that
+        is running. Scheduled calls are kept, the next call_at() starts a
+        new thread (unless it comes from the ending thread itself, like a
+        timer that is firing and schedules its next firing)."""
+        with self._cond:
+            thread = self._stopping = self._thread
+            self._thread = None
+            self._cond.notify_all()
+        join_thread(thread)
+
+    def _thread_func(self):
+        """the scheduler thread, runs until stop()"""
+        current = threading.current_thread()
+        while True:
+            with self._cond:
+                while True:
+                    if self._thread is not current:
+                        return
+                    while self._heap and self._heap[0][2] is None:
+                        heapq.heappop(self._heap)
+                    if not self._heap:
+                        self._cond.wait()
+                        continue
+                    wait = self._heap[0][0] - time.time()
+                    if wait <= 0:
+                        func = heapq.heappop(self._heap)[2]
+                        break
+                    self._cond.wait(wait)
+            try:
+                func()
+            except: # pylint: disable=W0702
+                logging.error(traceback.format_exc())
+
+
+class SimulatedScheduler(Scheduler):
+    """a Scheduler for simulated time (see BacktestClient). It has no
+    thread, clock is a function that returns the simulated time and the
+    owner of the clock calls fire_next() for every call that becomes due
+    while it advances it. Timers and delayed calls are made in the same
+    thread as everything else, so they need no locking."""
+
+    def __init__(self, clock):
+        Scheduler.__init__(self)
+        self._clock = clock
+        self.heap = self._heap  # [due, seq, func], for a quick look at heap[0][0]
+
+    def time(self):
+        """the current simulated time"""
+        return self._clock()
+
+    def call_at(self, due, func):
+        """call func() when the simulated time reaches due"""
+        entry = [due, next(self._seq), func]
+        heapq.heappush(self._heap, entry)
+        return entry
 
-    def __init__(self, interval, one_shot=False):
+    def deliver(self, func):
+        """there is no other thread, call it now"""
+        func()
+
+    def stop(self):
+        """there is no thread to stop"""
+        pass
+
+    def next_due(self):
+        """the due time of the next call, None if there is none"""
+        heap = self._heap
+        while heap and heap[0][2] is None:
+            heapq.heappop(heap)
+        return heap[0][0] if heap else None
+
+    def fire_next(self):
+        """make the next call, the clock must be at its due time already"""
+        func = heapq.heappop(self._heap)[2]
+        try:
+            func()
+        except: # pylint: disable=W0702
+            logging.error(traceback.format_exc())
+
+
+class Timer(Signal):
+    """a simple timer (used for stuff like keepalive). All timers are driven
+    by the one Scheduler thread. Periodic timers are scheduled on a fixed grid
+    (start + n * interval) so they don't drift, if a firing is late then the
+    missed ones are skipped, there will be no burst of catch-up firings.
+    jitter (seconds) adds a random delay to every firing (not accumulating)
+    to spread out timers that would otherwise always fire together. In a
+    backtest they run in simulated time, see SimulatedScheduler."""
+
+    def __init__(self, interval, one_shot=False, jitter=0):
         """create a new timer, interval is in seconds"""
         Signal.__init__(self)
         self._one_shot = one_shot
         self._canceled = False
         self._interval = interval
-        self._timer = None
+        self._jitter = jitter
+        self._entry = None
+        self._due = Scheduler.get().time()
         self._start()
 
     def _fire(self):
@@ -322,16 +1592,23 @@ class Timer(Signal):
                 self._start()
 
     def _start(self):
-        """start the timer"""
-        self._timer = threading.Timer(self._interval, self._fire)
-        self._timer.daemon = True
-        self._timer.start()
+        """schedule the next firing"""
+        now = Scheduler.get().time()
+        self._due += self._interval
+        if self._due < now and self._interval > 0:
+            skip = math.ceil((now - self._due) / self._interval)
+            self._due += skip * self._interval
+        due = self._due
+        if self._jitter:
+            due += random.uniform(0, self._jitter)
+        self._entry = Scheduler.get().call_at(due, self._fire)
 
     def cancel(self):
         """cancel the timer"""
         self._canceled = True
-        self._timer.cancel()
-        self._timer = None
+        if self._entry:
+            Scheduler.get().cancel(self._entry)
+            self._entry = None
 
 
 class Secret:
@@ -499,51 +1776,383 @@ class OHLCV():
         self.cls = price
         self.vol += volume
 
-
-class History(BaseObject):
-    """represents the trading history"""
-
-    def __init__(self, api, timeframe):
+class ColumnView():
+    """a read only view of length consecutive values of an array starting
+    at offset, nothing is copied. Index 0 is the oldest value. The view is
+    only valid until the CandleStore it came from is changed again."""
+
+    __slots__ = ("_array", "_offset", "_length")
+
+    def __init__(self, arr, offset, length):
+        self._array = arr
+        self._offset = offset
+        self._length = length
+
+    def __len__(self):
+        return self._length
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._length
+        if index < 0 or index >= self._length:
+            raise IndexError("column index out of range")
+        return self._array[self._offset + index]
+
+    def __iter__(self):
+        arr = self._array
+        for index in xrange(self._offset, self._offset + self._length):
+            yield arr[index]
+
+    def __reversed__(self):
+        arr = self._array
+        for index in xrange(self._offset + self._length - 1, self._offset - 1, -1):
+            yield arr[index]
+
+    def to_array(self):
+        """copy of the values as array.array("d")"""
+        return self._array[self._offset:self._offset + self._length]
+
+class CandleStore():
+    """the candles of History in a ring buffer of fixed capacity with one
+    array per column (tim, opn, hig, low, cls, vol). Every value is written
+    twice, at i and at i + capacity, so the most recent candles are always
+    one contiguous range in every array and column() can return views
+    without copying. Appending a candle drops the oldest one when the store
+    is full. Indexing and iterating are newest first and return OHLCV()
+    copies, like the list of candles that was used before."""
+
+    FIELDS = ("tim", "opn", "hig", "low", "cls", "vol")
+
+    def __init__(self, capacity):
+        self.capacity = max(1, int(capacity))
+        self.clear()
+
+    def clear(self):
+        """remove all candles"""
+        self._columns = dict((field, array.array("d", [0]) * (2 * self.capacity))
+                             for field in self.FIELDS)
+        self._head = 0  # where the next candle will be written
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += self._count
+        if index < 0 or index >= self._count:
+            raise IndexError("candle index out of range")
+        pos = self._head + self.capacity - 1 - index
+        cols = self._columns
+        return OHLCV(int(cols["tim"][pos]), cols["opn"][pos], cols["hig"][pos],
+                     cols["low"][pos], cols["cls"][pos], cols["vol"][pos])
+
+    def __iter__(self):
+        for index in xrange(self._count):
+            yield self[index]
+
+    def append(self, tim, opn, hig, low, cls, vol):
+        """add a new candle (it must be newer than all others)"""
+        head = self._head
+        other = head + self.capacity
+        for (field, value) in zip(self.FIELDS, (tim, opn, hig, low, cls, vol)):
+            column = self._columns[field]
+            column[head] = value
+            column[other] = value
+        self._head = (head + 1) % self.capacity
+        if self._count < self.capacity:
+            self._count += 1
+
+    def pop(self):
+        """remove the newest candle"""
+        if self._count:
+            self._head = (self._head - 1) % self.capacity
+            self._count -= 1
+
+    def last_cells(self):
+        """(hig, low, cls, vol, pos, other): the columns and the two
+        positions of the newest candle, for code that updates it for many
+        trades (see CandleEngine._apply_trade()). Valid until the next
+        candle is appended or anything else changes the store."""
+        cols = self._columns
+        pos = (self._head - 1) % self.capacity
+        return (cols["hig"], cols["low"], cols["cls"], cols["vol"], pos, pos + self.capacity)
+
+    def update_last(self, price, volume):
+        """update high, low and close of the newest candle and add volume"""
+        cols = self._columns
+        pos = (self._head - 1) % self.capacity
+        other = pos + self.capacity
+        hig = cols["hig"]
+        if price > hig[pos]:
+            hig[pos] = hig[other] = price
+        low = cols["low"]
+        if price < low[pos]:
+            low[pos] = low[other] = price
+        cls = cols["cls"]
+        cls[pos] = cls[other] = price
+        vol = cols["vol"]
+        vol[pos] = vol[other] = vol[pos] + volume
+
+    def last_time(self):
+        """open time of the newest candle, 0 if empty"""
+        if not self._count:
+            return 0
+        return int(self._columns["tim"][self._head + self.capacity - 1])
+
+    def column(self, field, count=None):
+        """a ColumnView of the newest count values (all if None) of one
+        column, oldest first. field is one of FIELDS"""
+        if count is None or count > self._count:
+            count = self._count
+        end = self._head + self.capacity
+        return ColumnView(self._columns[field], end - count, count)
+
+    def load(self, columns):
+        """replace all candles, columns is a list of six arrays in the order
+        of FIELDS, oldest candle first. Only the newest capacity are kept"""
+        self.clear()
+        count = min(len(columns[0]), self.capacity)
+        for (field, values) in zip(self.FIELDS, columns):
+            column = self._columns[field]
+            values = array.array("d", values[len(values) - count:])
+            column[0:count] = values
+            column[self.capacity:self.capacity + count] = values
+        self._head = count % self.capacity
+        self._count = count
+
+
+class TradeColumns():
+    """downloaded trades as three arrays of doubles (dates, prices, amounts),
+    oldest first. The clients send this with signal_fullhistory, so the
+    candles can be made from whole slices of the arrays. Code that expects
+    the list of {"date", "price", "amount"} dicts that was used before can
+    still index and iterate it, this returns such dicts."""
+
+    def __init__(self, dates=(), prices=(), amounts=(), ids=(), new_only=False, sides=()):
+        self.dates = array.array("d", dates)
+        self.prices = array.array("d", prices)
+        self.amounts = array.array("d", amounts)
+        self.ids = array.array("d", ids)  # exchange trade ids, empty if unknown
+        self.sides = array.array("d", sides)  # 1 buy, -1 sell, empty if unknown
+        self.new_only = new_only  # True if the client has never sent these before
+
+    def __len__(self):
+        return len(self.dates)
+
+    def __getitem__(self, index):
+        return {"date": self.dates[index],
+                "price": self.prices[index],
+                "amount": self.amounts[index]}
+
+    def __iter__(self):
+        for index in xrange(len(self.dates)):
+            yield self[index]
+
+    def append(self, date, price, amount, trade_id=None, side=None):
+        """add one trade (it should be newer than all others)"""
+        self.dates.append(date)
+        self.prices.append(price)
+        self.amounts.append(amount)
+        if trade_id is not None:
+            self.ids.append(trade_id)
+        if side is not None:
+            self.sides.append(side)
+
+    def to_dict(self):
+        """the columns as lists (for json), TradeColumns(**to_dict())
+        makes a copy again"""
+        return {"dates": self.dates.tolist(), "prices": self.prices.tolist(),
+                "amounts": self.amounts.tolist(), "ids": self.ids.tolist(),
+                "sides": self.sides.tolist(), "new_only": self.new_only}
+
+    def sort(self):
+        """sort by date (stable), only needed if they are not in order"""
+        dates = self.dates.tolist()
+        if dates == sorted(dates):
+            return
+        order = sorted(xrange(len(dates)), key=dates.__getitem__)
+        for name in ["dates", "prices", "amounts", "ids", "sides"]:
+            column = getattr(self, name)
+            if not len(column):
+                continue
+            setattr(self, name, array.array("d", [column[index] for index in order]))
+
+def as_trade_columns(trades):
+    """return trades as TradeColumns (sorted by date), trades may also be
+    a list of {"date", "price", "amount"} dicts"""
+    if not isinstance(trades, TradeColumns):
+        trades = TradeColumns([trade["date"] for trade in trades],
+                              [trade["price"] for trade in trades],
+                              [trade["amount"] for trade in trades])
+    trades.sort()
+    return trades
+
+
+class CandleEngine(BaseObject):
+    """builds the candles of several timeframes (in seconds) from one stream
+    of trades, every timeframe has its own CandleStore. A live trade updates
+    the current candle of each timeframe directly. A fullhistory download is
+    aggregated only once, into candles of the base timeframe (the greatest
+    common divisor of all timeframes, it gets a store of its own if it is
+    not one of them) and all other timeframes are then rolled up from these
+    base candles. This also works when the download only covers the end of
+    the current candle of a long timeframe, the beginning is still in the
+    base candles.
+
+    Downloads that only contain trades that were never seen before (the
+    client says so, or they all have exchange trade ids that are not in
+    seen_ids) and that are not older than the current candle are applied
+    trade by trade like live trades instead, so polling the history does
+    not rebuild the recent candles every time and no trade is counted
+    twice."""
+
+    MAX_SEEN_IDS = 100000
+
+    def __init__(self, api, timeframes, retention=10000):
         BaseObject.__init__(self)
 
-        self.signal_fullhistory_processed = Signal()
-        self.signal_changed = Signal()
-
-        self.api = api
-        self.candles = []
-        self.timeframe = timeframe
-
-        self.ready_history = False
+        # (timeframe, OHLCV) when a trade for the next candle arrives, the
+        # candle is then complete. Not fired for downloaded candles.
+        self.signal_candle_closed = Signal(api.lock)
+        # (timeframe, OHLCV, opened) after every trade, opened is True if
+        # the trade opened a new candle
+        self.signal_candle_updated = Signal(api.lock)
+        self.signal_fullhistory_processed = Signal(api.lock)
+
+        self.timeframes = sorted(set(int(timeframe) for timeframe in timeframes))
+        self.base = reduce(gcd, self.timeframes)
+        self.stores = {}
+        for timeframe in self.timeframes:
+            self.stores[timeframe] = CandleStore(retention)
+        # the base candles must reach back to the start of the current
+        # candle of the longest timeframe to be able to roll it up again
+        capacity = max(retention, 2 * self.timeframes[-1] // self.base)
+        self.stores[self.base] = CandleStore(capacity)
+        # the same as signal_candle_updated but only for one timeframe, for
+        # slots that want only one of them (see get_signal_updated())
+        self._signals_updated = dict((timeframe, Signal(api.lock))
+                                     for timeframe in self.timeframes)
+        # (timeframe, store, signal) for every live trade, signal is None
+        # for the base store if it is not one of the timeframes
+        self._trade_targets = [(timeframe, store, self._signals_updated.get(timeframe))
+                               for (timeframe, store) in sorted(self.stores.items())]
+        # trades from _fast_from up to (not including) _fast_until are in
+        # the newest candle of every store, see _apply_trade()
+        self._fast_from = 0
+        self._fast_until = 0
+        self._fast_cells = []  # last_cells() of every store
+        # the targets whose signal has slots, valid while Signal.generation
+        # is still _notify_generation
+        self._notify = []
+        self._notify_all = False
+        self._notify_generation = -1
+
+        # the candles are from a checkpoint or the trade tape, the next
+        # download makes them again from where it begins
+        self.stale = False
+        self.seen_ids = set()  # exchange ids of the trades in the candles
+        self._seen_order = collections.deque()  # to forget the oldest ones
 
         api.signal_trade.connect(self.slot_trade)
         api.signal_fullhistory.connect(self.slot_fullhistory)
 
-    def add_candle(self, candle):
-        """add a new candle to the history"""
-        self._add_candle(candle)
-        self.signal_changed(self, (self.length()))
+    def get_store(self, timeframe):
+        """the CandleStore of this timeframe"""
+        return self.stores[timeframe]
+
+    def get_signal_updated(self, timeframe):
+        """the signal that is emitted like signal_candle_updated but only
+        for this timeframe. A live trade costs a lot less when nobody is
+        connected to signal_candle_updated and the timeframes that are not
+        shown anywhere don't have any slots."""
+        return self._signals_updated[timeframe]
+
+    def last_time(self):
+        """open time of the newest base candle, everything before it is
+        complete in all timeframes. 0 if there are no candles yet"""
+        return self.stores[self.base].last_time()
+
+    def candles_changed(self):
+        """the stores are being changed by something else than a live trade,
+        the next trade must not take the shortcut in _apply_trade()"""
+        self._fast_until = 0
+
+    def add_seen_id(self, trade_id):
+        """remember that the trade with this exchange id is in the candles,
+        Api() calls this for every live trade that has an id"""
+        trade_id = int(trade_id)
+        if trade_id in self.seen_ids:
+            return
+        self.seen_ids.add(trade_id)
+        self._seen_order.append(trade_id)
+        if len(self._seen_order) > self.MAX_SEEN_IDS:
+            self.seen_ids.discard(self._seen_order.popleft())
 
     def slot_trade(self, dummy_sender, data):
         """slot for api.signal_trade"""
         (date, price, volume, dummy_typ, own) = data
         if not own:
-            time_round = int(date / self.timeframe) * self.timeframe
-            candle = self.last_candle()
-            if candle:
-                if candle.tim == time_round:
-                    candle.update(price, volume)
-                    self.signal_changed(self, (1))
-                else:
-                    self.debug("### opening new candle")
-                    self.add_candle(OHLCV(
-                        time_round, price, price, price, price, volume))
-            else:
-                self.add_candle(OHLCV(
-                    time_round, price, price, price, price, volume))
+            self._apply_trade(date, price, volume)
+
+    def _update_notify(self):
+        """find the targets whose candles somebody wants to see"""
+        notify_all = self.signal_candle_updated.has_slots()
+        self._notify = [(timeframe, store, signal)
+                        for (timeframe, store, signal) in self._trade_targets
+                        if signal and (notify_all or signal.has_slots())]
+        self._notify_all = notify_all
+        self._notify_generation = Signal.generation
+
+    def _apply_trade(self, date, price, volume):
+        """update the current candle of every timeframe with this trade"""
+        if self._fast_from <= date < self._fast_until:
+            # almost every trade: it only updates the newest candles, the
+            # same as CandleStore.update_last() without looking them up
+            for (hig, low, cls, vol, pos, other) in self._fast_cells:
+                if price > hig[pos]:
+                    hig[pos] = hig[other] = price
+                if price < low[pos]:
+                    low[pos] = low[other] = price
+                cls[pos] = cls[other] = price
+                vol[pos] = vol[other] = vol[pos] + volume
+            if self._notify_generation != Signal.generation:
+                self._update_notify()
+            for (timeframe, store, signal) in self._notify:
+                data = (timeframe, store[0], False)
+                if self._notify_all:
+                    self.signal_candle_updated(self, data)
+                signal(self, data)
+            return
 
-    def _add_candle(self, candle):
-        """add a new candle to the history but don't fire signal_changed"""
-        self.candles.insert(0, candle)
+        notify_all = self.signal_candle_updated.has_slots()
+        fast_from = 0
+        fast_until = float("inf")
+        for (timeframe, store, signal) in self._trade_targets:
+            time_round = int(date / timeframe) * timeframe
+            last_time = store.last_time()
+            if time_round == last_time and len(store):
+                store.update_last(price, volume)
+                opened = False
+            elif time_round > last_time:
+                if signal and len(store):
+                    self.signal_candle_closed(self, (timeframe, store[0]))
+                store.append(time_round, price, price, price, price, volume)
+                opened = True
+            else:
+                fast_until = 0
+                continue  # late trade for an older candle, ignore it
+            fast_from = max(fast_from, time_round)
+            fast_until = min(fast_until, time_round + timeframe)
+            # the copy of the candle is only made if somebody wants it
+            if signal and (notify_all or signal.has_slots()):
+                data = (timeframe, store[0], opened)
+                if notify_all:
+                    self.signal_candle_updated(self, data)
+                signal(self, data)
+        (self._fast_from, self._fast_until) = (fast_from, fast_until)
+        if fast_until:
+            self._fast_cells = [store.last_cells() for (_, store, _) in self._trade_targets]
 
     def slot_fullhistory(self, dummy_sender, data):
         """process the result of the fullhistory request"""
@@ -553,39 +2162,210 @@ class History(BaseObject):
             self.debug("### history download was empty")
             return
 
-        def get_time_round(date):
-            """round timestamp to current candle timeframe"""
-            return int(date / self.timeframe) * self.timeframe
+        trades = as_trade_columns(history)
+        self.candles_changed()
+        if len(trades.ids):
+            new = [index for (index, trade_id) in enumerate(trades.ids)
+                   if int(trade_id) not in self.seen_ids]
+            for trade_id in trades.ids:
+                self.add_seen_id(trade_id)
+        elif trades.new_only:
+            new = range(len(trades))
+        else:
+            new = None
+
+        last_time = self.last_time()
+        # the unseen trades are really new if the client says so or if the
+        # download overlaps trades we know, but not while the candles are
+        # from a checkpoint or the trade tape (their ids are not known)
+        really_new = new and not self.stale and (trades.new_only or new[0] > 0)
+        if new is not None and not new:
+            pass  # nothing we did not already have
+        elif really_new and last_time and trades.dates[new[0]] >= last_time:
+            for index in new:
+                self._apply_trade(trades.dates[index], trades.prices[index], trades.amounts[index])
+        elif really_new and last_time and \
+                trades.dates[0] > int(trades.dates[new[0]] / self.base) * self.base:
+            # the download (a poll) does not reach back to the start of the
+            # candle of its first unseen trade, the candles can't be made
+            # again from it without losing the trades we already counted
+            late = [index for index in new if trades.dates[index] < last_time]
+            self._roll_up(self._merge_late(trades, late))
+            for index in new[len(late):]:
+                self._apply_trade(trades.dates[index], trades.prices[index], trades.amounts[index])
+        else:
+            date_from = trades.dates[new[0] if new else 0]
+            date_begin = int(date_from / self.base) * self.base
+            if date_begin < trades.dates[0] and date_begin <= last_time:
+                # the download begins in the middle of a candle we have,
+                # keep that one, it has the trades before the download
+                date_from = date_begin + self.base
+            self._roll_up(self._aggregate(trades, date_from))
+            self.stale = False
+        self.signal_fullhistory_processed(self, None)
+
+    def _aggregate(self, trades, date_from):
+        """replace the base candles from the one containing date_from
+        onwards with candles made from the downloaded trades (TradeColumns),
+        return the open time of the first of them"""
+        step = self.base
+        store = self.stores[step]
 
         # remove existing recent candle(s) if any, we will create them fresh
-        date_begin = get_time_round(history[0]["date"])
-        while len(self.candles) and self.candles[0].tim >= date_begin:
-            self.candles.pop(0)
-
-        new_candle = OHLCV(0, 0, 0, 0, 0, 0)  # this is a dummy, not actually inserted
-        count_added = 0
-        for trade in history:
-            date = trade["date"]
-            price = trade["price"]
-            volume = trade["amount"]
-            time_round = get_time_round(date)
-            if time_round > new_candle.tim:
-                if new_candle.tim > 0:
-                    self._add_candle(new_candle)
-                    count_added += 1
-                new_candle = OHLCV(time_round, price, price, price, price, volume)
-            new_candle.update(price, volume)
-
-        # insert current (incomplete) candle
-        self._add_candle(new_candle)
-        count_added += 1
-        # self.debug("### got %d updated candle(s)" % count_added)
+        date_begin = int(date_from / step) * step
+        while len(store) and store.last_time() >= date_begin:
+            store.pop()
+
+        start = bisect.bisect_left(trades.dates, date_begin)
+        prices = trades.prices[start:]
+        self._group(store, step, trades.dates[start:], prices, prices,
+                    prices, prices, trades.amounts[start:])
+        return date_begin
+
+    def _merge_late(self, trades, late):
+        """add the trades at these indexes (sorted, all older than the
+        newest base candle) to the base candles they belong to, candles
+        that did not exist yet are made from them. The open and close of
+        existing candles are kept, the order of the trades in them is not
+        known. Return the open time of the first changed candle"""
+        step = self.base
+        store = self.stores[step]
+        date_begin = int(trades.dates[late[0]] / step) * step
+
+        # take the candles from date_begin on off the store, oldest first
+        candles = {}
+        while len(store) and store.last_time() >= date_begin:
+            candle = store[0]
+            candles[candle.tim] = candle
+            store.pop()
+
+        made = set()
+        for index in late:
+            price = trades.prices[index]
+            volume = trades.amounts[index]
+            time_round = int(trades.dates[index] / step) * step
+            candle = candles.get(time_round)
+            if candle is None:
+                candles[time_round] = OHLCV(time_round, price, price, price, price, volume)
+                made.add(time_round)
+            elif time_round in made:
+                candle.update(price, volume)
+            else:
+                candle.hig = max(candle.hig, price)
+                candle.low = min(candle.low, price)
+                candle.vol += volume
+
+        for tim in sorted(candles):
+            candle = candles[tim]
+            store.append(tim, candle.opn, candle.hig, candle.low, candle.cls, candle.vol)
+        return date_begin
+
+    def _roll_up(self, date_begin):
+        """make the candles of all other timeframes that begin at or after
+        the candle containing date_begin again from the base candles"""
+        base = self.stores[self.base]
+        for timeframe in self.timeframes:
+            if timeframe == self.base:
+                continue
+            store = self.stores[timeframe]
+            begin = int(date_begin / timeframe) * timeframe
+            while len(store) and store.last_time() >= begin:
+                store.pop()
+            # only the base candles from begin on, as arrays
+            start = bisect.bisect_left(base.column("tim"), begin)
+            count = len(base) - start
+            if count:
+                self._group(store, timeframe, *[base.column(field, count).to_array()
+                                                for field in CandleStore.FIELDS])
+
+    def _group(self, store, timeframe, tims, opns, higs, lows, clss, vols):
+        """append candles of timeframe to the store, grouped from rows of
+        the arrays (sorted by tim). These rows can be trades (then opns,
+        higs, lows and clss are all the prices) or shorter candles. Every
+        group is one slice of the arrays found by bisect, so max(), min()
+        and sum() do the per row work in C, Python only loops per candle."""
+        start = 0
+        count = len(tims)
+        while start < count:
+            time_round = int(tims[start] / timeframe) * timeframe
+            end = max(bisect.bisect_left(tims, time_round + timeframe, start), start + 1)
+            store.append(time_round, opns[start], max(higs[start:end]),
+                         min(lows[start:end]), clss[end - 1], sum(vols[start:end]))
+            start = end
+
+    def load_candles(self, timeframe, columns):
+        """fill the store of this timeframe from a checkpoint, see
+        CandleStore.load()"""
+        self.candles_changed()
+        self.stores[timeframe].load(columns)
+        self.stale = True
+
+
+class History(BaseObject):
+    """represents the trading history in one timeframe. The candles are made
+    by a CandleEngine (shared with other timeframes), if none is given then
+    it creates its own one that has only this timeframe"""
+
+    def __init__(self, api, timeframe, retention=10000, engine=None):
+        BaseObject.__init__(self)
+
+        self.signal_fullhistory_processed = Signal(api.lock)
+        self.signal_changed = Signal(api.lock)
+
+        if engine is None:
+            engine = CandleEngine(api, [timeframe], retention)
+
+        self.api = api
+        self.engine = engine
+        self.candles = engine.get_store(timeframe)  # newest first
+        self.timeframe = timeframe
+
+        self.ready_history = False
+        self.stale = False  # candles are from a checkpoint, not downloaded yet
+
+        engine.get_signal_updated(timeframe).connect(self.slot_candle_updated)
+        engine.signal_fullhistory_processed.connect(self.slot_fullhistory_processed)
+
+    def add_candle(self, candle):
+        """add a new candle to the history"""
+        self._add_candle(candle)
+        self.signal_changed(self, (self.length()))
+
+    def slot_candle_updated(self, dummy_sender, data):
+        """slot for the engine's signal_updated of this timeframe"""
+        (dummy_timeframe, dummy_candle, opened) = data
+        if opened:
+            if self.length() > 1:
+                self.debug("### opening new candle")
+            self.signal_changed(self, (self.length()))
+        else:
+            self.signal_changed(self, (1))
+
+    def _add_candle(self, candle):
+        """add a new candle to the history but don't fire signal_changed"""
+        self.engine.candles_changed()
+        self.candles.append(candle.tim, candle.opn, candle.hig, candle.low, candle.cls, candle.vol)
+
+    def slot_fullhistory_processed(self, dummy_sender, dummy_data):
+        """slot for engine.signal_fullhistory_processed, the candles have
+        been updated with the downloaded trades"""
+        self.ready_history = True
+        self.stale = False
+        self.signal_fullhistory_processed(self, None)
+        self.signal_changed(self, (self.length()))
+
+    def load_candles(self, columns):
+        """use these candles from a checkpoint (see CandleStore.load()) until
+        the history has been downloaded, the download will then replace the
+        most recent of them"""
+        self.engine.load_candles(self.timeframe, columns)
         self.ready_history = True
+        self.stale = True
         self.signal_fullhistory_processed(self, None)
         self.signal_changed(self, (self.length()))
 
     def last_candle(self):
-        """return the last (current) candle or None if empty"""
+        """return (a copy of) the last (current) candle or None if empty"""
         if self.length() > 0:
             return self.candles[0]
         else:
@@ -596,6 +2376,482 @@ class History(BaseObject):
         return len(self.candles)
 
 
+class Checkpoint():
+    """a snapshot of the order book and the candles of all timeframes in a
+    compact binary file. The file is a fixed size header followed by plain
+    arrays of doubles (little endian), so it can be memory mapped and every
+    array is read with a single copy. It is written to a temporary file
+    first and then renamed, so there is always either the old or the new
+    file."""
+
+    MAGIC = "PTCP"
+    VERSION = 3
+    # magic, version, time saved, base, quote, price decimals,
+    # volume decimals, number of bids, asks, timeframes
+    HEADER = struct.Struct("<4sId8s8sIIIII")
+    # in front of the candles of each timeframe: timeframe, candles
+    HEADER_CANDLES = struct.Struct("<II")
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.time = 0
+        self.curr_base = ""
+        self.curr_quote = ""
+        self.price_decimals = 0
+        self.volume_decimals = 0
+        self.bids = (array.array("d"), array.array("d"))  # (prices, volumes)
+        self.asks = (array.array("d"), array.array("d"))
+        self.candles = {}  # timeframe -> list of columns, oldest first
+
+    def take(self, api):
+        """copy the current state of the api's book and candles, this must
+        be called with api.lock held (it only copies, it does not write)"""
+        def levels(side):
+            """(prices, volumes) of the levels with public volume"""
+            pairs = [(price, volume) for (price, volume)
+                     in itertools.izip(side.prices, side.volumes) if volume]
+            return (array.array("d", [price for (price, _) in pairs]),
+                    array.array("d", [volume for (_, volume) in pairs]))
+
+        book = api.orderbook
+        self.time = time.time()
+        self.curr_base = api.curr_base
+        self.curr_quote = api.curr_quote
+        self.price_decimals = api.fixed.price_decimals
+        self.volume_decimals = api.fixed.volume_decimals
+        self.bids = levels(book.bids)
+        self.asks = levels(book.asks)
+        self.candles = {}
+        for (timeframe, store) in api.history.engine.stores.items():
+            self.candles[timeframe] = [store.column(field).to_array()
+                                       for field in CandleStore.FIELDS]
+
+    def count_candles(self):
+        """number of candles of all timeframes"""
+        return sum(len(columns[0]) for columns in self.candles.values())
+
+    def save(self):
+        """write it to the file"""
+        def write(arr):
+            """write the array little endian"""
+            if sys.byteorder == "big":
+                arr = array.array("d", arr)
+                arr.byteswap()
+            arr.tofile(file)
+
+        tmpname = self.filename + ".tmp"
+        with open(tmpname, "wb") as file:
+            file.write(self.HEADER.pack(
+                self.MAGIC, self.VERSION, self.time,
+                self.curr_base, self.curr_quote,
+                self.price_decimals, self.volume_decimals,
+                len(self.bids[0]), len(self.asks[0]), len(self.candles)))
+            for arr in list(self.bids) + list(self.asks):
+                write(arr)
+            for (timeframe, columns) in sorted(self.candles.items()):
+                file.write(self.HEADER_CANDLES.pack(timeframe, len(columns[0])))
+                for arr in columns:
+                    write(arr)
+        if os.name == "nt" and os.path.exists(self.filename):
+            os.remove(self.filename)
+        os.rename(tmpname, self.filename)
+
+    def load(self):
+        """read the file, return False if there is no usable checkpoint"""
+        try:
+            with open(self.filename, "rb") as file:
+                data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, ValueError, EnvironmentError):
+            return False
+
+        def read(pos, count):
+            """read count doubles at pos"""
+            arr = array.array("d")
+            arr.fromstring(data[pos:pos + 8 * count])
+            if sys.byteorder == "big":
+                arr.byteswap()
+            return arr
+
+        try:
+            size = self.HEADER.size
+            if len(data) < size:
+                return False
+            (magic, version, self.time, curr_base, curr_quote,
+             self.price_decimals, self.volume_decimals,
+             count_bids, count_asks, count_timeframes) = self.HEADER.unpack(data[:size])
+            if magic != self.MAGIC or version != self.VERSION:
+                return False
+            self.curr_base = curr_base.rstrip("\0")
+            self.curr_quote = curr_quote.rstrip("\0")
+            pos = size + 16 * (count_bids + count_asks)
+            if len(data) < pos:
+                return False
+            start = size + 16 * count_bids
+            self.bids = (read(size, count_bids), read(size + 8 * count_bids, count_bids))
+            self.asks = (read(start, count_asks), read(start + 8 * count_asks, count_asks))
+            self.candles = {}
+            for _ in range(count_timeframes):
+                if len(data) < pos + self.HEADER_CANDLES.size:
+                    return False
+                (timeframe, count) = self.HEADER_CANDLES.unpack(
+                    data[pos:pos + self.HEADER_CANDLES.size])
+                pos += self.HEADER_CANDLES.size
+                if len(data) < pos + 48 * count:
+                    return False
+                self.candles[timeframe] = [read(pos + 8 * count * i, count)
+                                           for i in range(len(CandleStore.FIELDS))]
+                pos += 48 * count
+            return pos == len(data)
+        finally:
+            data.close()
+
+
+class TradeTape(BaseObject):
+    """an append-only file with all downloaded trades of one pair, so they
+    are still there after a restart (to make candles without downloading
+    anything, or for other programs). After a small header it has records
+    of five little endian doubles (date, price, amount, side, id), ordered
+    by date, side is 1 for buy and -1 for sell, side and id are 0 if the
+    exchange does not send them. The records are written by a background
+    thread, slot_fullhistory() only queues the trades. Trades that are
+    already on the tape (an id that is not higher, or if there are no ids
+    a date that is older than the last one or the trades of the last
+    second that are on the tape already) are not written again. With
+    retention (seconds) the trades that are older than that are cut off
+    now and then, by copying the newer ones to a new file. Read it with a
+    TapeView. Live trades are not written, they have no id and would be
+    written a second time by the next history download (which has them
+    all on the supported exchanges)."""
+
+    MAGIC = "PTTP"
+    VERSION = 1
+    HEADER = struct.Struct("<4sI8s8s")  # magic, version, base, quote
+    RECORD = struct.Struct("<ddddd")  # date, price, amount, side, id
+
+    def __init__(self, filename, curr_base, curr_quote, retention=0):
+        BaseObject.__init__(self)
+        self.filename = filename
+        self.curr_base = curr_base
+        self.curr_quote = curr_quote
+        self.retention = retention  # seconds, 0 keeps everything
+        self.first_date = 0
+        self.last_date = 0
+        self.last_id = 0
+        self.last_second = []  # (price, amount) of the trades at last_date
+        self.count_written = 0
+        self._file = None
+        self._items = collections.deque()
+        self._cond = threading.Condition(threading.Lock())
+        self._thread = None
+
+    def start(self):
+        """open the file (create it if needed) and start the writer thread"""
+        if self._open():
+            self._thread = start_thread(self._thread_func, "trade tape writer")
+
+    def stop(self):
+        """write everything that is still queued and stop the writer thread"""
+        if self._thread:
+            with self._cond:
+                self._items.append(None)
+                self._cond.notify()
+            self._thread.join(10)
+            self._thread = None
+
+    def slot_fullhistory(self, dummy_sender, data):
+        """slot for api.signal_fullhistory, queue the trades for writing"""
+        trades = as_trade_columns(data)
+        if len(trades):
+            with self._cond:
+                self._items.append(trades)
+                self._cond.notify()
+
+    def _open(self):
+        """open the file for appending, write the header if it is new and
+        cut off an incomplete record at the end (from a crash)"""
+        header = self.HEADER.pack(self.MAGIC, self.VERSION, self.curr_base, self.curr_quote)
+        try:
+            if not os.path.exists(self.filename):
+                with open(self.filename, "wb") as file:
+                    file.write(header)
+            self._file = open(self.filename, "r+b")
+            if self._file.read(self.HEADER.size) != header:
+                self.debug("### %s is not a trade tape of %s%s, not using it" % (
+                    self.filename, self.curr_base, self.curr_quote))
+                self._file.close()
+                self._file = None
+                return False
+            self._file.seek(0, os.SEEK_END)
+            size = self._file.tell()
+            count = (size - self.HEADER.size) // self.RECORD.size
+            end = self.HEADER.size + count * self.RECORD.size
+            if end != size:
+                self._file.truncate(end)
+            if count:
+                self.first_date = self._read_record(0)[0]
+                (self.last_date, _, _, _, self.last_id) = self._read_record(count - 1)
+                index = count - 1
+                while index >= 0:
+                    (date, price, amount, _, _) = self._read_record(index)
+                    if date != self.last_date:
+                        break
+                    self.last_second.insert(0, (price, amount))
+                    index -= 1
+            self._file.seek(end)
+            self._trim()
+            return True
+        except EnvironmentError as exc:
+            self.debug("### could not open trade tape:", exc)
+            self._file = None
+            return False
+
+    def _thread_func(self):
+        """writer thread, runs until stop()"""
+        while True:
+            with self._cond:
+                while not self._items:
+                    self._cond.wait()
+                trades = self._items.popleft()
+            if trades is None:
+                break
+            try:
+                self._write(trades)
+            except EnvironmentError as exc:
+                self.debug("### could not write trade tape:", exc)
+        self._file.close()
+        self._file = None
+
+    def _read_record(self, index):
+        """the record at index (date, price, amount, side, id)"""
+        self._file.seek(self.HEADER.size + index * self.RECORD.size)
+        return self.RECORD.unpack(self._file.read(self.RECORD.size))
+
+    def _find_new(self, trades):
+        """index of the first trade that is not on the tape yet. Without
+        ids the trades of the last second on the tape are compared with
+        those of the same second in trades: the longest run at its start
+        that is also at the end of the tape is skipped, the rest of that
+        second is new (trades with the same date can arrive in more than
+        one download)."""
+        if len(trades.ids):
+            return bisect.bisect_right(trades.ids, self.last_id)
+        start = bisect.bisect_left(trades.dates, self.last_date)
+        end = bisect.bisect_right(trades.dates, self.last_date)
+        if start == end:
+            return start
+        same = zip(trades.prices[start:end], trades.amounts[start:end])
+        for skip in range(min(len(same), len(self.last_second)), 0, -1):
+            if same[:skip] == self.last_second[-skip:]:
+                return start + skip
+        return start
+
+    def _write(self, trades):
+        """append the trades (TradeColumns) that are not yet on the tape,
+        the columns are interleaved into records with slice assignments"""
+        start = self._find_new(trades)
+        count = len(trades) - start
+        if count <= 0:
+            return
+        zeros = array.array("d", [0]) * count
+        records = array.array("d", [0]) * (5 * count)
+        records[0::5] = trades.dates[start:]
+        records[1::5] = trades.prices[start:]
+        records[2::5] = trades.amounts[start:]
+        records[3::5] = trades.sides[start:] if len(trades.sides) else zeros
+        records[4::5] = trades.ids[start:] if len(trades.ids) else zeros
+        if sys.byteorder == "big":
+            records.byteswap()
+        records.tofile(self._file)
+        self._file.flush()
+        if not self.first_date:
+            self.first_date = trades.dates[start]
+        if trades.dates[-1] != self.last_date:
+            self.last_second = []
+        self.last_date = trades.dates[-1]
+        begin = max(start, bisect.bisect_left(trades.dates, self.last_date))
+        self.last_second += zip(trades.prices[begin:], trades.amounts[begin:])
+        if len(trades.ids):
+            self.last_id = trades.ids[-1]
+        self.count_written += count
+        self._trim()
+
+    def _trim(self):
+        """cut off the trades that are older than retention seconds before
+        the last one. The rest is copied to a new file that replaces the
+        old one, this is only done when at least a quarter of the
+        retention can be cut off, not after every write."""
+        if not self.retention or self.first_date >= self.last_date - self.retention * 1.25:
+            return
+        view = TapeView(self.filename)
+        try:
+            start = view.find(self.last_date - self.retention)
+            self.first_date = view.date(start)
+        finally:
+            view.close()
+        self._file.seek(self.HEADER.size + start * self.RECORD.size)
+        rest = self._file.read()
+        self._file.seek(0)
+        header = self._file.read(self.HEADER.size)
+        tmpname = self.filename + ".tmp"
+        with open(tmpname, "wb") as file:
+            file.write(header)
+            file.write(rest)
+        self._file.close()
+        if os.name == "nt":
+            os.remove(self.filename)
+        os.rename(tmpname, self.filename)
+        self._file = open(self.filename, "r+b")
+        self._file.seek(0, os.SEEK_END)
+        self.debug("### trade tape: removed %i trades older than %i s" % (start, self.retention))
+
+class TapeView():
+    """read only access to a trade tape file through mmap. Nothing is read
+    up front, a record is unpacked straight from the mapping when it is
+    accessed, so opening a large tape takes no time. The tape is ordered
+    by date, find() is a binary search over the records. The view shows
+    the records that were complete when it was opened."""
+
+    def __init__(self, filename):
+        self._data = None
+        self._count = 0
+        with open(filename, "rb") as file:
+            size = os.fstat(file.fileno()).st_size
+            if size > TradeTape.HEADER.size:
+                self._data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._data:
+            (magic, version, _, _) = TradeTape.HEADER.unpack_from(self._data)
+            if magic == TradeTape.MAGIC and version == TradeTape.VERSION:
+                self._count = (size - TradeTape.HEADER.size) // TradeTape.RECORD.size
+
+    def close(self):
+        """unmap the file"""
+        if self._data:
+            self._data.close()
+            self._data = None
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, index):
+        """the record (date, price, amount, side, id)"""
+        if index < 0:
+            index += self._count
+        if index < 0 or index >= self._count:
+            raise IndexError("trade tape index out of range")
+        return TradeTape.RECORD.unpack_from(
+            self._data, TradeTape.HEADER.size + index * TradeTape.RECORD.size)
+
+    def date(self, index):
+        """the date of the record at index"""
+        return struct.unpack_from(
+            "<d", self._data, TradeTape.HEADER.size + index * TradeTape.RECORD.size)[0]
+
+    def find(self, date):
+        """index of the first record that is not older than date"""
+        low = 0
+        high = self._count
+        while low < high:
+            mid = (low + high) // 2
+            if self.date(mid) < date:
+                low = mid + 1
+            else:
+                high = mid
+        return low
+
+    def get_trades(self, time_begin=0, time_end=None):
+        """TradeColumns with the trades from time_begin (inclusive) to
+        time_end (exclusive, None for all), ids and sides are only filled
+        if the exchange had sent them"""
+        start = self.find(time_begin)
+        end = self._count if time_end is None else self.find(time_end)
+        if end <= start:
+            return TradeColumns()
+        pos = TradeTape.HEADER.size + start * TradeTape.RECORD.size
+        records = array.array("d")
+        records.fromstring(self._data[pos:pos + (end - start) * TradeTape.RECORD.size])
+        if sys.byteorder == "big":
+            records.byteswap()
+        ids = records[4::5]
+        sides = records[3::5]
+        return TradeColumns(records[0::5], records[1::5], records[2::5],
+                            ids if any(ids) else (), sides=sides if any(sides) else ())
+
+
+class FeedRecorder():
+    """writes everything the exchange client sends to the Api (signal_recv,
+    signal_fulldepth, signal_fullhistory, signal_ticker and the connected
+    and disconnected signals) with the time it arrived into a gzip
+    compressed file. The first line is a JSON header, then every event is
+    one line [time, name, data]. The "replay" exchange (exchanges/replay.py)
+    plays such a recording back."""
+
+    VERSION = 1
+    NAMES = ["recv", "fulldepth", "fullhistory", "ticker", "connected", "disconnected"]
+
+    def __init__(self, filename, client, exchange):
+        self.filename = filename
+        self.count_events = 0
+        self._lock = threading.Lock()
+        self._time_flushed = time.time()
+        self._file = gzip.open(filename, "wb")
+        self._file.write(json.dumps({
+            "version": self.VERSION,
+            "exchange": exchange,
+            "curr_base": client.curr_base,
+            "curr_quote": client.curr_quote,
+            "price_decimals": client.fixed.price_decimals,
+            "volume_decimals": client.fixed.volume_decimals,
+            "time": time.time()}) + "\n")
+        for name in self.NAMES:
+            getattr(client, "signal_" + name).connect(getattr(self, "slot_" + name))
+
+    def close(self):
+        """finish the file, nothing is recorded anymore after this"""
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+
+    def write(self, name, data):
+        """append one event, the file is flushed once per second"""
+        line = json.dumps([time.time(), name, data]) + "\n"
+        with self._lock:
+            if not self._file:
+                return
+            self._file.write(line)
+            self.count_events += 1
+            if time.time() - self._time_flushed > 1:
+                self._file.flush()
+                self._time_flushed = time.time()
+
+    def slot_recv(self, _sender, data):
+        """the raw json messages (or dicts)"""
+        self.write("recv", data)
+
+    def slot_fulldepth(self, _sender, data):
+        """full depth dicts"""
+        self.write("fulldepth", data)
+
+    def slot_fullhistory(self, _sender, data):
+        """TradeColumns (or a list of trade dicts)"""
+        if isinstance(data, TradeColumns):
+            data = {"trades": data.to_dict()}
+        self.write("fullhistory", data)
+
+    def slot_ticker(self, _sender, data):
+        """(bid, ask)"""
+        self.write("ticker", data)
+
+    def slot_connected(self, _sender, _data):
+        """connected"""
+        self.write("connected", None)
+
+    def slot_disconnected(self, _sender, _data):
+        """disconnected"""
+        self.write("disconnected", None)
+
+
 class Api(BaseObject):
     """represents the API of the exchange. An Instance of this
     class will connect to the streaming socket.io API, receive live
@@ -606,25 +2862,35 @@ class Api(BaseObject):
         """initialize the API but do not yet connect to it."""
         BaseObject.__init__(self)
 
-        self.signal_depth = Signal()
-        self.signal_trade = Signal()
-        self.signal_ticker = Signal()
-        self.signal_fulldepth = Signal()
-        self.signal_fullhistory = Signal()
-        self.signal_wallet = Signal()
-        self.signal_userorder = Signal()
-        self.signal_orderlag = Signal()
-        self.signal_disconnected = Signal()  # socket connection lost
-        self.signal_ready = Signal()  # connected and fully initialized
-
-        self.signal_order_too_fast = Signal()  # don't use that
+        # all signals of this instance (and of its orderbook and history)
+        # share this lock, so all market events are processed in order. A
+        # backtest does everything in one thread (its timers are driven by
+        # the simulated time, see SimulatedScheduler), it needs no locking.
+        if config.get_string("pytrader", "exchange") == "backtest":
+            self.lock = NoLock()
+        else:
+            self.lock = threading.RLock()
+        Signal.add_lock_owner(self)
+
+        self.signal_depth = Signal(self.lock)
+        self.signal_trade = Signal(self.lock)
+        self.signal_ticker = Signal(self.lock)
+        self.signal_fulldepth = Signal(self.lock)
+        self.signal_fullhistory = Signal(self.lock)
+        self.signal_wallet = Signal(self.lock)
+        self.signal_userorder = Signal(self.lock)
+        self.signal_orderlag = Signal(self.lock)
+        self.signal_disconnected = Signal(self.lock)  # socket connection lost
+        self.signal_ready = Signal(self.lock)  # connected and fully initialized
+
+        self.signal_order_too_fast = Signal(self.lock)  # don't use that
 
         self.strategies = weakref.WeakValueDictionary()
 
         # the following are not fired by the api itself but by the
         # application controlling it to pass some of its events
-        self.signal_keypress = Signal()
-        self.signal_strategy_unload = Signal()
+        self.signal_keypress = Signal(self.lock)
+        self.signal_strategy_unload = Signal(self.lock)
 
         # self._idkey = ""
         self.wallet = {}
@@ -635,6 +2901,7 @@ class Api(BaseObject):
         self.last_tid = 0
         self.count_submitted = 0  # number of submitted orders not yet acked
         self.msg = {}  # the incoming message that is currently processed
+        self._op_handlers = {}  # op -> _on_op_xxx function, see slot_recv()
 
         # the following will be set to true once the information
         # has been received after connect, once all thes flags are
@@ -651,22 +2918,16 @@ class Api(BaseObject):
 
         self.exchange = config.get_string("pytrader", "exchange")
 
-        # these are needed for conversion from/to intereger, float, string
-        self.mult_quote = 1e5
-        self.format_quote = "%12.5f"
-        self.mult_base = 1e8
-        self.format_base = "%16.8f"
-
         Signal.signal_error.connect(self.signal_debug)
+        if config.get_bool("api", "signal_stats"):
+            Signal.enable_stats(True)
 
-        timeframe = 60 * config.get_int("api", "history_timeframe")
-        if not timeframe:
-            timeframe = 60 * 15
-        self.history = History(self, timeframe)
-        self.history.signal_debug.connect(self.signal_debug)
-
-        self.orderbook = OrderBook(self)
-        self.orderbook.signal_debug.connect(self.signal_debug)
+        HTTP_POOL.configure(
+            config.get_int("api", "http_pool_size"),
+            config.get_int("api", "http_idle_timeout"))
+        FETCH_POOL.configure(
+            config.get_int("api", "fetch_threads"),
+            config.get_int("api", "fetch_queue_size"))
 
         use_websocket = self.config.get_bool("api", "use_plain_old_websocket")
 
@@ -688,9 +2949,52 @@ class Api(BaseObject):
         elif self.exchange == "poloniex":
             from exchanges.poloniex import WebsocketClient
             self.client = WebsocketClient(self.curr_base, self.curr_quote, secret, config)
+        elif self.exchange == "replay":
+            from exchanges.replay import ReplayClient
+            self.client = ReplayClient(self.curr_base, self.curr_quote, secret, config)
+        elif self.exchange == "backtest":
+            from exchanges.backtest import BacktestClient
+            self.client = BacktestClient(self.curr_base, self.curr_quote, secret, config)
         else:
             raise Exception("Unsupported exchange")
 
+        # optionally record everything the client sends, for replaying it
+        self.recorder = None
+        if config.get_string("api", "record_feed"):
+            self.recorder = FeedRecorder(
+                config.get_string("api", "record_feed"), self.client, self.exchange)
+
+        # the exchange client knows the precision of the traded pair, the
+        # book uses it for its integer ticks (see FixedPoint)
+        self.fixed = self.client.fixed
+
+        # these are needed for conversion from/to intereger, float, string.
+        # The multipliers of these public helpers stay fixed whatever the
+        # pair's precision is, strategies (buy.py, sell.py) and their saved
+        # values depend on them. Only the display uses the pair's decimals.
+        self.mult_quote = 1e5
+        self.format_quote = "%%12.%if" % self.fixed.price_decimals
+        self.mult_base = 1e8
+        self.format_base = "%%16.%if" % self.fixed.volume_decimals
+
+        timeframe = 60 * config.get_int("api", "history_timeframe")
+        if not timeframe:
+            timeframe = 60 * 15
+        timeframes = [timeframe] + [60 * int(minutes) for minutes in
+                                    config.get_string("api", "history_timeframes").split(",")
+                                    if minutes.strip() and int(minutes) > 0]
+        retention = config.get_int("api", "history_retention")
+        self.candle_engine = CandleEngine(self, timeframes, retention)
+        self.candle_engine.signal_debug.connect(self.signal_debug)
+        self.history = History(self, timeframe, retention, self.candle_engine)
+        self.history.signal_debug.connect(self.signal_debug)
+
+        self.orderbook = OrderBook(self)
+        self.orderbook.signal_debug.connect(self.signal_debug)
+        if self.exchange == "backtest":
+            # the simulated exchange fills marketable orders from this book
+            self.client.orderbook = self.orderbook
+
         self.client.signal_debug.connect(self.signal_debug)
         self.client.signal_disconnected.connect(self.slot_disconnected)
         self.client.signal_connected.connect(self.slot_client_connected)
@@ -699,9 +3003,54 @@ class Api(BaseObject):
         self.client.signal_fullhistory.connect(self.signal_fullhistory)
         self.client.signal_ticker.connect(self.signal_ticker)
 
+        # optionally decouple the client threads from all the consumers,
+        # everything coming from the client is queued in one ordered queue
+        self.dispatcher = None
+        queue_size = config.get_int("api", "dispatch_queue_size")
+        if queue_size > 0:
+            self.dispatcher = Dispatcher(
+                queue_size,
+                config.get_int("api", "dispatch_threads"),
+                config.get_string("api", "dispatch_overflow"))
+            # only a ticker may be dropped or coalesced on overflow, the
+            # next one replaces it. Losing any other message would corrupt
+            # book, history or orders.
+            for signal in [self.client.signal_recv,
+                           self.client.signal_fulldepth,
+                           self.client.signal_fullhistory,
+                           self.client.signal_ticker,
+                           self.client.signal_connected,
+                           self.client.signal_disconnected]:
+                signal.set_dispatcher(self.dispatcher, self.lock,
+                                      signal is self.client.signal_ticker)
+
         self.timer_poll = Timer(120)
         self.timer_poll.connect(self.slot_poll)
 
+        # book and history are written to this file regularly and
+        # loaded again at start, so they are available immediately
+        self.checkpoint_file = "%s.%s%s.checkpoint" % (
+            os.path.splitext(config.filename)[0], self.curr_base, self.curr_quote)
+        # a replay always starts from scratch and must not touch them
+        replaying = self.exchange in ("replay", "backtest")
+        self.timer_checkpoint = None
+        self._checkpoint_thread = None
+        interval = config.get_int("api", "checkpoint_interval")
+        if interval > 0 and not replaying:
+            self.timer_checkpoint = Timer(interval)
+            self.timer_checkpoint.connect(self.slot_checkpoint)
+
+        # all downloaded trades are appended to this file, the candles are
+        # made from it at start if there is no checkpoint
+        self.trade_tape = None
+        if config.get_bool("api", "trade_tape") and not replaying:
+            self.trade_tape = TradeTape("%s.%s%s.tape" % (
+                os.path.splitext(config.filename)[0], self.curr_base, self.curr_quote),
+                self.curr_base, self.curr_quote,
+                config.get_int("api", "trade_tape_retention"))
+            self.trade_tape.signal_debug.connect(self.signal_debug)
+            self.signal_fullhistory.connect(self.trade_tape.slot_fullhistory)
+
         self.history.signal_changed.connect(self.slot_history_changed)
         self.history.signal_fullhistory_processed.connect(self.slot_fullhistory_processed)
         self.orderbook.signal_fulldepth_processed.connect(self.slot_fulldepth_processed)
@@ -710,12 +3059,160 @@ class Api(BaseObject):
     def start(self):
         """connect to API and start receiving events."""
         self.debug("### Starting API, trading %s%s" % (self.curr_base, self.curr_quote))
+        if self.timer_checkpoint:
+            self.load_checkpoint()
+        if self.trade_tape:
+            self.load_trade_tape()
+            self.trade_tape.start()
         self.client.start()
 
     def stop(self):
         """shutdown the client"""
         self.debug("### shutdown...")
         self.client.stop()
+        if self.dispatcher:
+            self.dispatcher.stop()
+        if self.timer_checkpoint:
+            self.timer_checkpoint.cancel()
+            self.save_checkpoint()
+        if self.trade_tape:
+            self.trade_tape.stop()
+        if self.recorder:
+            self.recorder.close()
+        # the timers and delayed calls of all objects end here, their
+        # threads would otherwise still run while the interpreter exits
+        Scheduler.get().stop()
+        DeliveryThread.get().stop()
+
+    def load_checkpoint(self):
+        """load book and history from the checkpoint file (if there is one)
+        so they are available right after start. They are marked as stale
+        until the downloads have updated them, the history download only
+        needs to fetch what is newer than the last candle. A book that is
+        older than checkpoint_max_age is not used."""
+        time_start = time.time()
+        checkpoint = Checkpoint(self.checkpoint_file)
+        if not checkpoint.load():
+            return False
+        if (checkpoint.curr_base, checkpoint.curr_quote) != (self.curr_base, self.curr_quote):
+            return False
+        age = time.time() - checkpoint.time
+        engine = self.candle_engine
+        with self.lock:
+            if (sorted(checkpoint.candles) == sorted(engine.stores)
+                    and checkpoint.count_candles() and not engine.last_time()):
+                for (timeframe, columns) in checkpoint.candles.items():
+                    if timeframe != self.history.timeframe:
+                        engine.load_candles(timeframe, columns)
+                self.history.load_candles(checkpoint.candles[self.history.timeframe])
+            max_age = self.config.get_int("api", "checkpoint_max_age")
+            book = self.orderbook
+            if age < max_age and not len(book.bids) and not len(book.asks):
+                book.load_levels(checkpoint.bids, checkpoint.asks)
+        self.debug("### loaded checkpoint (%i s old, %i candles, %i levels) in %0.3f s" % (
+            age, checkpoint.count_candles(),
+            len(checkpoint.bids[0]) + len(checkpoint.asks[0]),
+            time.time() - time_start))
+        return True
+
+    def load_trade_tape(self):
+        """make the candles from the trades on the trade tape (the last
+        trade_tape_warmup seconds) if there are none yet, for example
+        because there was no checkpoint. They are stale until the history
+        has been downloaded, which then only needs to fetch what is newer."""
+        if self.candle_engine.last_time() or not os.path.exists(self.trade_tape.filename):
+            return False
+        time_start = time.time()
+        try:
+            view = TapeView(self.trade_tape.filename)
+        except EnvironmentError as exc:
+            self.debug("### could not read trade tape:", exc)
+            return False
+        try:
+            warmup = self.config.get_int("api", "trade_tape_warmup")
+            trades = view.get_trades(time.time() - warmup)
+        finally:
+            view.close()
+        if not len(trades):
+            return False
+        with self.lock:
+            self.candle_engine.slot_fullhistory(self, trades)
+            self.candle_engine.stale = True
+            self.history.stale = True
+        self.debug("### made %i candles from %i trades of the trade tape in %0.3f s" % (
+            self.history.length(), len(trades), time.time() - time_start))
+        return True
+
+    def save_checkpoint(self, background=False):
+        """write book and history to the checkpoint file. Nothing is
+        written while they are still stale (they would be in the file
+        already) or when there is nothing to write yet. Only the copy is
+        made with the lock held, with background=True the file is written
+        by a separate thread (and nothing is done while the previous one
+        is still writing)."""
+        if self._checkpoint_thread and self._checkpoint_thread.is_alive():
+            if background:
+                return False
+            self._checkpoint_thread.join()
+        checkpoint = Checkpoint(self.checkpoint_file)
+        with self.lock:
+            if self.orderbook.stale or self.history.stale:
+                return False
+            if not (self.orderbook.ready_depth or self.history.ready_history):
+                return False
+            checkpoint.take(self)
+        if background:
+            self._checkpoint_thread = start_thread(
+                lambda: self._write_checkpoint(checkpoint), "checkpoint writer")
+            return True
+        return self._write_checkpoint(checkpoint)
+
+    def _write_checkpoint(self, checkpoint):
+        """write the file of a Checkpoint that has been taken already"""
+        try:
+            checkpoint.save()
+            return True
+        except EnvironmentError as exc:
+            self.debug("### could not write checkpoint:", exc)
+            return False
+
+    def slot_checkpoint(self, _sender, _data):
+        """Slot for timer_checkpoint, the Scheduler thread only makes the
+        copy, it does not wait for the file to be written"""
+        self.save_checkpoint(True)
+
+    def enable_signal_stats(self, enabled):
+        """switch the collection of signal statistics on or off, this
+        affects all signals in the application, not only our own"""
+        Signal.enable_stats(enabled)
+
+    def get_signal_stats(self):
+        """return a list of (name, SignalStats) for all signals of this
+        instance, its orderbook, history, candle engine, client and the loaded
+        strategies that have been emitted since the statistics were enabled"""
+        result = []
+        objects = [self, self.orderbook, self.history, self.candle_engine, self.client]
+        objects += self.strategies.values()
+        for obj in objects:
+            for attr, value in sorted(vars(obj).items()):
+                if isinstance(value, Signal) and value._stats:
+                    name = "%s.%s" % (obj.__class__.__name__, attr)
+                    result.append((name, value._stats))
+        return result
+
+    def format_signal_stats(self):
+        """return the signal statistics as a list of human readable lines"""
+        if not Signal._stats_enabled:
+            return ["signal statistics are disabled"]
+        lines = []
+        for name, stats in self.get_signal_stats():
+            lines += stats.format(name)
+        return lines
+
+    def format_http_stats(self):
+        """return the http connection and fetch pool statistics
+        as a list of lines"""
+        return HTTP_POOL.format_stats() + [FETCH_POOL.format_stats()]
 
     def order(self, typ, price, volume):
         """place pending order. If price=0 then it will be filled at market"""
@@ -736,16 +3233,15 @@ class Api(BaseObject):
 
     def cancel_by_price(self, price):
         """cancel all orders at price"""
-        for i in reversed(range(len(self.orderbook.owns))):
-            order = self.orderbook.owns[i]
-            if order.price == price:
+        ticks = self.fixed.price2int(price)
+        for order in reversed(list(self.orderbook.owns)):
+            if self.fixed.price2int(order.price) == ticks:
                 if order.oid != "":
                     self.cancel(order.oid)
 
     def cancel_by_type(self, typ=None):
         """cancel all orders of type (or all orders if typ=None)"""
-        for i in reversed(range(len(self.orderbook.owns))):
-            order = self.orderbook.owns[i]
+        for order in reversed(list(self.orderbook.owns)):
             if typ is None or typ == order.typ:
                 if order.oid != "":
                     self.cancel(order.oid)
@@ -816,39 +3312,62 @@ class Api(BaseObject):
         # self.ready_idkey = False
         self.ready_info = False
         self.orderbook.ready_owns = False
-        self.orderbook.ready_depth = False
-        self.history.ready_history = False
+        if self.timer_checkpoint:
+            # keep using book and history, they will be updated after
+            # the reconnect just like after loading a checkpoint
+            self.orderbook.stale = self.orderbook.ready_depth
+            self.history.stale = self.history.ready_history
+        else:
+            self.orderbook.ready_depth = False
+            self.history.ready_history = False
         self._was_disconnected = True
         self.signal_disconnected(self, None)
 
     def slot_recv(self, dummy_sender, data):
         """Slot for signal_recv, handle new incoming JSON message. Decode the
         JSON string into a Python object and dispatch it to the method that
-        can handle it."""
+        can handle it. The handlers modify the orderbook directly, so this
+        must hold the same lock as all the other signals of this instance."""
         (str_json) = data
         handler = None
         if type(str_json) == dict:
             msg = str_json  # was already a dict
         else:
             msg = json.loads(str_json)
-        self.msg = msg
 
-        if "stamp" in msg:
-            delay = time.time() * 1e6 - int(msg["stamp"])
-            self.socket_lag = (self.socket_lag * 29 + delay) / 30
+        # acquire() and release(), not the with statement, this is called
+        # for every single message (and not even that for the NoLock of
+        # a backtest)
+        lock = self.lock
+        locking = lock.__class__ is not NoLock
+        if locking:
+            lock.acquire()
+        try:
+            self.msg = msg
 
-        if "op" in msg:
-            try:
-                msg_op = msg["op"]
-                handler = getattr(self, "_on_op_" + msg_op)
+            if "stamp" in msg:
+                delay = time.time() * 1e6 - int(msg["stamp"])
+                self.socket_lag = (self.socket_lag * 29 + delay) / 30
 
-            except AttributeError:
-                self.debug("slot_recv() ignoring: op=%s" % msg_op)
-        else:
-            self.debug("slot_recv() ignoring:", msg)
+            if "op" in msg:
+                # the handlers are looked up only once per op, they are
+                # kept as plain functions (bound methods would be a cycle)
+                msg_op = msg["op"]
+                handler = self._op_handlers.get(msg_op)
+                if handler is None:
+                    try:
+                        handler = getattr(self.__class__, "_on_op_" + msg_op).im_func
+                        self._op_handlers[msg_op] = handler
+                    except AttributeError:
+                        self.debug("slot_recv() ignoring: op=%s" % msg_op)
+            else:
+                self.debug("slot_recv() ignoring:", msg)
 
-        if handler:
-            handler(msg)
+            if handler:
+                handler(self, msg)
+        finally:
+            if locking:
+                lock.release()
 
     def slot_poll(self, _sender, _data):
         """poll stuff from http in regular intervals, not yet implemented"""
@@ -859,10 +3378,16 @@ class Api(BaseObject):
 
     def slot_history_changed(self, _sender, _data):
         """this is a small optimzation, if we tell the client the time
-        of the last known candle then it won't fetch full history next time"""
-        last_candle = self.history.last_candle()
-        if last_candle:
-            self.client.history_last_candle = last_candle.tim
+        of the last known candle then it won't fetch full history next time.
+        This is the last candle of the shortest timeframe, the longer ones
+        are rolled up from it again after the download."""
+        if _data == 1 and self.client.history_last_candle:
+            # only the current candle has changed (every trade), its
+            # time is known already
+            return
+        last_time = self.candle_engine.last_time()
+        if last_time:
+            self.client.history_last_candle = last_time
 
     def _on_op_error(self, msg):
         """handle error mesages (op:error)"""
@@ -879,7 +3404,7 @@ class Api(BaseObject):
         bid = msg["bid"]
         ask = msg["ask"]
 
-        # self.debug(" tick: %s %s" % (bid, ask))
+        self.log(LOG_TICK, logging.DEBUG, "tick: %s %s", bid, ask)
         self.signal_ticker(self, (bid, ask))
 
     def _on_op_depth(self, msg):
@@ -895,14 +3420,7 @@ class Api(BaseObject):
         # timestamp = msg["timestamp"]
         # total_volume = msg["total_volume"]
 
-        # delay = time.time() - timestamp
-        # self.debug("depth: %s: %.8f @ %.8f total: %.8f (age: %0.4f s)" % (
-        #     typ,
-        #     volume,
-        #     price,
-        #     price * volume,
-        #     delay / 1e6
-        # ))
+        self.log(LOG_DEPTH, logging.DEBUG, "depth: %s: %s @ %s", typ, volume, price)
         self.signal_depth(self, (typ, price, volume))  # , total_volume))
 
     def _on_op_trade(self, msg):
@@ -930,12 +3448,11 @@ class Api(BaseObject):
         #     # seems to need some time until the new values are available.
         #     # self.client.request_info_later(60)
         # else:
-        self.debug("trade: %s: %s @ %s" % (
-            typ,
-            volume,
-            price
-        ))
+        self.log(LOG_TRADE, logging.DEBUG, "trade: %s: %s @ %s", typ, volume, price)
 
+        # a history download that contains it must not add it again
+        if "id" in trade:
+            self.candle_engine.add_seen_id(trade["id"])
         self.signal_trade(self, (timestamp, price, volume, typ, False))  # own))
 
     def _on_op_chat(self, msg):
@@ -1007,10 +3524,10 @@ class Api(BaseObject):
             # is that we have the order-id already).
             parts = reqid.split(":")
             typ = parts[1]
-            price = float(parts[2])
-            volume = float(parts[3])
+            price = self.fixed.round_price(float(parts[2]))
+            volume = self.fixed.round_volume(float(parts[3]))
             oid = result
-            self.debug("### got ack for order/add:", typ, price, volume, oid)
+            self.log(LOG_ORDER, logging.DEBUG, "### got ack for order/add: %s %s %s %s", typ, price, volume, oid)
             self.count_submitted -= 1
             self.orderbook.add_own(Order(price, volume, typ, oid, "pending"))
 
@@ -1020,7 +3537,7 @@ class Api(BaseObject):
             # do nothing now, let things happen in the user_order message
             parts = reqid.split(":")
             oid = parts[1]
-            self.debug("### got ack for order/cancel:", oid)
+            self.log(LOG_ORDER, logging.DEBUG, "### got ack for order/cancel: %s", oid)
 
         else:
             self.debug("### _on_op_result() ignoring:", msg)
@@ -1175,18 +3692,345 @@ class Api(BaseObject):
         self.signal_order_too_fast(self, msg)
 
 
-class Level:
-    """represents a level in the orderbook"""
-    def __init__(self, price, volume):
+class Level(object):
+    """represents a level in the orderbook. The OrderBook does not store
+    these objects, they are created on the fly when indexing OrderBook.bids
+    or OrderBook.asks, modifying them will not change the book."""
+
+    __slots__ = ("price", "volume", "own_volume")
+
+    def __init__(self, price, volume, own_volume=0):
         self.price = price
         self.volume = volume
-        self.own_volume = 0
+        self.own_volume = own_volume
+
+class BookSide():
+    """one side (bids or asks) of the OrderBook. The levels are stored in
+    parallel arrays of prices, volumes and own volumes, sorted from the top
+    of the book downwards (lowest ask first, highest bid first). The sort
+    key is the price in ticks of the pair's FixedPoint(), negative for bids,
+    so bisect can be used for both sides and two prices that differ only by
+    a rounding error are the same level. Indexing returns a Level() for
+    compatibility, for anything performance critical use the arrays directly.
+
+    The cumulative volume (base and quote) is kept in two Fenwick trees
+    over "slots". The slots are the sorted prices of the levels but when a
+    level is removed its slot stays (with zero volume), so volume changes,
+    removals and the re-appearance of a price that was there before are all
+    O(log n) updates. A price that never had a slot is kept in a small
+    sorted overflow list (the "extra" arrays) that is added to the result of
+    every query, when this list is full the trees are rebuilt. The empty slots
+    are kept when rebuilding, so this becomes rare once the book has been
+    running for a while, they are only dropped when there are too many.
+    The changes are only queued and applied at the next query, if there are
+    more of them than slots the trees are rebuilt instead."""
+
+    EXTRA_MAX = 64
+
+    def __init__(self, is_ask, fixed):
+        self.is_ask = is_ask
+        self.fixed = fixed
+        self._mult = fixed.mult_price
+        self.keys = array.array("d")
+        self.prices = array.array("d")
+        self.volumes = array.array("d")
+        self.own_volumes = array.array("d")
+        self._slot_keys = array.array("d")
+        self._tree_vol = array.array("d", [0])
+        self._tree_quote = array.array("d", [0])
+        self._tree_valid = True
+        self._tree_pending = []
+        self._extra_keys = array.array("d")
+        self._extra_vol = array.array("d")
+        self._extra_quote = array.array("d")
+
+    def __len__(self):
+        return len(self.prices)
+
+    def __getitem__(self, index):
+        return Level(self.prices[index], self.volumes[index], self.own_volumes[index])
+
+    def __iter__(self):
+        for index in xrange(len(self.prices)):
+            yield self[index]
+
+    def _key(self, price):
+        """the sort key of this price (ticks, as float for the arrays)"""
+        ticks = round(price * self._mult)
+        return ticks if self.is_ask else -ticks
+
+    def _key_up_to(self, price):
+        """the sort key of the last tick between the top and price, this is
+        for queries with arbitrary prices that don't need to be on a tick"""
+        ticks = price * self._mult
+        nearest = round(ticks)
+        if abs(ticks - nearest) <= abs(ticks) * 1e-12:
+            ticks = nearest
+        return math.floor(ticks) if self.is_ask else -math.ceil(ticks)
+
+    def _price(self, key):
+        """the price of this sort key"""
+        return abs(key) / self._mult
+
+    def find(self, price):
+        """return a tuple (index, found), index is the index of the level
+        if found or the index where it would have to be inserted"""
+        key = self._key(price)
+        index = bisect.bisect_left(self.keys, key)
+        return (index, index < len(self.keys) and self.keys[index] == key)
+
+    def index_up_to(self, price):
+        """index of the last level between the top and price (inclusive),
+        -1 if there is no such level"""
+        return bisect.bisect_right(self.keys, self._key_up_to(price)) - 1
+
+    def clear(self):
+        """remove all levels"""
+        self.__init__(self.is_ask, self.fixed)
+
+    def load(self, prices, volumes):
+        """replace all levels, prices must be sorted top of the book first"""
+        self.clear()
+        self.keys = array.array("d", [self._key(price) for price in prices])
+        self.prices = array.array("d", prices)
+        self.volumes = array.array("d", volumes)
+        self.own_volumes = array.array("d", [0]) * len(prices)
+        self._tree_valid = False
+
+    def append(self, price, volume, own_volume=0):
+        """append a level at the bottom, the caller must make sure that
+        the order is not violated (used when loading full depth)"""
+        self.keys.append(self._key(price))
+        self.prices.append(price)
+        self.volumes.append(volume)
+        self.own_volumes.append(own_volume)
+        self._tree_valid = False
+
+    def insert(self, index, price, volume, own_volume=0):
+        """insert a new level at index"""
+        key = self._key(price)
+        self.keys.insert(index, key)
+        self.prices.insert(index, price)
+        self.volumes.insert(index, volume)
+        self.own_volumes.insert(index, own_volume)
+        self._tree_add(key, volume, volume * price)
+
+    def remove(self, index):
+        """remove the level at index"""
+        key = self.keys.pop(index)
+        price = self.prices.pop(index)
+        volume = self.volumes.pop(index)
+        self.own_volumes.pop(index)
+        self._tree_add(key, -volume, -volume * price)
+
+    def set_volume(self, index, volume):
+        """change the volume of the level at index"""
+        price = self.prices[index]
+        diff = volume - self.volumes[index]
+        self.volumes[index] = volume
+        self._tree_add(self.keys[index], diff, diff * price)
+
+    def set_own_volume(self, index, own_volume):
+        """change the own volume of the level at index"""
+        self.own_volumes[index] = own_volume
+
+    def reset_own_volumes(self):
+        """set the own volume of all levels to 0"""
+        self.own_volumes = array.array("d", [0]) * len(self.prices)
+
+    def _tree_add(self, key, volume, quote):
+        """queue a change of the volume at this key for the trees"""
+        if not self._tree_valid:
+            return
+        pending = self._tree_pending
+        pending.append((key, volume, quote))
+        if len(pending) > len(self._slot_keys):
+            self._tree_valid = False
+
+    def _tree_ready(self):
+        """apply the queued changes to the trees or rebuild them"""
+        if self._tree_valid and self._tree_pending:
+            pending = self._tree_pending
+            self._tree_pending = []
+            for (key, volume, quote) in pending:
+                if not self._tree_valid:
+                    break
+                self._tree_apply(key, volume, quote)
+        if not self._tree_valid:
+            self._tree_build()
+
+    def _tree_apply(self, key, volume, quote):
+        """add to the cumulative volume at the slot of this key"""
+        slot = bisect.bisect_left(self._slot_keys, key)
+        if slot == len(self._slot_keys) or self._slot_keys[slot] != key:
+            # no slot for this price, use the overflow list
+            extra_keys = self._extra_keys
+            index = bisect.bisect_left(extra_keys, key)
+            if index < len(extra_keys) and extra_keys[index] == key:
+                self._extra_vol[index] += volume
+                self._extra_quote[index] += quote
+            elif len(extra_keys) < self.EXTRA_MAX:
+                extra_keys.insert(index, key)
+                self._extra_vol.insert(index, volume)
+                self._extra_quote.insert(index, quote)
+            else:
+                # overflow list is full, rebuild the trees later
+                self._tree_valid = False
+            return
+        tree_vol = self._tree_vol
+        tree_quote = self._tree_quote
+        size = len(self._slot_keys)
+        i = slot + 1
+        while i <= size:
+            tree_vol[i] += volume
+            tree_quote[i] += quote
+            i += i & -i
+
+    def _tree_build(self):
+        """build the trees, one slot for every level plus the empty slots of
+        the previous trees (prices that are likely to come back), unless there
+        are too many empty slots, then they are all dropped."""
+        keys = self.keys
+        if len(self._slot_keys) < 4 * len(keys) + 64:
+            slot_keys = array.array("d", sorted(set(self._slot_keys).union(keys)))
+        else:
+            slot_keys = array.array("d", keys)
+        size = len(slot_keys)
+        tree_vol = array.array("d", [0]) * (size + 1)
+        tree_quote = array.array("d", [0]) * (size + 1)
+        slot = 0
+        for (key, price, volume) in itertools.izip(keys, self.prices, self.volumes):
+            while slot_keys[slot] != key:
+                slot += 1
+            tree_vol[slot + 1] = volume
+            tree_quote[slot + 1] = volume * price
+        for i in xrange(1, size + 1):
+            j = i + (i & -i)
+            if j <= size:
+                tree_vol[j] += tree_vol[i]
+                tree_quote[j] += tree_quote[i]
+        self._slot_keys = slot_keys
+        self._tree_vol = tree_vol
+        self._tree_quote = tree_quote
+        self._tree_valid = True
+        self._tree_pending = []
+        self._extra_keys = array.array("d")
+        self._extra_vol = array.array("d")
+        self._extra_quote = array.array("d")
+
+    def _tree_prefix(self, count):
+        """total (volume, quote) of the first count slots"""
+        self._tree_ready()
+        tree_vol = self._tree_vol
+        tree_quote = self._tree_quote
+        total = 0
+        total_quote = 0
+        i = count
+        while i > 0:
+            total += tree_vol[i]
+            total_quote += tree_quote[i]
+            i -= i & -i
+        return (total, total_quote)
 
-        # these fields are only used to store temporary cache values
-        # in some (not all!) levels and is calculated by the OrderBook
-        # on demand, do not access this, use get_total_up_to() instead!
-        self._cache_total_vol = 0
-        self._cache_total_vol_quote = 0
+    def _tree_walk(self, value, is_quote=False):
+        """find the slot at which the cumulative volume (or quote volume) of
+        the trees alone reaches value. Returns a tuple (slot, volume, quote)
+        where volume and quote are the totals of all the slots before it,
+        slot is the number of slots if the trees have not enough."""
+        tree_vol = self._tree_vol
+        tree_quote = self._tree_quote
+        tree = tree_quote if is_quote else tree_vol
+        size = len(self._slot_keys)
+        pos = 0
+        total = 0
+        total_quote = 0
+        reached = 0
+        step = 1
+        while step * 2 <= size:
+            step *= 2
+        while step:
+            nxt = pos + step
+            if nxt <= size and reached + tree[nxt] < value:
+                pos = nxt
+                reached += tree[nxt]
+                total += tree_vol[nxt]
+                total_quote += tree_quote[nxt]
+            step //= 2
+        return (pos, total, total_quote)
+
+    def _tree_search(self, value, is_quote=False):
+        """find the level at which the cumulative volume (or quote volume)
+        reaches value. Returns a tuple (key, volume, quote) where volume and
+        quote are the totals of everything before it, key is None if the
+        whole side has not enough. The prices in the overflow list are
+        folded into the walk (like in get_total_up_to()), only the extra
+        levels before the slot found without them can change the result.
+        Only a small side is rebuilt instead, that is cheaper."""
+        self._tree_ready()
+        if len(self._slot_keys) < 16 * len(self._extra_keys):
+            self._tree_build()
+        slot_keys = self._slot_keys
+        (slot, total, total_quote) = self._tree_walk(value, is_quote)
+        extra_keys = self._extra_keys
+        count = len(extra_keys)
+        if count and slot < len(slot_keys):
+            count = bisect.bisect_left(extra_keys, slot_keys[slot])
+        if count:
+            extra_values = self._extra_quote if is_quote else self._extra_vol
+            extra_vol = 0
+            extra_quote = 0
+            for index in xrange(count):
+                key = extra_keys[index]
+                (tree_vol, tree_quote) = self._tree_prefix(bisect.bisect_left(slot_keys, key))
+                reached = tree_quote + extra_quote if is_quote else tree_vol + extra_vol
+                if reached >= value:
+                    break  # at a slot before this extra level
+                if reached + extra_values[index] >= value:
+                    return (key, tree_vol + extra_vol, tree_quote + extra_quote)
+                extra_vol += self._extra_vol[index]
+                extra_quote += self._extra_quote[index]
+            (slot, total, total_quote) = self._tree_walk(
+                value - (extra_quote if is_quote else extra_vol), is_quote)
+            total += extra_vol
+            total_quote += extra_quote
+        if slot >= len(slot_keys):
+            return (None, total, total_quote)
+        return (slot_keys[slot], total, total_quote)
+
+    def get_total_up_to(self, price):
+        """return a tuple of the total volume in base and in quote currency
+        between top and this price (inclusive)"""
+        self._tree_ready()
+        key = self._key_up_to(price)
+        (total, total_quote) = self._tree_prefix(bisect.bisect_right(self._slot_keys, key))
+        if self._extra_keys:
+            count = bisect.bisect_right(self._extra_keys, key)
+            total += sum(self._extra_vol[:count])
+            total_quote += sum(self._extra_quote[:count])
+        return (total, total_quote)
+
+    def get_cost(self, volume):
+        """return the total quote volume needed to take volume (base) from
+        the top of this side and the price of the last level touched as a
+        tuple (cost, price), None if the whole side has not enough volume"""
+        (key, total, total_quote) = self._tree_search(volume)
+        if key is None:
+            return None
+        price = self._price(key)
+        return (total_quote + (volume - total) * price, price)
+
+    def get_volume_top(self, count):
+        """total base volume of the first count levels"""
+        return sum(self.volumes[:count])
+
+    def get_price_for_volume(self, volume, is_quote=False):
+        """return the price of the level at which the total volume from the
+        top of the book reaches volume (base currency or quote currency if
+        is_quote), or None if the whole side has not enough volume"""
+        key = self._tree_search(volume, is_quote)[0]
+        if key is None:
+            return None
+        return self._price(key)
 
 class Order:
     """represents an order"""
@@ -1198,6 +4042,185 @@ class Order:
         self.oid = oid
         self.status = status
 
+class OwnOrders():
+    """the list of own orders (OrderBook.owns). It can be used like a list
+    (iterate over it, len(), owns[0]) but it is also indexed by oid and it
+    maintains the total own volume per (typ, price), so none of the lookups
+    needs to go through all the orders. The volume of an order in this list
+    must only be changed with set_volume()."""
+
+    def __init__(self, fixed):
+        self._fixed = fixed
+        self._orders = collections.OrderedDict()  # oid -> Order()
+        self._volumes = {}  # (typ, price in ticks) -> [count, volume]
+
+    def __len__(self):
+        return len(self._orders)
+
+    def __iter__(self):
+        return self._orders.itervalues()
+
+    def __getitem__(self, index):
+        if index == 0 and self._orders:
+            return next(self._orders.itervalues())
+        return self._orders.values()[index]
+
+    def get(self, oid):
+        """return the order with this oid or None"""
+        return self._orders.get(oid)
+
+    def add(self, order):
+        """add the order, it must not be in the list already"""
+        self._orders[order.oid] = order
+        self._add_volume(order.typ, order.price, 1, order.volume)
+
+    def remove(self, oid):
+        """remove and return the order with this oid"""
+        order = self._orders.pop(oid)
+        self._add_volume(order.typ, order.price, -1, -order.volume)
+        return order
+
+    def set_volume(self, order, volume):
+        """change the volume of an order that is in the list"""
+        self._add_volume(order.typ, order.price, 0, volume - order.volume)
+        order.volume = volume
+
+    def get_volume_at(self, price, typ=None):
+        """total volume of own orders at this price"""
+        if typ:
+            return self._volumes.get((typ, self._fixed.price2int(price)), (0, 0))[1]
+        return self.get_volume_at(price, "bid") + self.get_volume_at(price, "ask")
+
+    def clear(self):
+        """remove all orders"""
+        self._orders.clear()
+        self._volumes.clear()
+
+    def _add_volume(self, typ, price, count, volume):
+        """update the count and volume at (typ, price), the entry is
+        removed when its last order is gone (no rounding errors left)"""
+        key = (typ, self._fixed.price2int(price))
+        entry = self._volumes.setdefault(key, [0, 0])
+        entry[0] += count
+        entry[1] += volume
+        if entry[0] <= 0:
+            del self._volumes[key]
+
+def group_index(price, group, is_ask):
+    """the number of the bin of width group that price falls into. Asks are
+    binned upwards (ceil) and bids downwards (floor), the bin price is
+    index * group. A price that is a multiple of group (apart from the
+    rounding error of the division) is its own bin."""
+    steps = price / group
+    nearest = round(steps)
+    if abs(steps - nearest) <= abs(steps) * 1e-12:
+        return int(nearest)
+    if is_ask:
+        return int(math.ceil(steps))
+    return int(math.floor(steps))
+
+class GroupedSide():
+    """one side of a GroupedView: the non-empty bins, top of the book first.
+    keys is the sorted list of bin numbers (negative for bids so that the
+    highest bid comes first), bins maps bin number to [volume, quote]"""
+
+    EMPTY = 1e-10  # a bin with less volume than this is considered empty
+
+    def __init__(self, is_ask, group):
+        self.is_ask = is_ask
+        self.group = group
+        self.keys = []
+        self.bins = {}
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __iter__(self):
+        """iterate over (bin_price, volume, quote), top of the book first"""
+        group = self.group
+        bins = self.bins
+        sign = 1 if self.is_ask else -1
+        # iterate over a copy, the book might change while a window paints
+        for key in list(self.keys):
+            entry = bins.get(key)
+            if entry is not None:
+                yield (sign * key * group, entry[0], entry[1])
+
+    def bin_price(self, price):
+        """the price of the bin that contains price"""
+        return group_index(price, self.group, self.is_ask) * self.group
+
+    def get_bin(self, price):
+        """return (volume, quote) of the bin that contains price"""
+        key = group_index(price, self.group, self.is_ask)
+        if not self.is_ask:
+            key = -key
+        return tuple(self.bins.get(key, (0, 0)))
+
+    def clear(self):
+        """remove all bins"""
+        self.keys = []
+        self.bins = {}
+
+    def add(self, price, voldiff):
+        """add voldiff at price, return (bin_price, new bin volume)"""
+        index = group_index(price, self.group, self.is_ask)
+        key = index if self.is_ask else -index
+        entry = self.bins.get(key)
+        if entry is None:
+            entry = self.bins[key] = [0, 0]
+            bisect.insort(self.keys, key)
+        entry[0] += voldiff
+        entry[1] += voldiff * price
+        volume = entry[0]
+        if volume < self.EMPTY:
+            del self.bins[key]
+            del self.keys[bisect.bisect_left(self.keys, key)]
+            volume = 0
+        return (index * self.group, volume)
+
+class GroupedView():
+    """the order book aggregated into price bins of width group. It is
+    created with OrderBook.add_grouped_view() and then kept up to date
+    with every single level change, so painting a grouped book or depth
+    chart only needs to iterate over the (non-empty) bins in asks and bids
+    instead of querying the book for every bin between top and bottom."""
+
+    def __init__(self, orderbook, group):
+        self.group = group
+        self.asks = GroupedSide(True, group)
+        self.bids = GroupedSide(False, group)
+        self.refcount = 0
+
+        self.signal_changed = Signal(orderbook.api.lock)
+        """a bin has changed
+        param: (typ, bin_price, volume)
+        typ is "bid" or "ask", volume is the new total volume in the bin,
+        it is 0 when the bin has become empty. Not emitted on rebuild()."""
+
+        self.rebuild(orderbook)
+
+    def rebuild(self, orderbook):
+        """fill all bins from scratch from the current book"""
+        for (side, book_side) in [(self.asks, orderbook.asks), (self.bids, orderbook.bids)]:
+            side.clear()
+            for (price, volume) in itertools.izip(book_side.prices, book_side.volumes):
+                if volume:
+                    side.add(price, volume)
+
+    def slot_level_changed(self, _book, data):
+        """Slot for OrderBook.signal_level_changed"""
+        (typ, price, voldiff) = data
+        side = self.asks if typ == "ask" else self.bids
+        (bin_price, volume) = side.add(price, voldiff)
+        if self.signal_changed.has_slots():
+            self.signal_changed(self, (typ, bin_price, volume))
+
+    def slot_fulldepth_processed(self, book, _dummy):
+        """Slot for OrderBook.signal_fulldepth_processed, start over with
+        the fresh snapshot so rounding errors can't accumulate forever"""
+        self.rebuild(book)
+
 class OrderBook(BaseObject):
     """represents the orderbook. Each Gox instance has one
     instance of OrderBook to maintain the open orders. This also
@@ -1209,7 +4232,7 @@ class OrderBook(BaseObject):
         BaseObject.__init__(self)
         self.api = api
 
-        self.signal_changed = Signal()
+        self.signal_changed = Signal(api.lock)
         """orderbook state has changed
         param: None
         an update to the state of the orderbook happened, this is emitted very
@@ -1217,27 +4240,35 @@ class OrderBook(BaseObject):
         also after every user_order message. This signal is for example used
         in pytrader.py to repaint the user interface of the orderbook window."""
 
-        self.signal_fulldepth_processed = Signal()
+        self.signal_level_changed = Signal(api.lock)
+        """a level in the book has changed
+        param: (typ, price, voldiff)
+        typ is "bid" or "ask", voldiff is the change of the volume at this
+        price, emitted for every single change (depth messages, trades and
+        every level that has actually changed when a fulldepth arrives)."""
+
+        self.signal_fulldepth_processed = Signal(api.lock)
         """fulldepth download is complete
         param: None
         The orderbook (fulldepth) has been downloaded from the server.
-        This happens soon after connect."""
+        This happens soon after connect. It is also emitted when the book
+        has been loaded from a checkpoint, then stale will be True."""
 
-        self.signal_owns_initialized = Signal()
+        self.signal_owns_initialized = Signal(api.lock)
         """own order list has been initialized
         param: None
         The owns list has been initialized. This happens soon after connect
         after it has downloaded the authoritative list of pending and open
         orders. This will also happen if it reinitialized after lost connection."""
 
-        self.signal_owns_changed = Signal()
+        self.signal_owns_changed = Signal(api.lock)
         """owns list has changed
         param: None
         an update to the owns list has happened, this can be order added,
         removed or filled, status or volume of an order changed. For specific
         changes to individual orders see the signal_own_* signals below."""
 
-        self.signal_own_added = Signal()
+        self.signal_own_added = Signal(api.lock)
         """order was added
         param: (order)
         order is a reference to the Order() instance
@@ -1246,7 +4277,7 @@ class OrderBook(BaseObject):
         some time later there will be signal_own_opened when the status
         changed to open."""
 
-        self.signal_own_removed = Signal()
+        self.signal_own_removed = Signal(api.lock)
         """order has been removed
         param: (order, reason)
         order is a reference to the Order() instance
@@ -1258,7 +4289,7 @@ class OrderBook(BaseObject):
         reliable way to determine that a trade has fully completed because the
         trade signal alone won't tell you whether its partial or complete"""
 
-        self.signal_own_opened = Signal()
+        self.signal_own_opened = Signal(api.lock)
         """order status went to "open"
         param: (order)
         order is a reference to the Order() instance
@@ -1267,7 +4298,7 @@ class OrderBook(BaseObject):
         market orders can't have an "open" status, they never move beyond
         "executing", they just execute and emit volume and removed signals."""
 
-        self.signal_own_volume = Signal()
+        self.signal_own_volume = Signal(api.lock)
         """order volume changed (partial fill)
         param: (order, voldiff)
         order is a reference to the Order() instance
@@ -1280,9 +4311,10 @@ class OrderBook(BaseObject):
         remaining order volume down to zero will be immediately followed by
         a removed signal."""
 
-        self.bids = []  # list of Level(), lowest ask first
-        self.asks = []  # list of Level(), highest bid first
-        self.owns = []  # list of Order(), unordered list
+        self.bids = BookSide(False, api.fixed)  # highest bid first
+        self.asks = BookSide(True, api.fixed)  # lowest ask first
+        self.owns = OwnOrders(api.fixed)  # list of Order(), in the order they were added
+        self.grouped_views = {}  # group -> GroupedView()
 
         self.bid = 0
         self.ask = 0
@@ -1291,6 +4323,7 @@ class OrderBook(BaseObject):
 
         self.ready_depth = False
         self.ready_owns = False
+        self.stale = False  # levels are from a checkpoint, not downloaded yet
 
         self.last_change_type = None  # ("bid", "ask", None) this can be used
         self.last_change_price = 0  # for highlighting relative changes
@@ -1299,9 +4332,6 @@ class OrderBook(BaseObject):
         self.depth_updated = '-'
         self.orders_updated = '-'
 
-        self._valid_bid_cache = -1   # index of bid with valid _cache_total_vol
-        self._valid_ask_cache = -1   # index of ask with valid _cache_total_vol
-
         api.signal_ticker.connect(self.slot_ticker)
         api.signal_depth.connect(self.slot_depth)
         api.signal_trade.connect(self.slot_trade)
@@ -1324,6 +4354,7 @@ class OrderBook(BaseObject):
         """Slot for signal_depth, process incoming depth message"""
         (typ, price, total_vol) = data
         if self._update_book(typ, price, total_vol):
+            self.signal_level_changed(self, (typ, price, self.last_change_volume))
             self.signal_changed(self, None)
 
     def slot_trade(self, dummy_sender, data):
@@ -1343,36 +4374,50 @@ class OrderBook(BaseObject):
             # message but we update the orderbook immediately.
             voldiff = -volume
             if typ == "bid":  # typ=bid means an ask order was filled
-                self._repair_crossed_asks(price)
-                if len(self.asks):
-                    if self.asks[0].price == price:
-                        self.asks[0].volume -= volume
-                        if self.asks[0].volume <= 0:
-                            voldiff -= self.asks[0].volume
-                            self.asks.pop(0)
+                # the key of the price only once and no len(asks), this is
+                # done for every trade
+                asks = self.asks
+                key = asks._key(price)
+                keys = asks.keys
+                if keys and keys[0] < key:
+                    self._repair_crossed_asks(price)
+                if keys:
+                    if keys[0] == key:
+                        volume_left = asks.volumes[0] - volume
+                        if volume_left <= 0:
+                            voldiff -= volume_left
+                            asks.remove(0)
+                        else:
+                            asks.set_volume(0, volume_left)
                         self.last_change_type = "ask"  # the asks have changed
                         self.last_change_price = price
                         self.last_change_volume = voldiff
                         self._update_total_ask(voldiff)
-                        self._valid_ask_cache = -1
-                if len(self.asks):
-                    self.ask = self.asks[0].price
+                        self.signal_level_changed(self, ("ask", price, voldiff))
+                if keys:
+                    self.ask = asks.prices[0]
 
             if typ == "ask":  # typ=ask means a bid order was filled
-                self._repair_crossed_bids(price)
-                if len(self.bids):
-                    if self.bids[0].price == price:
-                        self.bids[0].volume -= volume
-                        if self.bids[0].volume <= 0:
-                            voldiff -= self.bids[0].volume
-                            self.bids.pop(0)
+                bids = self.bids
+                key = bids._key(price)
+                keys = bids.keys
+                if keys and keys[0] < key:
+                    self._repair_crossed_bids(price)
+                if keys:
+                    if keys[0] == key:
+                        volume_left = bids.volumes[0] - volume
+                        if volume_left <= 0:
+                            voldiff -= volume_left
+                            bids.remove(0)
+                        else:
+                            bids.set_volume(0, volume_left)
                         self.last_change_type = "bid"  # the bids have changed
                         self.last_change_price = price
                         self.last_change_volume = voldiff
                         self._update_total_bid(voldiff, price)
-                        self._valid_bid_cache = -1
-                if len(self.bids):
-                    self.bid = self.bids[0].price
+                        self.signal_level_changed(self, ("bid", price, voldiff))
+                if keys:
+                    self.bid = bids.prices[0]
 
         self.signal_changed(self, None)
 
@@ -1390,52 +4435,46 @@ class OrderBook(BaseObject):
             # don't need this status at all
             return
         if "removed" in status:
-            for i in range(len(self.owns)):
-                if self.owns[i].oid == oid:
-                    order = self.owns[i]
-
-                    # work around strangeness:
-                    # for some reason it will send a "completed_passive"
-                    # immediately followed by a "completed_active" when a
-                    # market order is filled and removed. Since "completed_passive"
-                    # is meant for limit orders only we will just completely
-                    # IGNORE all "completed_passive" if it affects a market order,
-                    # there WILL follow a "completed_active" immediately after.
-                    if order.price == 0:
-                        if "passive" in status:
-                            # ignore it, the correct one with
-                            # "active" will follow soon
-                            return
-
-                    self.debug(
-                        "### removing order %s " % oid,
-                        "price:", order.price,
-                        "type:", order.typ)
-
-                    # remove it from owns...
-                    self.owns.pop(i)
-
-                    # ...and update own volume cache in the bids or asks
-                    self._update_level_own_volume(
-                        order.typ,
-                        order.price,
-                        self.get_own_volume_at(order.price, order.typ)
-                    )
-                    removed = True
-                    break
+            order = self.owns.get(oid)
+            if order:
+                # work around strangeness:
+                # for some reason it will send a "completed_passive"
+                # immediately followed by a "completed_active" when a
+                # market order is filled and removed. Since "completed_passive"
+                # is meant for limit orders only we will just completely
+                # IGNORE all "completed_passive" if it affects a market order,
+                # there WILL follow a "completed_active" immediately after.
+                if order.price == 0:
+                    if "passive" in status:
+                        # ignore it, the correct one with
+                        # "active" will follow soon
+                        return
+
+                self.log(LOG_ORDER, logging.DEBUG,
+                         "### removing order %s  price: %s type: %s",
+                         oid, order.price, order.typ)
+
+                # remove it from owns...
+                self.owns.remove(oid)
+
+                # ...and update own volume cache in the bids or asks
+                self._update_level_own_volume(
+                    order.typ,
+                    order.price,
+                    self.get_own_volume_at(order.price, order.typ)
+                )
+                removed = True
         else:
-            for order in self.owns:
-                if order.oid == oid:
-                    found = True
-                    self.debug(
-                        "### updating order %s " % oid,
-                        "volume:", volume,
-                        "status:", status)
-                    voldiff = volume - order.volume
-                    opened = (order.status != "open" and status == "open")
-                    order.volume = volume
-                    order.status = status
-                    break
+            order = self.owns.get(oid)
+            if order:
+                found = True
+                self.log(LOG_ORDER, logging.DEBUG,
+                         "### updating order %s  volume: %s status: %s",
+                         oid, volume, status)
+                voldiff = volume - order.volume
+                opened = (order.status != "open" and status == "open")
+                self.owns.set_volume(order, volume)
+                order.status = status
 
             if not found:
                 # This can happen if we added the order with a different
@@ -1458,9 +4497,15 @@ class OrderBook(BaseObject):
         # as we can by sending different signals for different events.
         if removed:
             reason = self.api.msg["user_order"]["reason"]
+            if reason.startswith("completed"):
+                self.log(LOG_TRADE_OWN, logging.DEBUG, "own trade: %s: %s @ %s (%s)",
+                         order.typ, order.volume, order.price, reason)
             self.signal_own_removed(self, (order, reason))
         if opened:
             self.signal_own_opened(self, (order))
+        if voldiff < 0:
+            self.log(LOG_TRADE_OWN, logging.DEBUG, "own trade: %s: %s @ %s (partial)",
+                     order.typ, -voldiff, order.price)
         if voldiff:
             self.signal_own_volume(self, (order, voldiff))
         self.signal_changed(self, None)
@@ -1468,63 +4513,104 @@ class OrderBook(BaseObject):
 
     def slot_fulldepth(self, dummy_sender, data):
         """Slot for signal_fulldepth, process received fulldepth data.
-        This will clear the book and then re-initialize it from scratch."""
+        The snapshot is compared with the existing book and only the levels
+        that have actually changed are updated (and signaled), levels that
+        exist in the book but not in the snapshot are removed."""
         (depth) = data
         # self.debug("### got full depth, updating orderbook...")
-        self.bids = []
-        self.asks = []
-        self.total_ask = 0
-        self.total_bid = 0
         if "error" in depth and depth['error']:
             self.debug("### ", depth["error"])
             return
-        for order in depth["data"]["asks"]:
-            price = order["price"]
-            volume = order["amount"]
-            self._update_total_ask(volume)
-            self.asks.append(Level(price, volume))
-        for order in depth["data"]["bids"]:
-            price = order["price"]
-            volume = order["amount"]
-            self._update_total_bid(volume, price)
-            self.bids.insert(0, Level(price, volume))
-
-        # update own volume cache
-        for order in self.owns:
-            self._update_level_own_volume(
-                order.typ, order.price, self.get_own_volume_at(order.price, order.typ))
+        self._apply_fulldepth("ask", depth["data"]["asks"])
+        self._apply_fulldepth("bid", depth["data"]["bids"])
+
+        # sum it up again so that rounding errors can't accumulate forever
+        self.total_ask = sum(self.asks.volumes)
+        self.total_bid = sum(itertools.imap(operator.mul, self.bids.prices, self.bids.volumes))
 
         if len(self.bids):
-            self.bid = self.bids[0].price
+            self.bid = self.bids.prices[0]
         if len(self.asks):
-            self.ask = self.asks[0].price
+            self.ask = self.asks.prices[0]
 
-        self._valid_ask_cache = -1
-        self._valid_bid_cache = -1
         self.ready_depth = True
+        self.stale = False
         self.depth_updated = time.strftime("%Y-%m-%d %H:%M:%S")
         self.signal_fulldepth_processed(self, None)
         self.signal_changed(self, None)
 
+    def load_levels(self, bids, asks):
+        """fill the book with the (prices, volumes) of bids and asks from a
+        checkpoint, the book is marked as stale until the next fulldepth
+        has been applied (which will only change what has changed)"""
+        self.bids.load(*bids)
+        self.asks.load(*asks)
+        self.total_ask = sum(self.asks.volumes)
+        self.total_bid = sum(itertools.imap(operator.mul, self.bids.prices, self.bids.volumes))
+        if len(self.bids):
+            self.bid = self.bids.prices[0]
+        if len(self.asks):
+            self.ask = self.asks.prices[0]
+        self.ready_depth = True
+        self.stale = True
+        self.depth_updated = "checkpoint"
+        self.signal_fulldepth_processed(self, None)
+        self.signal_changed(self, None)
+
+    def _apply_fulldepth(self, typ, levels):
+        """update one side of the book from the list of levels in the
+        fulldepth message, return the number of changed levels"""
+        side = self.asks if typ == "ask" else self.bids
+        price2int = self.api.fixed.price2int
+        snapshot = {}  # ticks -> (price, volume)
+        for order in levels:
+            snapshot[price2int(order["price"])] = (order["price"], order["amount"])
+
+        if not len(side):
+            # empty book (first download), no need to compare anything
+            for ticks in sorted(snapshot, reverse=(typ == "bid")):
+                (price, volume) = snapshot[ticks]
+                if volume:
+                    side.append(price, volume)
+                    self.signal_level_changed(self, (typ, price, volume))
+            return len(side)
+
+        changes = []
+        for (price, volume) in itertools.izip(side.prices, side.volumes):
+            new_volume = snapshot.pop(price2int(price), (0, 0))[1]
+            if new_volume != volume:
+                changes.append((price, new_volume))
+        for (price, volume) in snapshot.itervalues():
+            if volume:
+                changes.append((price, volume))
+
+        for (price, volume) in changes:
+            if self._update_book(typ, price, volume):
+                self.signal_level_changed(self, (typ, price, self.last_change_volume))
+        return len(changes)
+
     def _repair_crossed_bids(self, bid):
         """remove all bids that are higher than current bid value, which occurs
         when ticker prices come in before depth"""
-        while len(self.bids) and self.bids[0].price > bid:
-            price = self.bids[0].price
-            volume = self.bids[0].volume
+        bids = self.bids
+        key = bids._key(bid)
+        while len(bids) and bids.keys[0] < key:
+            (price, volume) = (bids.prices[0], bids.volumes[0])
             self._update_total_bid(-volume, price)
-            self.bids.pop(0)
-            self._valid_bid_cache = -1
+            bids.remove(0)
+            self.signal_level_changed(self, ("bid", price, -volume))
             # self.debug("### repaired bid")
 
     def _repair_crossed_asks(self, ask):
         """remove all asks that are lower than official ask value, which occurs
         when ticker prices come in before depth"""
-        while len(self.asks) and self.asks[0].price < ask:
-            volume = self.asks[0].volume
+        asks = self.asks
+        key = asks._key(ask)
+        while len(asks) and asks.keys[0] < key:
+            (price, volume) = (asks.prices[0], asks.volumes[0])
             self._update_total_ask(-volume)
-            self.asks.pop(0)
-            self._valid_ask_cache = -1
+            asks.remove(0)
+            self.signal_level_changed(self, ("ask", price, -volume))
             # self.debug("### repaired ask")
 
     def _update_book(self, typ, price, total_vol):
@@ -1532,38 +4618,45 @@ class OrderBook(BaseObject):
         also update all other stuff that needs to be tracked such as
         total volumes and invalidate the total volume cache index.
         Return True if book has changed, return False otherwise"""
-        (lst, index, level) = self._find_level(typ, price)
+        side = self.asks if typ == "ask" else self.bids
+        # side.find() without the call, this is done for every depth message
+        key = side._key(price)
+        keys = side.keys
+        index = bisect.bisect_left(keys, key)
+        found = index < len(keys) and keys[index] == key
         if total_vol == 0:
-            if level is None:
+            if not found:
+                return False
+            voldiff = -side.volumes[index]
+            if voldiff == 0:
                 return False
+            if side.own_volumes[index]:
+                # keep the level, we still have our own orders there
+                side.set_volume(index, 0)
             else:
-                voldiff = -level.volume
-                lst.pop(index)
+                side.remove(index)
         else:
-            if level is None:
+            if not found:
                 voldiff = total_vol
-                level = Level(price, total_vol)
-                lst.insert(index, level)
+                side.insert(index, price, total_vol)
             else:
-                voldiff = total_vol - level.volume
+                voldiff = total_vol - side.volumes[index]
                 if voldiff == 0:
                     return False
-                level.volume = total_vol
+                side.set_volume(index, total_vol)
 
         # now keep all the other stuff in sync with it
         self.last_change_type = typ
         self.last_change_price = price
         self.last_change_volume = voldiff
         if typ == "ask":
-            self._update_total_ask(voldiff)
-            if len(self.asks):
-                self.ask = self.asks[0].price
-            self._valid_ask_cache = min(self._valid_ask_cache, index - 1)
+            self.total_ask += voldiff  # _update_total_ask()
+            if keys:
+                self.ask = side.prices[0]
         else:
-            self._update_total_bid(voldiff, price)
-            if len(self.bids):
-                self.bid = self.bids[0].price
-            self._valid_bid_cache = min(self._valid_bid_cache, index - 1)
+            self.total_bid += voldiff * price  # _update_total_bid()
+            if keys:
+                self.bid = side.prices[0]
 
         return True
 
@@ -1585,149 +4678,140 @@ class OrderBook(BaseObject):
             # would only insert empty rows at price=0 into the book
             return
 
-        (index, level) = self._find_level_or_insert_new(typ, price)
-        if level.volume == 0 and own_volume == 0:
-            if typ == "ask":
-                self.asks.pop(index)
-            else:
-                self.bids.pop(index)
-        else:
-            level.own_volume = own_volume
-
-    def _find_level(self, typ, price):
-        """find the level in the orderbook and return a triple
-        (list, index, level) where list is a reference to the list,
-        index is the index if its an exact match or the index of the next
-        element if it was not found (can be used for inserting) and level
-        is either a reference to the found level or None if not found."""
-        lst = {"ask": self.asks, "bid": self.bids}[typ]
-        comp = {"ask": lambda x, y: x < y, "bid": lambda x, y: x > y}[typ]
-        low = 0
-        high = len(lst)
-
-        # binary search
-        while low < high:
-            mid = (low + high) // 2
-            midval = lst[mid].price
-            if comp(midval, price):
-                low = mid + 1
-            elif comp(price, midval):
-                high = mid
-            else:
-                return (lst, mid, lst[mid])
-
-        # not found, return insertion point (index of next higher level)
-        return (lst, high, None)
-
-    def _find_level_or_insert_new(self, typ, price):
-        """find the Level() object in bids or asks or insert a new
-        Level() at the correct position. Returns tuple (index, level)"""
-        (lst, index, level) = self._find_level(typ, price)
-        if level:
-            return (index, level)
-
-        # no exact match found, create new Level() and insert
-        level = Level(price, 0)
-        lst.insert(index, level)
-
-        # invalidate the total volume cache at and beyond this level
-        if typ == "ask":
-            self._valid_ask_cache = min(self._valid_ask_cache, index - 1)
+        side = self.asks if typ == "ask" else self.bids
+        (index, found) = side.find(price)
+        if not found:
+            if own_volume:
+                side.insert(index, price, 0, own_volume)
+        elif side.volumes[index] == 0 and own_volume == 0:
+            side.remove(index)
         else:
-            self._valid_bid_cache = min(self._valid_bid_cache, index - 1)
-
-        return (index, level)
+            side.set_own_volume(index, own_volume)
 
     def get_own_volume_at(self, price, typ=None):
         """returns the sum of the volume of own orders at a given price. This
         method will not look up the cache in the bids or asks lists, it will
         use the authoritative data from the owns list bacause this method is
         also used to calculate these cached values in the first place."""
-        volume = 0
-        for order in self.owns:
-            if order.price == price and (not typ or typ == order.typ):
-                volume += order.volume
-        return volume
+        return self.owns.get_volume_at(price, typ)
 
     def have_own_oid(self, oid):
         """do we have an own order with this oid in our list already?"""
-        for order in self.owns:
-            if order.oid == oid:
-                return True
-        return False
+        return self.owns.get(oid) is not None
 
     def get_total_up_to(self, price, is_ask):
         """return a tuple of the total volume in coins and in fiat between top
-        and this price. This will calculate the total on demand, it has a cache
-        to not repeat the same calculations more often than absolutely needed"""
+        and this price (the cumulative volume and notional up to price)"""
         if is_ask:
-            lst = self.asks
-            known_level = self._valid_ask_cache
-            comp = lambda x, y: x < y
+            return self.asks.get_total_up_to(price)
         else:
-            lst = self.bids
-            known_level = self._valid_bid_cache
-            comp = lambda x, y: x > y
-
-        # now first we need the list index of the level we are looking for or
-        # if it doesn't match exactly the index of the level right before that
-        # price, for this we do a quick binary search for the price
-        low = 0
-        high = len(lst)
-        while low < high:
-            mid = (low + high) // 2
-            midval = lst[mid].price
-            if comp(midval, price):
-                low = mid + 1
-            elif comp(price, midval):
-                high = mid
-            else:
-                break
-        if comp(price, midval):
-            needed_level = mid - 1
-        else:
-            needed_level = mid
-
-        # if the total volume at this level has been calculated
-        # already earlier then we don't need to do anything further,
-        # we can immediately return the cached value from that level.
-        if needed_level <= known_level:
-            lvl = lst[needed_level]
-            return (lvl._cache_total_vol, lvl._cache_total_vol_quote)
-
-        # we are still here, this means we must calculate and update
-        # all totals in all levels between last_known and needed_level
-        # after that is done we can return the total at needed_level.
-        if known_level == -1:
-            total = 0
-            total_quote = 0
+            return self.bids.get_total_up_to(price)
+
+    def add_grouped_view(self, group):
+        """return the GroupedView() for this bin width, it will be created
+        if nobody else is using it yet. It will be kept up to date until
+        remove_grouped_view() has been called as often as add_grouped_view()"""
+        view = self.grouped_views.get(group)
+        if view is None:
+            view = GroupedView(self, group)
+            self.signal_level_changed.connect(view.slot_level_changed)
+            self.signal_fulldepth_processed.connect(view.slot_fulldepth_processed)
+            self.grouped_views[group] = view
+        view.refcount += 1
+        return view
+
+    def remove_grouped_view(self, view):
+        """release a view obtained with add_grouped_view()"""
+        view.refcount -= 1
+        if view.refcount <= 0 and self.grouped_views.get(view.group) is view:
+            del self.grouped_views[view.group]
+            self.signal_level_changed.disconnect(view.slot_level_changed)
+            self.signal_fulldepth_processed.disconnect(view.slot_fulldepth_processed)
+
+    def get_price_for_volume(self, volume, is_ask):
+        """return the price that would be reached when consuming volume
+        (base currency) from the top of the asks (is_ask) or bids, this
+        is the price of the worst level a market order of that size would
+        touch. Returns None if the book has not enough volume."""
+        if is_ask:
+            return self.asks.get_price_for_volume(volume)
         else:
-            total = lst[known_level]._cache_total_vol
-            total_quote = lst[known_level]._cache_total_vol_quote
-
-        # mult_base = self.api.mult_base
-        for i in range(known_level, needed_level):
-            that = lst[i + 1]
-            total += that.volume
-            total_quote += that.volume * that.price  # / mult_base
-            that._cache_total_vol = total
-            that._cache_total_vol_quote = total_quote
+            return self.bids.get_price_for_volume(volume)
 
+    def get_vwap(self, volume, is_ask):
+        """return the volume weighted average price a market order of this
+        size (base currency) would get when filled against the asks (is_ask,
+        a buy) or the bids (a sell), None if the book has not enough volume"""
+        if volume <= 0:
+            return None
+        side = self.asks if is_ask else self.bids
+        result = side.get_cost(volume)
+        if result is None:
+            return None
+        return result[0] / volume
+
+    def get_slippage(self, volume, is_ask):
+        """return the relative difference between the vwap of a market
+        order of this size and the top of the book (0.001 means it would
+        cost 0.1% more than the best price), None if not enough volume"""
+        side = self.asks if is_ask else self.bids
+        vwap = self.get_vwap(volume, is_ask)
+        if vwap is None or not len(side):
+            return None
+        top = side.prices[0]
         if is_ask:
-            self._valid_ask_cache = needed_level
+            return (vwap - top) / top
         else:
-            self._valid_bid_cache = needed_level
+            return (top - vwap) / top
+
+    def get_volume_near_mid(self, percent):
+        """return the base volume that is available within percent (1 means
+        1%) of the mid price as tuple (bid_volume, ask_volume)"""
+        if not (len(self.bids) and len(self.asks)):
+            return (0, 0)
+        mid = (self.bids.prices[0] + self.asks.prices[0]) / 2
+        bid_volume = self.bids.get_total_up_to(mid * (1 - percent / 100.0))[0]
+        ask_volume = self.asks.get_total_up_to(mid * (1 + percent / 100.0))[0]
+        return (bid_volume, ask_volume)
+
+    def get_imbalance(self, depth=1):
+        """return the order book imbalance of the top depth levels on both
+        sides, between -1 (only asks) and 1 (only bids)"""
+        bid_volume = self.bids.get_volume_top(depth)
+        ask_volume = self.asks.get_volume_top(depth)
+        if not bid_volume + ask_volume:
+            return 0
+        return (bid_volume - ask_volume) / float(bid_volume + ask_volume)
 
-        return (total, total_quote)
+    def get_microprice(self, depth=1):
+        """return the micro price, the mid price weighted with the volume of
+        the top depth levels of the other side (the price moves towards the
+        side with less volume), None if one side of the book is empty"""
+        if not (len(self.bids) and len(self.asks)):
+            return None
+        bid_volume = self.bids.get_volume_top(depth)
+        ask_volume = self.asks.get_volume_top(depth)
+        bid = self.bids.prices[0]
+        ask = self.asks.prices[0]
+        if not bid_volume + ask_volume:
+            return (bid + ask) / 2
+        return (bid * ask_volume + ask * bid_volume) / (bid_volume + ask_volume)
+
+    def get_price_for_quote(self, quote, is_ask):
+        """like get_price_for_volume() but volume is given in quote currency"""
+        if is_ask:
+            return self.asks.get_price_for_volume(quote, True)
+        else:
+            return self.bids.get_price_for_volume(quote, True)
 
     def init_own(self, own_orders):
         """called by api when the initial order list is downloaded,
         this will happen after connect or reconnect"""
-        self.owns = []
+        self.owns.clear()
 
         # also reset the own volume cache in bids and ask list
-        for level in self.bids + self.asks:
-            level.own_volume = 0
+        self.bids.reset_own_volumes()
+        self.asks.reset_own_volumes()
 
         if own_orders:
             for order in own_orders:
@@ -1758,7 +4842,8 @@ class OrderBook(BaseObject):
         This is a separate method from _add_own because we additionally need
         to fire a bunch of signals when this happens"""
         if not self.have_own_oid(order.oid):
-            self.debug("### adding order:", order.typ, order.price, order.volume, order.oid)
+            self.log(LOG_ORDER, logging.DEBUG, "### adding order: %s %s %s %s",
+                     order.typ, order.price, order.volume, order.oid)
             self._add_own(order)
             self.signal_own_added(self, (order))
             self.signal_changed(self, None)
@@ -1768,7 +4853,7 @@ class OrderBook(BaseObject):
         """add order to the list of own orders. This method is used during
         initial download of complete order list."""
         if not self.have_own_oid(order.oid):
-            self.owns.append(order)
+            self.owns.add(order)
 
             # update own volume in that level:
             self._update_level_own_volume(
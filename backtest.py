@@ -0,0 +1,169 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+Headless backtest of strategy modules. It plays back a recording made with
+the record_feed option (or a trade tape) as fast as it can through the same
+Api, OrderBook and History the live application uses, the strategies are
+loaded with the same StrategyManager and their orders are filled by the
+simulated exchange in exchanges/backtest.py. At the end it prints the PnL,
+the fills and the latencies.
+
+$ ./backtest.py --feed pytrader.XETHXXBT.feed.gz --strategy balancer.py
+
+Latency, fees and starting balances are the backtest_* options in the
+[api] section of the ini file (default: backtest.ini).
+"""
+
+import argparse
+import locale
+import logging
+import traceback
+import api
+import strategy
+
+INI_DEFAULTS = [["pytrader", "exchange", "backtest"],
+                ["pytrader", "show_ticker", "False"],
+                ["pytrader", "show_depth", "False"],
+                ["pytrader", "show_trade", "False"],
+                ["pytrader", "show_trade_own", "True"],
+                ["pytrader", "log_level", "DEBUG"]]
+
+
+def slot_debug(sender, msg):
+    """log everything from instance.signal_debug, like the LogWriter of
+    the live application"""
+    name = "%s.%s" % (sender.__class__.__module__, sender.__class__.__name__)
+    logging.debug("%s:%s", name, msg)
+
+
+def format_report(instance):
+    """return the results of the finished backtest as a list of lines"""
+    client = instance.client
+    base = instance.curr_base
+    quote = instance.curr_quote
+    book = instance.orderbook
+    if book.bid and book.ask:
+        mark = (book.bid + book.ask) / 2
+    else:
+        mark = client.last_price
+
+    start = client.wallet_start
+    end = client.wallet
+    equity_start = start[quote] + start[base] * mark
+    equity_end = end[quote] + end[base] * mark
+
+    bought = sum(fill[4] for fill in client.fills if fill[2] == "bid")
+    sold = sum(fill[4] for fill in client.fills if fill[2] == "ask")
+    cost_bought = sum(fill[3] * fill[4] for fill in client.fills if fill[2] == "bid")
+    cost_sold = sum(fill[3] * fill[4] for fill in client.fills if fill[2] == "ask")
+    count_maker = sum(1 for fill in client.fills if fill[6])
+
+    lines = []
+    lines.append("PnL (marked at %s %s)" % (instance.fixed.format_price(mark), quote))
+    lines.append("    start        %16.8f %s %16.8f %s" % (start[base], base, start[quote], quote))
+    lines.append("    end          %16.8f %s %16.8f %s" % (end[base], base, end[quote], quote))
+    lines.append("    equity       %16.8f %s at start, %.8f at end" % (equity_start, quote, equity_end))
+    lines.append("    pnl          %16.8f %s against holding the start balances" % (
+        equity_end - equity_start, quote))
+    lines.append("    fees         %16.8f %s" % (client.total_fees, quote))
+
+    lines.append("Fills")
+    lines.append("    orders %i, canceled %i, still open %i" % (
+        client.count_orders, client.count_canceled, len(client.resting)))
+    lines.append("    fills %i (%i maker, %i taker)" % (
+        len(client.fills), count_maker, len(client.fills) - count_maker))
+    if bought:
+        lines.append("    bought %.8f %s at %.8f" % (bought, base, cost_bought / bought))
+    if sold:
+        lines.append("    sold   %.8f %s at %.8f" % (sold, base, cost_sold / sold))
+
+    lines.append("Latency (seconds)")
+    lines.append("    order to first fill (simulated) %s" % client.latency_fill.format())
+    lines.append("    order to filled (simulated)     %s" % client.latency_done.format())
+    lines.append("    event to order (strategy)       %s" % client.reaction.format())
+
+    lines.append("Speed")
+    lines.append("    %i events loaded in %.2f s, played back in %.2f s" % (
+        client.count_events, client.time_load, client.time_run))
+    if client.time_run > 0:
+        lines.append("    %.0f events/s, %.2f us per event" % (
+            client.count_events / client.time_run,
+            client.time_run * 1e6 / max(1, client.count_events)))
+    return lines
+
+
+def write_fills(instance, filename):
+    """write all fills into a csv file"""
+    with open(filename, "w") as file:
+        file.write("time,oid,type,price,volume,fee,maker\n")
+        for (tim, oid, typ, price, volume, fee, is_maker) in instance.client.fills:
+            file.write("%.3f,%s,%s,%s,%s,%.8f,%i\n" % (
+                tim, oid, typ, instance.fixed.format_price(price),
+                instance.fixed.format_volume(volume), fee, is_maker))
+
+
+def main():
+    """main funtion, called at the start of the program"""
+    for loc in ["en_US.UTF8", "en_GB.UTF8", "en_EN", "en_GB", "C"]:
+        try:
+            locale.setlocale(locale.LC_NUMERIC, loc)
+            break
+        except locale.Error:
+            continue
+
+    argp = argparse.ArgumentParser(
+        description='Backtest strategy modules on recorded market data')
+    argp.add_argument('--config',
+                      default="backtest.ini",
+                      help="Use different config file (default: %(default)s)")
+    argp.add_argument('--feed', action="store", required=True,
+                      help="recording (record_feed) or trade tape to play back")
+    argp.add_argument('--strategy', action="store", default="strategy.py",
+                      help="name of strategy module files, comma separated list (default: %(default)s)")
+    argp.add_argument('--fills', action="store", default="",
+                      help="also write all fills into this csv file")
+    args = argp.parse_args()
+
+    config = api.ApiConfig(args.config)
+    config.init_defaults(INI_DEFAULTS)
+    config.filename = args.config
+    config.set("pytrader", "exchange", "backtest")
+    config.set("api", "replay_file", args.feed)
+
+    logging.basicConfig(filename='%s.log' % config.filename[:-4],
+                        filemode='w',
+                        format='%(asctime)s:%(levelname)s:%(message)s',
+                        level=logging.DEBUG)
+    for option, category in [("show_ticker", api.LOG_TICK),
+                             ("show_depth", api.LOG_DEPTH),
+                             ("show_trade", api.LOG_TRADE),
+                             ("show_trade_own", api.LOG_TRADE_OWN)]:
+        api.BaseObject.set_log_category(category, config.get_bool("pytrader", option))
+    level = config.get_string("pytrader", "log_level").upper()
+    api.BaseObject.set_log_level(getattr(logging, level, logging.DEBUG))
+
+    instance = api.Api(api.Secret(config), config)
+    instance.signal_debug.connect(slot_debug)
+    strategy_manager = strategy.StrategyManager(instance, args.strategy.split(","))
+    if not strategy_manager.strategy_object_list:
+        print("no strategy could be loaded, see %s.log" % config.filename[:-4])
+        return
+
+    try:
+        instance.start()
+        instance.client.run()
+    except KeyboardInterrupt:
+        instance.client.stop()
+    except Exception:
+        print(traceback.format_exc())
+
+    strategy_manager.unload()
+    instance.stop()
+
+    for line in format_report(instance):
+        print(line)
+    if args.fills:
+        write_fills(instance, args.fills)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+plays back a synthetic recording (a full depth with 200 levels per side,
+then depth and trade messages 2:1) through the backtest client and a small
+strategy that cancels and places a few orders every 500 trades, once with
+the 4 default candle timeframes and once with only 1m candles. Prints the
+events per second and the number of fills.
+
+usage: python benchmarks/bench_backtest.py [num_events]
+"""
+
+import gzip
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import api
+import strategy
+
+STRATEGY = '''
+import strategy
+
+class Strategy(strategy.Strategy):
+    """every 500 trades cancel everything and buy at market or quote
+    both sides at the top of the book"""
+
+    def __init__(self, instance):
+        strategy.Strategy.__init__(self, instance)
+        self.count = 0
+
+    def slot_trade(self, instance, (date, price, volume, typ, own)):
+        self.count += 1
+        if self.count % 500 == 0:
+            book = instance.orderbook
+            instance.cancel_by_type()
+            if self.count % 1000 == 0:
+                instance.buy(book.bid, 0.3)
+                instance.sell(book.ask, 0.3)
+            else:
+                instance.buy(0, 0.1)
+'''
+
+
+def write_feed(filename, num_events):
+    """a recording in the format of api.FeedRecorder"""
+    rnd = random.Random(4)
+    date = time.time() - 86400
+    mid = 100.5
+    with gzip.open(filename, "wb") as file:
+        file.write(json.dumps({
+            "version": api.FeedRecorder.VERSION, "exchange": "kraken",
+            "curr_base": "XETH", "curr_quote": "XXBT",
+            "price_decimals": 5, "volume_decimals": 8, "time": date}) + "\n")
+        file.write(json.dumps([date, "connected", None]) + "\n")
+        file.write(json.dumps([date, "fulldepth", {"data": {
+            "asks": [{"price": 101 + i * 0.01, "amount": 1.0} for i in range(200)],
+            "bids": [{"price": 100 - i * 0.01, "amount": 1.0} for i in range(200)]}}]) + "\n")
+        for i in range(num_events):
+            date += 0.3
+            mid += rnd.gauss(0, 0.005)
+            if i % 3 == 0:
+                msg = {"op": "trade", "trade": {
+                    "id": i, "type": rnd.choice(["bid", "ask"]),
+                    "price": round(mid + rnd.gauss(0, 0.3), 2),
+                    "amount": 0.5, "timestamp": date}}
+            else:
+                typ = rnd.choice(["bid", "ask"])
+                if typ == "bid":
+                    price = round(mid - 0.25 - rnd.randint(0, 199) * 0.01, 2)
+                else:
+                    price = round(mid + 0.25 + rnd.randint(0, 199) * 0.01, 2)
+                msg = {"op": "depth", "depth": {
+                    "type": typ, "price": price,
+                    "volume": rnd.choice([0, 1.0, 2.0]), "timestamp": 0}}
+            file.write(json.dumps([date, "recv", msg]) + "\n")
+
+
+def run(directory, feed, timeframes):
+    """one backtest, return the client after it has finished"""
+    config = api.ApiConfig(os.path.join(directory, "bench.ini"))
+    config.init_defaults([["pytrader", "exchange", "backtest"]])
+    config.set("api", "replay_file", feed)
+    config.set("api", "history_timeframes", timeframes)
+    instance = api.Api(api.Secret(config), config)
+    manager = strategy.StrategyManager(instance, ["bench_strategy"])
+    instance.start()
+    instance.client.run()
+    manager.unload()
+    instance.stop()
+    return instance.client
+
+
+def main():
+    """main function, called at the start of the program"""
+    num_events = int(sys.argv[1]) if len(sys.argv) > 1 else 300000
+    for category in (api.LOG_TICK, api.LOG_DEPTH, api.LOG_TRADE):
+        api.BaseObject.set_log_category(category, False)
+
+    directory = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(directory, "bench_strategy.py"), "w") as file:
+            file.write(STRATEGY)
+        sys.path.insert(0, directory)
+        feed = os.path.join(directory, "feed.gz")
+        write_feed(feed, num_events)
+        print("%i events" % num_events)
+        for timeframes in ["1,15,60,240", "1"]:
+            client = run(directory, feed, timeframes)
+            print("timeframes %-12s %8.0f events/s %6.2f us per event, %i fills" % (
+                timeframes,
+                client.count_events / client.time_run,
+                client.time_run * 1e6 / client.count_events,
+                len(client.fills)))
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+turns a synthetic Kraken trade history download (10k, 100k and 1M trades
+within two days) into candles of 1m, 15m, 1h and 4h, once the old way (a
+dict per trade, then one Python loop over all trades with an OHLCV() per
+candle for every timeframe) and once the new way (trades parsed into
+TradeColumns, one CandleEngine grouping slices of the arrays). Checks that
+both produce the same candles and prints the time for parsing and for
+making the candles.
+
+usage: python benchmarks/bench_fullhistory.py [max_trades]
+"""
+
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import api
+
+TIMEFRAMES = [60, 900, 3600, 14400]
+
+
+class FakeApi():
+    """just enough of Api() to create a CandleEngine()"""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.signal_trade = api.Signal()
+        self.signal_fullhistory = api.Signal()
+        self.fixed = api.FixedPoint(5, 8)
+
+
+def make_raw(num_trades):
+    """the "result" list of a Kraken Trades response"""
+    rnd = random.Random(3)
+    date = time.time() - 172800
+    step = 172800.0 / num_trades
+    price = 0.03
+    raw = []
+    for _ in range(num_trades):
+        date += rnd.uniform(0, 2 * step)
+        price = max(0.001, price + rnd.gauss(0, 0.00002))
+        raw.append(["%.5f" % price, "%.8f" % rnd.uniform(0.01, 20),
+                    round(date, 4), rnd.choice("bs"), "l", ""])
+    return raw
+
+
+def parse_old(raw, fixed):
+    """the old list of dicts"""
+    history = []
+    for h in raw:
+        history.append({
+            'price': fixed.round_price(float(h[0])),
+            'amount': fixed.round_volume(float(h[1])),
+            'date': h[2]
+        })
+    return history
+
+
+def parse_new(raw, fixed):
+    """straight into TradeColumns"""
+    round_price = fixed.round_price
+    round_volume = fixed.round_volume
+    return api.TradeColumns(
+        [h[2] for h in raw],
+        [round_price(float(h[0])) for h in raw],
+        [round_volume(float(h[1])) for h in raw])
+
+
+def candles_old(history, timeframe):
+    """the old History.slot_fullhistory() loop (without counting the
+    first trade of a candle twice), returns a list of tuples"""
+    candles = []
+    new_candle = api.OHLCV(0, 0, 0, 0, 0, 0)
+    for trade in history:
+        date = trade["date"]
+        price = trade["price"]
+        volume = trade["amount"]
+        time_round = int(date / timeframe) * timeframe
+        if time_round > new_candle.tim:
+            if new_candle.tim > 0:
+                candles.append(new_candle)
+            new_candle = api.OHLCV(time_round, price, price, price, price, 0)
+        new_candle.update(price, volume)
+    candles.append(new_candle)
+    return [(c.tim, c.opn, c.hig, c.low, c.cls, c.vol) for c in candles]
+
+
+def candles_new(trades):
+    """CandleEngine, returns {timeframe: list of tuples}"""
+    fake = FakeApi()
+    engine = api.CandleEngine(fake, TIMEFRAMES, 10000)
+    fake.signal_fullhistory(None, trades)
+    result = {}
+    for timeframe in TIMEFRAMES:
+        result[timeframe] = list(reversed(
+            [(c.tim, c.opn, c.hig, c.low, c.cls, c.vol) for c in engine.get_store(timeframe)]))
+    return result
+
+
+def same(old, new):
+    """compare two lists of candle tuples"""
+    return len(old) == len(new) and all(
+        abs(a - b) <= 1e-9 * max(1, abs(a)) for (x, y) in zip(old, new) for (a, b) in zip(x, y))
+
+
+def main():
+    """run it for 10k, 100k and 1M trades"""
+    max_trades = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    fixed = api.FixedPoint(5, 8)
+    for num_trades in [10000, 100000, 1000000]:
+        if num_trades > max_trades:
+            break
+        raw = make_raw(num_trades)
+
+        time_start = time.time()
+        history = parse_old(raw, fixed)
+        time_parse_old = time.time() - time_start
+        time_start = time.time()
+        old = dict((timeframe, candles_old(history, timeframe)) for timeframe in TIMEFRAMES)
+        time_old = time.time() - time_start
+
+        time_start = time.time()
+        trades = parse_new(raw, fixed)
+        time_parse_new = time.time() - time_start
+        time_start = time.time()
+        new = candles_new(trades)
+        time_new = time.time() - time_start
+
+        print("%i trades, %i 1m candles, results identical: %s" % (
+            num_trades, len(new[60]), all(same(old[tf], new[tf]) for tf in TIMEFRAMES)))
+        print("    list of dicts, loop per timeframe: parse %7.3f s   candles %7.3f s" % (
+            time_parse_old, time_old))
+        print("    TradeColumns, CandleEngine:        parse %7.3f s   candles %7.3f s" % (
+            time_parse_new, time_new))
+
+
+if __name__ == "__main__":
+    main()
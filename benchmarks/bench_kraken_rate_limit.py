@@ -0,0 +1,229 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+runs the Kraken PollClient against a local mock server that enforces the
+call counter (and the separate order counter) the same way Kraken does and
+that rejects every nonce that is not strictly increasing. A burst of order
+adds and cancels is sent together with the regular balance, volume and
+order polling, it measures how long it takes until all orders have been
+answered and counts the rejected calls (there should be none).
+
+After that it keeps polling balance and open orders far more often than
+the counter allows for a few seconds, the client must throttle itself.
+
+usage: python benchmarks/bench_kraken_rate_limit.py [num_orders] [poll_seconds]
+"""
+
+import BaseHTTPServer
+import SocketServer
+import base64
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import urlparse
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, "exchanges"))
+import api
+import kraken
+
+CALL_LIMIT = 15
+CALL_DECAY = 0.33
+ORDER_LIMIT = 60
+ORDER_DECAY = 1.0
+
+
+class Counter():
+    """the server side of Kraken's call counter"""
+
+    def __init__(self, limit, decay):
+        self.limit = limit
+        self.decay = decay
+        self.value = 0.0
+        self.time = time.time()
+
+    def add(self, cost):
+        """return False if this call would exceed the limit"""
+        now = time.time()
+        self.value = max(0, self.value - (now - self.time) * self.decay)
+        self.time = now
+        if self.value + cost > self.limit:
+            return False
+        self.value += cost
+        return True
+
+
+class MockKraken():
+    """state of the mock server"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = Counter(CALL_LIMIT, CALL_DECAY)
+        self.orders = Counter(ORDER_LIMIT, ORDER_DECAY)
+        self.last_nonce = 0
+        self.count_calls = {}
+        self.count_rate_limited = 0
+        self.count_bad_nonce = 0
+        self.next_txid = 0
+
+    def private(self, endpoint, params):
+        """handle one private call, return the answer dict"""
+        with self.lock:
+            self.count_calls[endpoint] = self.count_calls.get(endpoint, 0) + 1
+            nonce = int(params["nonce"][0])
+            if nonce <= self.last_nonce:
+                self.count_bad_nonce += 1
+                return {"error": ["EAPI:Invalid nonce"]}
+            self.last_nonce = nonce
+            if endpoint in ["AddOrder", "CancelOrder"]:
+                if not self.orders.add(1):
+                    self.count_rate_limited += 1
+                    return {"error": ["EOrder:Rate limit exceeded"]}
+            elif not self.calls.add(kraken.CALL_COST.get("private/" + endpoint, 1)):
+                self.count_rate_limited += 1
+                return {"error": ["EAPI:Rate limit exceeded"]}
+            if endpoint == "AddOrder":
+                self.next_txid += 1
+                return {"error": [], "result": {"txid": ["T%i" % self.next_txid]}}
+            if endpoint == "CancelOrder":
+                return {"error": [], "result": {"count": 1}}
+            if endpoint == "OpenOrders":
+                return {"error": [], "result": {"open": {}}}
+            if endpoint == "TradeVolume":
+                return {"error": [], "result": {
+                    "volume": "0", "currency": "ZUSD",
+                    "fees_maker": {kraken_pair(): {"fee": "0.16"}}}}
+            return {"error": [], "result": {}}
+
+
+MOCK = MockKraken()
+
+
+def kraken_pair():
+    """the pair we are trading in this benchmark"""
+    return "XETHXXBT"
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """the http side of the mock server"""
+
+    protocol_version = "HTTP/1.1"
+    wbufsize = -1
+
+    def log_message(self, *args):
+        """be quiet"""
+        pass
+
+    def do_GET(self):
+        """public calls are not needed here"""
+        self.reply({"error": ["EGeneral:Unknown method"]})
+
+    def do_POST(self):
+        """private calls"""
+        length = int(self.headers.get("Content-Length", 0))
+        params = urlparse.parse_qs(self.rfile.read(length))
+        endpoint = self.path.split("/")[-1]
+        self.reply(MOCK.private(endpoint, params))
+
+    def reply(self, answer):
+        """send the json answer"""
+        body = json.dumps(answer)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.wfile.flush()
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """threaded mock server"""
+    daemon_threads = True
+
+
+class FakeSecret():
+    """just enough of api.Secret to sign requests"""
+
+    key = "key"
+    secret = base64.b64encode("secret")
+
+    def know_secret(self):
+        """we always know it"""
+        return True
+
+
+def main():
+    """start the server and the client and send a burst of orders"""
+    num_orders = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    poll_seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 10
+
+    server = Server(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever).start()
+    kraken.HTTP_HOST = "127.0.0.1:%i" % server.server_address[1]
+
+    config = api.ApiConfig(os.path.join(tempfile.mkdtemp(), "bench.ini"))
+    config.set("api", "use_ssl", "False")
+    config.set("api", "load_fulldepth", "False")
+    config.set("api", "load_history", "False")
+    config.set("api", "kraken_call_limit", str(CALL_LIMIT))
+    config.set("api", "kraken_call_decay", str(CALL_DECAY))
+    config.set("api", "kraken_order_limit", str(ORDER_LIMIT))
+    config.set("api", "kraken_order_decay", str(ORDER_DECAY))
+
+    client = kraken.PollClient("XETH", "XXBT", FakeSecret(), config)
+    answered = []
+    done = threading.Event()
+
+    def slot_recv(_sender, data):
+        """count the answers to our orders"""
+        msg = json.loads(data)
+        if msg["id"].startswith("order_"):
+            answered.append(msg)
+            if len(answered) == num_orders:
+                done.set()
+
+    client.signal_recv.connect(slot_recv)
+    client.start()
+
+    time_start = time.time()
+    for i in range(num_orders):
+        # make the polling compete with the orders
+        client.request_info()
+        client.request_orders()
+        client.request_volume()
+        if i % 2:
+            client.send_order_cancel("T%i" % i)
+        else:
+            client.send_order_add("bid", 0.01 + i * 0.0001, 1)
+    done.wait(120)
+    duration = time.time() - time_start
+
+    # now keep on polling much faster than the call counter allows
+    time_end = time.time() + poll_seconds
+    while time.time() < time_end:
+        client.request_info()
+        client.request_orders()
+        time.sleep(0.05)
+    client.http_requests.join()
+
+    client.stop()
+    server.shutdown()
+    errors = [msg for msg in answered if msg["op"] != "result"]
+    print("%i orders answered in %.2f s (old fixed 3 s pause: at least %i s)" % (
+        len(answered), duration, 3 * num_orders))
+    print("orders with errors: %i" % len(errors))
+    print("calls: %s" % ", ".join("%s %i" % item for item in sorted(MOCK.count_calls.items())))
+    print("rejected by server: rate limit %i, nonce %i" % (
+        MOCK.count_rate_limited, MOCK.count_bad_nonce))
+    print("client waited for the call counter %i times, %.2f s in total" % (
+        client._call_limiter.count_waits, client._call_limiter.time_waited))
+    server.server_close()
+    time.sleep(0.5)
+
+
+if __name__ == "__main__":
+    main()
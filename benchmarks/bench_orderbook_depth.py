@@ -0,0 +1,234 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+replays a synthetic depth stream (random walk of the mid price, most updates
+near the top of the book, levels appearing and disappearing) against the
+OrderBook and against a copy of the old list-of-Level() implementation,
+with a depth chart style get_total_up_to() query every 50 updates. Checks
+that both end up with the same results and prints updates/s and the memory
+used per level.
+
+usage: python benchmarks/bench_orderbook_depth.py [num_updates] [num_levels]
+"""
+
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import api
+
+TICK = 0.00001
+
+
+class OldLevel:
+    """the old Level() class"""
+    def __init__(self, price, volume):
+        self.price = price
+        self.volume = volume
+        self.own_volume = 0
+        self._cache_total_vol = 0
+        self._cache_total_vol_quote = 0
+
+
+class OldBook():
+    """the relevant parts of the old list based OrderBook"""
+
+    def __init__(self):
+        self.bids = []
+        self.asks = []
+        self.bid = 0
+        self.ask = 0
+        self.total_bid = 0
+        self.total_ask = 0
+        self._valid_bid_cache = -1
+        self._valid_ask_cache = -1
+
+    def _find_level(self, typ, price):
+        """old hand rolled binary search"""
+        lst = {"ask": self.asks, "bid": self.bids}[typ]
+        comp = {"ask": lambda x, y: x < y, "bid": lambda x, y: x > y}[typ]
+        low = 0
+        high = len(lst)
+        while low < high:
+            mid = (low + high) // 2
+            midval = lst[mid].price
+            if comp(midval, price):
+                low = mid + 1
+            elif comp(price, midval):
+                high = mid
+            else:
+                return (lst, mid, lst[mid])
+        return (lst, high, None)
+
+    def _update_book(self, typ, price, total_vol):
+        """old _update_book()"""
+        (lst, index, level) = self._find_level(typ, price)
+        if total_vol == 0:
+            if level is None:
+                return False
+            else:
+                voldiff = -level.volume
+                lst.pop(index)
+        else:
+            if level is None:
+                voldiff = total_vol
+                level = OldLevel(price, total_vol)
+                lst.insert(index, level)
+            else:
+                voldiff = total_vol - level.volume
+                if voldiff == 0:
+                    return False
+                level.volume = total_vol
+        if typ == "ask":
+            self.total_ask += voldiff
+            if len(self.asks):
+                self.ask = self.asks[0].price
+            self._valid_ask_cache = min(self._valid_ask_cache, index - 1)
+        else:
+            self.total_bid += voldiff * price
+            if len(self.bids):
+                self.bid = self.bids[0].price
+            self._valid_bid_cache = min(self._valid_bid_cache, index - 1)
+        return True
+
+    def get_total_up_to(self, price, is_ask):
+        """old get_total_up_to()"""
+        if is_ask:
+            lst = self.asks
+            known_level = self._valid_ask_cache
+            comp = lambda x, y: x < y
+        else:
+            lst = self.bids
+            known_level = self._valid_bid_cache
+            comp = lambda x, y: x > y
+        low = 0
+        high = len(lst)
+        while low < high:
+            mid = (low + high) // 2
+            midval = lst[mid].price
+            if comp(midval, price):
+                low = mid + 1
+            elif comp(price, midval):
+                high = mid
+            else:
+                break
+        if comp(price, midval):
+            needed_level = mid - 1
+        else:
+            needed_level = mid
+        if needed_level <= known_level:
+            lvl = lst[needed_level]
+            return (lvl._cache_total_vol, lvl._cache_total_vol_quote)
+        if known_level == -1:
+            total = 0
+            total_quote = 0
+        else:
+            total = lst[known_level]._cache_total_vol
+            total_quote = lst[known_level]._cache_total_vol_quote
+        for i in range(known_level, needed_level):
+            that = lst[i + 1]
+            total += that.volume
+            total_quote += that.volume * that.price
+            that._cache_total_vol = total
+            that._cache_total_vol_quote = total_quote
+        if is_ask:
+            self._valid_ask_cache = needed_level
+        else:
+            self._valid_bid_cache = needed_level
+        return (total, total_quote)
+
+
+class FakeApi():
+    """just enough of Api() to create an OrderBook()"""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.signal_ticker = api.Signal()
+        self.signal_depth = api.Signal()
+        self.signal_trade = api.Signal()
+        self.signal_userorder = api.Signal()
+        self.signal_fulldepth = api.Signal()
+        self.fixed = api.FixedPoint(5, 8)
+
+
+def make_stream(num_updates, num_levels):
+    """return a list of (typ, price, volume) depth messages and the
+    prices used for the queries"""
+    rnd = random.Random(42)
+    mid = 0.03
+    stream = []
+    for _ in range(num_updates):
+        mid += rnd.choice([-1, 0, 1]) * TICK
+        typ = rnd.choice(["bid", "ask"])
+        # most of the activity happens close to the top of the book
+        distance = int(rnd.expovariate(1.0 / (num_levels / 8.0))) % num_levels + 1
+        if typ == "bid":
+            price = round(mid - distance * TICK, 5)
+        else:
+            price = round(mid + distance * TICK, 5)
+        volume = 0 if rnd.random() < 0.3 else round(rnd.uniform(0.1, 50), 3)
+        stream.append((typ, price, volume))
+    return (stream, mid)
+
+
+def replay(book, stream, mid, num_levels):
+    """apply the stream, return (seconds, results)"""
+    results = []
+    time_start = time.time()
+    for (i, (typ, price, volume)) in enumerate(stream):
+        book._update_book(typ, price, volume)
+        if i % 50 == 0 and len(book.asks) and len(book.bids):
+            # like a depth chart paint: totals at several distances
+            for distance in [2, 10, 50, num_levels / 2]:
+                results.append(book.get_total_up_to(round(mid + distance * TICK, 5), True))
+                results.append(book.get_total_up_to(round(mid - distance * TICK, 5), False))
+    duration = time.time() - time_start
+    results.append((book.bid, book.ask, book.total_bid, book.total_ask))
+    return (duration, results)
+
+
+def size_of_old(book):
+    """rough memory usage of the old book in bytes"""
+    size = sys.getsizeof(book.bids) + sys.getsizeof(book.asks)
+    for level in book.bids + book.asks:
+        size += sys.getsizeof(level) + sys.getsizeof(level.__dict__)
+        size += sys.getsizeof(level.price) + sys.getsizeof(level.volume)
+    return size
+
+
+def size_of_new(book):
+    """rough memory usage of the new book in bytes"""
+    size = 0
+    for side in [book.bids, book.asks]:
+        for arr in vars(side).values():
+            size += sys.getsizeof(arr)
+    return size
+
+
+def main():
+    """run both and compare"""
+    num_updates = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+    num_levels = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+    (stream, mid) = make_stream(num_updates, num_levels)
+
+    old = OldBook()
+    (time_old, results_old) = replay(old, stream, mid, num_levels)
+    new = api.OrderBook(FakeApi())
+    (time_new, results_new) = replay(new, stream, mid, num_levels)
+
+    same = len(results_old) == len(results_new) and all(
+        abs(a - b) < 1e-6 for (x, y) in zip(results_old, results_new) for (a, b) in zip(x, y))
+    levels = len(new.bids) + len(new.asks)
+    print("%i updates, %i levels in the book at the end, results identical: %s" % (
+        num_updates, levels, same))
+    print("old list of Level(): %8.0f updates/s, %5.0f bytes/level" % (
+        num_updates / time_old, size_of_old(old) / float(levels)))
+    print("new BookSide arrays: %8.0f updates/s, %5.0f bytes/level" % (
+        num_updates / time_new, size_of_new(new) / float(levels)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+measures the market impact queries of the OrderBook (vwap, slippage, volume
+near mid, microprice, imbalance) on books with 100 to 10000 levels per side
+while the book is being updated between the queries, and compares them with
+a straightforward linear scan over the levels (also used to check results).
+The vwap is also measured with a level at a price that was never in the
+book inserted (or one removed) before each query.
+
+usage: python benchmarks/bench_orderbook_queries.py [num_queries]
+"""
+
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import api
+
+TICK = 0.00001
+
+
+class FakeApi():
+    """just enough of Api() to create an OrderBook()"""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.signal_ticker = api.Signal()
+        self.signal_depth = api.Signal()
+        self.signal_trade = api.Signal()
+        self.signal_userorder = api.Signal()
+        self.signal_fulldepth = api.Signal()
+        self.fixed = api.FixedPoint(5, 8)
+
+
+def scan_vwap(side, volume):
+    """vwap by walking through the levels"""
+    left = volume
+    cost = 0
+    for (price, vol) in zip(side.prices, side.volumes):
+        take = min(left, vol)
+        cost += take * price
+        left -= take
+        if left <= 0:
+            return cost / volume
+    return None
+
+
+def scan_near_mid(book, percent):
+    """volume near mid by walking through the levels"""
+    mid = (book.bids.prices[0] + book.asks.prices[0]) / 2
+    bid_volume = sum(v for (p, v) in zip(book.bids.prices, book.bids.volumes)
+                     if p >= mid * (1 - percent / 100.0))
+    ask_volume = sum(v for (p, v) in zip(book.asks.prices, book.asks.volumes)
+                     if p <= mid * (1 + percent / 100.0))
+    return (bid_volume, ask_volume)
+
+
+def make_book(num_levels, rnd, spacing=1):
+    """an OrderBook with num_levels on each side around 0.03, spacing
+    ticks apart"""
+    book = api.OrderBook(FakeApi())
+    mid = 0.03
+    book.slot_fulldepth(None, {"data": {
+        "asks": [{"price": round(mid + (i + 1) * spacing * TICK, 5), "amount": rnd.uniform(0.1, 50)}
+                 for i in range(num_levels)],
+        "bids": [{"price": round(mid - (num_levels - i) * spacing * TICK, 5), "amount": rnd.uniform(0.1, 50)}
+                 for i in range(num_levels)]}})
+    return book
+
+
+def random_update(book, num_levels, rnd):
+    """change the volume of a random level near the top"""
+    typ = rnd.choice(["bid", "ask"])
+    distance = min(int(rnd.expovariate(0.05)) + 1, num_levels)
+    if typ == "bid":
+        price = round(0.03 - distance * TICK, 5)
+    else:
+        price = round(0.03 + distance * TICK, 5)
+    book._update_book(typ, price, rnd.uniform(0.1, 50))
+
+
+def random_new_level(book, num_levels, rnd):
+    """insert an ask between two levels (the book has a gap at every odd
+    tick) or remove one, near the top"""
+    distance = min(int(rnd.expovariate(0.05)) + 1, num_levels)
+    if rnd.random() < 0.7:
+        price = round(0.03 + (2 * distance - 1) * TICK, 5)
+    else:
+        price = round(0.03 + 2 * distance * TICK, 5)
+    book._update_book("ask", price, rnd.uniform(0.1, 50) if rnd.random() < 0.7 else 0)
+
+
+def measure_new_levels(num_levels, num_queries):
+    """(name, us_per_query_book, us_per_query_scan) of the vwap with a
+    new level before every query"""
+    rnd = random.Random(8)
+    book = make_book(num_levels, rnd, 2)
+    total = sum(book.asks.volumes)
+    volumes = [rnd.uniform(0, total * 0.9) for _ in range(num_queries)]
+    time_book = 0
+    time_scan = 0
+    for volume in volumes:
+        random_new_level(book, num_levels, rnd)
+        time_start = time.time()
+        a = book.get_vwap(volume, True)
+        time_book += time.time() - time_start
+        time_start = time.time()
+        b = scan_vwap(book.asks, volume)
+        time_scan += time.time() - time_start
+        assert abs(a - b) < 1e-9, (a, b)
+    return ("vwap, new price level", time_book * 1e6 / num_queries, time_scan * 1e6 / num_queries)
+
+
+def measure(num_levels, num_queries):
+    """return a list of (name, us_per_query_book, us_per_query_scan)"""
+    rnd = random.Random(7)
+    book = make_book(num_levels, rnd)
+    total = sum(book.asks.volumes)
+    volumes = [rnd.uniform(0, total * 0.9) for _ in range(num_queries)]
+    results = []
+
+    def timed(func):
+        """run func(volume) once per query with an update before each"""
+        time_start = time.time()
+        out = []
+        for volume in volumes:
+            random_update(book, num_levels, rnd)
+            out.append(func(volume))
+        return ((time.time() - time_start) * 1e6 / num_queries, out)
+
+    (t_book, res_book) = timed(lambda v: book.get_vwap(v, True))
+    (t_scan, res_scan) = timed(lambda v: scan_vwap(book.asks, v))
+    results.append(("vwap", t_book, t_scan))
+    (t_book, _) = timed(lambda v: book.get_slippage(v, False))
+    results.append(("slippage", t_book, t_scan))
+    (t_book, _) = timed(lambda v: book.get_volume_near_mid(1))
+    (t_scan, _) = timed(lambda v: scan_near_mid(book, 1))
+    results.append(("volume within 1% of mid", t_book, t_scan))
+    (t_book, _) = timed(lambda v: book.get_microprice(10))
+    results.append(("microprice depth 10", t_book, None))
+    (t_book, _) = timed(lambda v: book.get_imbalance(10))
+    results.append(("imbalance depth 10", t_book, None))
+
+    # check the results on the final state of the book
+    for volume in volumes[:100]:
+        (a, b) = (book.get_vwap(volume, True), scan_vwap(book.asks, volume))
+        assert abs(a - b) < 1e-9, (a, b)
+    for (a, b) in zip(book.get_volume_near_mid(1), scan_near_mid(book, 1)):
+        assert abs(a - b) < 1e-6, (a, b)
+    results.append(measure_new_levels(num_levels, num_queries))
+    return results
+
+
+def main():
+    """run it for different book sizes"""
+    num_queries = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    for num_levels in [100, 1000, 10000]:
+        print("%i levels per side (us per query, each after one book update)" % num_levels)
+        for (name, t_book, t_scan) in measure(num_levels, num_queries):
+            if t_scan is None:
+                print("    %-26s %8.1f" % (name, t_book))
+            else:
+                print("    %-26s %8.1f   linear scan %8.1f" % (name, t_book, t_scan))
+
+
+if __name__ == "__main__":
+    main()
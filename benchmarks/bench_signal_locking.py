@@ -0,0 +1,71 @@
+#!/usr/bin/env python2
+# -*- coding: utf-8 -*-
+"""
+contention benchmark for the signal locks. Several feed threads are
+emitting their own signals at the same time, the slots simulate a bit of
+processing and a short blocking operation (like a curses repaint that has
+to wait for the terminal). This is run twice: once with all signals sharing
+one global lock (the way it used to be) and once with a lock per signal.
+
+usage: python benchmarks/bench_signal_locking.py [threads] [seconds]
+"""
+
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import api
+
+
+class Feed():
+    """one feed thread emitting its own signal as fast as it can"""
+
+    def __init__(self, lock):
+        self.signal = api.Signal(lock)
+        self.signal.connect(self.slot)
+        self.count = 0
+        self.running = True
+        self.thread = None
+
+    def slot(self, _sender, data):
+        """simulate some processing and a short blocking call"""
+        total = 0
+        for i in range(data):
+            total += i
+        time.sleep(0.0001)
+
+    def run(self):
+        """emit the signal until stopped"""
+        while self.running:
+            self.signal(self, 50)
+            self.count += 1
+
+
+def measure(num_threads, seconds, shared_lock):
+    """run num_threads feeds for the given time, return emissions/sec"""
+    feeds = [Feed(shared_lock) for _ in range(num_threads)]
+    for feed in feeds:
+        feed.thread = api.start_thread(feed.run, "feed")
+    time.sleep(seconds)
+    for feed in feeds:
+        feed.running = False
+    for feed in feeds:
+        feed.thread.join()
+    return sum(feed.count for feed in feeds) / float(seconds)
+
+
+def main():
+    """run the benchmark for both locking models"""
+    num_threads = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    seconds = float(sys.argv[2]) if len(sys.argv) > 2 else 2
+    for threads in range(1, num_threads + 1):
+        glob = measure(threads, seconds, threading.RLock())
+        own = measure(threads, seconds, None)
+        print("%2d feed thread(s): global lock %9.0f emit/s, per-signal lock %9.0f emit/s (x%.2f)"
+              % (threads, glob, own, own / glob))
+
+
+if __name__ == "__main__":
+    main()
@@ -26,7 +26,9 @@ import curses
 import curses.panel
 import curses.textpad
 import api
+import strategy
 import logging
+import itertools
 import locale
 import math
 import os
@@ -75,15 +77,18 @@ INI_DEFAULTS = [["pytrader", "exchange", "kraken"],
                 ["pytrader", "dont_truncate_logfile", "False"],
                 ["pytrader", "show_orderbook_stats", "True"],
                 ["pytrader", "highlight_changes", "True"],
+                ["pytrader", "max_repaint_rate", "20"],
                 ["pytrader", "orderbook_group", "0"],
                 ["pytrader", "orderbook_sum_total", "False"],
                 ["pytrader", "display_right", "history_chart"],
+                ["pytrader", "chart_timeframe", "0"],
                 ["pytrader", "depth_chart_group", "0.00001"],
                 ["pytrader", "depth_chart_sum_total", "True"],
                 ["pytrader", "show_ticker", "True"],
                 ["pytrader", "show_depth", "True"],
                 ["pytrader", "show_trade", "True"],
-                ["pytrader", "show_trade_own", "True"]]
+                ["pytrader", "show_trade_own", "True"],
+                ["pytrader", "log_level", "DEBUG"]]
 
 COLOR_PAIR = {}
 
@@ -120,26 +125,40 @@ def dump_all_stacks():
 def try_get_lock_or_break_open():
     """this is an ugly hack to workaround possible deadlock problems.
     It is used during shutdown to make sure we can properly exit even when
-    some slot is stuck (due to a programming error) and won't release the lock.
-    If we can't acquire it within 5 seconds we just break it open forcefully."""
+    some slot is stuck (due to a programming error) and won't release a lock.
+    We try to acquire all signal locks and the curses lock, if we can't get
+    all of them within 5 seconds we just break the remaining ones open."""
+    locks = api.Signal.get_locks()
     time_end = time.time() + 5
-    while time.time() < time_end:
-        if api.Signal._lock.acquire(False):
+    while True:
+        locks = [lock for lock in locks if not lock.acquire(False)]
+        if not locks and Win._lock.acquire(False):
             return
+        if time.time() > time_end:
+            break
         time.sleep(0.001)
 
-    # something keeps holding the lock, apparently some slot is stuck
+    # something keeps holding a lock, apparently some slot is stuck
     # in an infinite loop. In order to be able to shut down anyways
-    # we just throw away that lock and replace it with a new one
-    lock = threading.RLock()
-    lock.acquire()
-    api.Signal._lock = lock
+    # we just throw away these locks and replace them with new ones
+    for stuck_lock in locks:
+        lock = threading.RLock()
+        lock.acquire()
+        api.Signal.replace_lock(stuck_lock, lock)
+    if not Win._lock.acquire(False):
+        lock = threading.RLock()
+        lock.acquire()
+        Win._lock = lock
     print ("### could not acquire signal lock frozen slot somewhere")
     print ("### please see the stacktrace log to determine the cause.")
 
 class Win:
     """represents a curses window"""
 
+    # curses is not thread safe and signals are no longer all serialized by
+    # one global lock, so all painting to the screen is done with this lock
+    _lock = threading.RLock()
+
     def __init__(self, stdscr):
         """create and initialize the window. This will also subsequently
         call the paint() method."""
@@ -152,6 +171,7 @@ class Win:
         self.termheight = 10
         self.win = None
         self.panel = None
+        self.grouped_view = None
         self.__create_win()
 
     def __del__(self):
@@ -167,10 +187,11 @@ class Win:
 
     def do_paint(self):
         """call this if you want the window to repaint itself"""
-        curses.curs_set(0)
-        if self.win:
-            self.paint()
-            self.done_paint()
+        with Win._lock:
+            curses.curs_set(0)
+            if self.win:
+                self.paint()
+                self.done_paint()
 
     # method could be a function
     def done_paint(self):
@@ -188,6 +209,18 @@ class Win:
         your data has changed and must be displayed"""
         pass
 
+    def get_grouped_view(self, book, group):
+        """return the GroupedView() of the book for this bin width, the view
+        used for the previous paint is released if the width has changed.
+        Call it with group None to release it when no grouping is needed"""
+        view = self.grouped_view
+        if view is not None and view.group != group:
+            book.remove_grouped_view(view)
+            view = self.grouped_view = None
+        if view is None and group is not None:
+            view = self.grouped_view = book.add_grouped_view(group)
+        return view
+
     def resize(self):
         """You must call this method from your main loop when the
         terminal has been resized. It will subsequently make it
@@ -294,29 +327,16 @@ class WinConsole(Win):
         if not self.win:
             return
 
-        # This code would break if the format of
-        # the log messages would ever change!
-        if " tick:" in txt:
-            if not self.instance.config.get_bool("pytrader", "show_ticker"):
-                return
-        if "depth:" in txt:
-            if not self.instance.config.get_bool("pytrader", "show_depth"):
-                return
-        if "trade:" in txt:
-            if "own order" in txt:
-                if not self.instance.config.get_bool("pytrader", "show_trade_own"):
-                    return
-            else:
-                if not self.instance.config.get_bool("pytrader", "show_trade"):
-                    return
-
+        # show_ticker, show_depth, etc. are handled by the log categories,
+        # see apply_log_settings(), unwanted messages never arrive here.
         col = COLOR_PAIR["con_text"]
         if "trade: bid:" in txt:
             col = COLOR_PAIR["con_text_buy"] + curses.A_BOLD
         if "trade: ask:" in txt:
             col = COLOR_PAIR["con_text_sell"] + curses.A_BOLD
-        self.win.addstr("\n" + txt.encode('utf-8'), col)
-        self.done_paint()
+        with Win._lock:
+            self.win.addstr("\n" + txt.encode('utf-8'), col)
+            self.done_paint()
 
 class PluginConsole(Win):
     """The console window at the bottom"""
@@ -355,9 +375,10 @@ class PluginConsole(Win):
 
     def write(self, txt):
         """write a line of text, scroll if needed"""
-        self.win.addstr("\n ", COLOR_PAIR["con_separator"])
-        self.win.addstr(txt, COLOR_PAIR["con_text"])
-        self.done_paint()
+        with Win._lock:
+            self.win.addstr("\n ", COLOR_PAIR["con_separator"])
+            self.win.addstr(txt, COLOR_PAIR["con_text"])
+            self.done_paint()
 
 
 class WinOrderBook(Win):
@@ -367,7 +388,8 @@ class WinOrderBook(Win):
         """create the orderbook window and connect it to the
         onChanged callback of the instance.orderbook instance"""
         self.instance = instance
-        instance.orderbook.signal_changed.connect(self.slot_changed)
+        rate = instance.config.get_float("pytrader", "max_repaint_rate")
+        instance.orderbook.signal_changed.connect(self.slot_changed, max_rate=rate)
         Win.__init__(self, stdscr)
 
     def calc_size(self):
@@ -408,6 +430,8 @@ class WinOrderBook(Win):
         group = instance.config.get_float("pytrader", "orderbook_group")
         if group == 0:
             group = 1
+        if group == 1:
+            self.get_grouped_view(book, None)
 
         #
         # paint the asks (first we put them into bins[] then we paint them)
@@ -434,37 +458,37 @@ class WinOrderBook(Win):
                     pos -= 1
                     i += 1
 
-            # with grouping its a bit more complicated
+            # with grouping the bins come from the grouped view of the book
             else:
+                view = self.get_grouped_view(book, group)
+
                 # first bin is exact lowest ask price
                 price = book.asks[0].price
                 vol = book.asks[0].volume
                 bins.append([pos, price, vol, 0, 0])
-                prev_vol = vol
+                top_vol = vol
+                top_bin_price = view.asks.bin_price(price)
                 pos -= 1
 
-                # now all following bins
-                bin_price = math.ceil(price / group) * group
-                if bin_price == price:
-                    # first level was exact bin price already, skip to next bin
-                    bin_price += group
-                while pos >= 0 and bin_price < book.asks[-1].price + group:
-                    vol, _vol_quote = book.get_total_up_to(bin_price, True)  # 01 freeze
-                    if vol > prev_vol:
-                        # append only non-empty bins
-                        if sum_total:
-                            bins.append([pos, bin_price, vol, 0, 0])
-                        else:
-                            bins.append([pos, bin_price, vol - prev_vol, 0, 0])
-                        prev_vol = vol
-                        pos -= 1
-                    bin_price += group
-                    bin_price = math.ceil(bin_price / group) * group
+                # now all following bins, the first level is not counted twice
+                for (bin_price, bin_vol, _bin_quote) in view.asks:
+                    if pos < 0:
+                        break
+                    if bin_price == top_bin_price:
+                        bin_vol -= top_vol
+                        if bin_vol < api.GroupedSide.EMPTY:
+                            continue
+                    vol += bin_vol
+                    if sum_total:
+                        bins.append([pos, bin_price, vol, 0, 0])
+                    else:
+                        bins.append([pos, bin_price, bin_vol, 0, 0])
+                    pos -= 1
 
                 # now add the own volumes to their bins
                 for order in book.owns:
                     if order.typ == "ask" and order.price > 0:
-                        order_bin_price = math.ceil(float(order.price) / group) * group
+                        order_bin_price = view.asks.bin_price(order.price)
                         for abin in bins:
                             if abin[1] == order.price:
                                 abin[3] += order.volume
@@ -476,7 +500,7 @@ class WinOrderBook(Win):
             # mark the level where change took place (optional)
             if instance.config.get_bool("pytrader", "highlight_changes"):
                 if book.last_change_type == "ask":
-                    change_bin_price = math.ceil(float(book.last_change_price) / group) * group
+                    change_bin_price = api.group_index(book.last_change_price, group, True) * group
                     for abin in bins:
                         if abin[1] == book.last_change_price:
                             abin[4] = book.last_change_volume
@@ -515,37 +539,37 @@ class WinOrderBook(Win):
                     pos += 1
                     i += 1
 
-            # with gouping its a bit more complicated
+            # with grouping the bins come from the grouped view of the book
             else:
-                # first bin is exact lowest ask price
+                view = self.get_grouped_view(book, group)
+
+                # first bin is exact highest bid price
                 price = book.bids[0].price
                 vol = book.bids[0].volume
                 bins.append([pos, price, vol, 0, 0])
-                prev_vol = vol
+                top_vol = vol
+                top_bin_price = view.bids.bin_price(price)
                 pos += 1
 
-                # now all following bins
-                bin_price = math.floor(float(price) / group) * group
-                if bin_price == price:
-                    # first level was exact bin price already, skip to next bin
-                    bin_price -= group
-                while pos < self.height and bin_price >= 0:
-                    vol, _vol_quote = book.get_total_up_to(bin_price, False)
-                    if vol > prev_vol:
-                        # append only non-empty bins
-                        if sum_total:
-                            bins.append([pos, bin_price, vol, 0, 0])
-                        else:
-                            bins.append([pos, bin_price, vol - prev_vol, 0, 0])
-                        prev_vol = vol
-                        pos += 1
-                    bin_price -= group
-                    bin_price = math.floor(bin_price / group) * group
+                # now all following bins, the first level is not counted twice
+                for (bin_price, bin_vol, _bin_quote) in view.bids:
+                    if pos >= self.height:
+                        break
+                    if bin_price == top_bin_price:
+                        bin_vol -= top_vol
+                        if bin_vol < api.GroupedSide.EMPTY:
+                            continue
+                    vol += bin_vol
+                    if sum_total:
+                        bins.append([pos, bin_price, vol, 0, 0])
+                    else:
+                        bins.append([pos, bin_price, bin_vol, 0, 0])
+                    pos += 1
 
                 # now add the own volumes to their bins
                 for order in book.owns:
                     if order.typ == "bid" and order.price > 0:
-                        order_bin_price = math.floor(float(order.price) / group) * group
+                        order_bin_price = view.bids.bin_price(order.price)
                         for abin in bins:
                             if abin[1] == order.price:
                                 abin[3] += order.volume
@@ -557,7 +581,7 @@ class WinOrderBook(Win):
             # mark the level where change took place (optional)
             if instance.config.get_bool("pytrader", "highlight_changes"):
                 if book.last_change_type == "bid":
-                    change_bin_price = math.floor(float(book.last_change_price) / group) * group
+                    change_bin_price = api.group_index(book.last_change_price, group, False) * group
                     for abin in bins:
                         if abin[1] == book.last_change_price:
                             abin[4] = book.last_change_volume
@@ -602,8 +626,9 @@ class WinChart(Win):
         self.pmin = 0
         self.pmax = 0
         self.change_type = None
-        instance.history.signal_changed.connect(self.slot_history_changed)
-        instance.orderbook.signal_changed.connect(self.slot_orderbook_changed)
+        rate = instance.config.get_float("pytrader", "max_repaint_rate")
+        instance.history.signal_changed.connect(self.slot_history_changed, max_rate=rate)
+        instance.orderbook.signal_changed.connect(self.slot_orderbook_changed, max_rate=rate)
 
         # some terminals do not support reverse video
         # so we cannot use reverse space for candle bodies
@@ -671,13 +696,13 @@ class WinChart(Win):
             COLOR_PAIR["chart_text"]
         )
 
-    def paint_candle(self, posx, candle):
+    def paint_candle(self, posx, opn, hig, low, cls):
         """paint a single candle"""
 
-        sopen = self.price_to_screen(candle.opn)
-        shigh = self.price_to_screen(candle.hig)
-        slow = self.price_to_screen(candle.low)
-        sclose = self.price_to_screen(candle.cls)
+        sopen = self.price_to_screen(opn)
+        shigh = self.price_to_screen(hig)
+        slow = self.price_to_screen(low)
+        sclose = self.price_to_screen(cls)
 
         for posy in range(self.height):
             if posy >= shigh and posy < sopen and posy < sclose:
@@ -695,11 +720,10 @@ class WinChart(Win):
 
     def paint(self):
         typ = self.instance.config.get_string("pytrader", "display_right")
-        if typ == "history_chart":
-            self.paint_history_chart()
-        elif typ == "depth_chart":
+        if typ == "depth_chart":
             self.paint_depth_chart()
         else:
+            self.get_grouped_view(self.instance.orderbook, None)
             self.paint_history_chart()
 
     def paint_depth_chart(self):
@@ -748,48 +772,38 @@ class WinChart(Win):
         mid = self.height / 2
         sum_total = self.instance.config.get_bool("pytrader", "depth_chart_sum_total")
 
+        view = self.get_grouped_view(book, group)
+
         #
         # bin the asks
         #
         pos = mid - 1
-        prev_vol = 0
-        bin_price = math.ceil(book.asks[0].price / group) * group
-        while pos >= 0 and bin_price < book.asks[-1].price + group:
-            bin_vol, _bin_vol_quote = book.get_total_up_to(bin_price, True)
-            if bin_vol > prev_vol:
-                # add only non-empty bins
-                if sum_total:
-                    bin_asks.append([pos, bin_price, bin_vol, 0, 0])
-                    max_vol_ask = max(bin_vol, max_vol_ask)
-                else:
-                    bin_asks.append([pos, bin_price, bin_vol - prev_vol, 0, 0])
-                    max_vol_ask = max(bin_vol - prev_vol, max_vol_ask)
-                prev_vol = bin_vol
-                pos -= 1
-            bin_price += group
-            bin_price = math.ceil(bin_price / group) * group
+        total = 0
+        for (bin_price, bin_vol, _bin_quote) in view.asks:
+            if pos < 0:
+                break
+            total += bin_vol
+            if sum_total:
+                bin_vol = total
+            bin_asks.append([pos, bin_price, bin_vol, 0, 0])
+            max_vol_ask = max(bin_vol, max_vol_ask)
+            pos -= 1
 
         #
-        # bin the bids
+        # bin the bids (quote volume expressed in base currency at the bid)
         #
         pos = mid + 1
-        prev_vol = 0
-        bin_price = math.floor(book.bids[0].price / group) * group
-        while pos < self.height and bin_price >= 0:
-            _bin_vol_base, bin_vol_quote = book.get_total_up_to(bin_price, False)
-            bin_vol = float(bin_vol_quote / book.bid)
-            if bin_vol > prev_vol:
-                # add only non-empty bins
-                if sum_total:
-                    bin_bids.append([pos, bin_price, bin_vol, 0, 0])
-                    max_vol_bid = max(bin_vol, max_vol_bid)
-                else:
-                    bin_bids.append([pos, bin_price, bin_vol - prev_vol, 0, 0])
-                    max_vol_bid = max(bin_vol - prev_vol, max_vol_bid)
-                prev_vol = bin_vol
-                pos += 1
-            bin_price -= group
-            bin_price = math.floor(bin_price / group) * group
+        total = 0
+        for (bin_price, _bin_vol, bin_quote) in view.bids:
+            if pos >= self.height:
+                break
+            bin_vol = float(bin_quote / book.bid)
+            total += bin_vol
+            if sum_total:
+                bin_vol = total
+            bin_bids.append([pos, bin_price, bin_vol, 0, 0])
+            max_vol_bid = max(bin_vol, max_vol_bid)
+            pos += 1
 
         max_vol_tot = max(max_vol_ask, max_vol_bid)
         if not max_vol_tot:
@@ -800,13 +814,13 @@ class WinChart(Win):
         for order in book.owns:
             if order.price > 0:
                 if order.typ == "ask":
-                    bin_price = math.ceil(order.price / group) * group
+                    bin_price = view.asks.bin_price(order.price)
                     for abin in bin_asks:
                         if abin[1] == bin_price:
                             abin[3] += order.volume
                             break
                 else:
-                    bin_price = math.floor(order.price / group) * group
+                    bin_price = view.bids.bin_price(order.price)
                     for abin in bin_bids:
                         if abin[1] == bin_price:
                             abin[3] += order.volume
@@ -816,13 +830,13 @@ class WinChart(Win):
         if self.instance.config.get_bool("pytrader", "highlight_changes"):
             price = book.last_change_price
             if book.last_change_type == "ask":
-                bin_price = math.ceil(price / group) * group
+                bin_price = view.asks.bin_price(price)
                 for abin in bin_asks:
                     if abin[1] == bin_price:
                         abin[4] = book.last_change_volume
                         break
             if book.last_change_type == "bid":
-                bin_price = math.floor(price / group) * group
+                bin_price = view.bids.bin_price(price)
                 for abin in bin_bids:
                     if abin[1] == bin_price:
                         abin[4] = book.last_change_volume
@@ -847,23 +861,21 @@ class WinChart(Win):
             self.win.bkgd(" ", COLOR_PAIR["chart_text"])
             self.win.erase()
 
-        hist = self.instance.history
+        candles = self.get_chart_candles()
         book = self.instance.orderbook
 
-        self.pmax = 0
-        self.pmin = 9999999999
+        # the visible candles, views into the candle store (oldest first)
+        count = max(0, min(len(candles), self.width - 1))
+        if not count:
+            return
+        opns = candles.column("opn", count)
+        higs = candles.column("hig", count)
+        lows = candles.column("low", count)
+        clss = candles.column("cls", count)
 
         # determine y range
-        posx = self.width - 2
-        index = 0
-        while index < hist.length() and posx >= 0:
-            candle = hist.candles[index]
-            if self.pmax < candle.hig:
-                self.pmax = candle.hig
-            if self.pmin > candle.low:
-                self.pmin = candle.low
-            index += 1
-            posx -= 1
+        self.pmax = max(higs)
+        self.pmin = min(lows)
 
         if self.pmax == self.pmin:
             return
@@ -873,14 +885,11 @@ class WinChart(Win):
         # signal because that would be redundant and only waste CPU.
         # In that case we only repaint the bid/ask markers (see below)
         if self.change_type != TYPE_ORDERBOOK:
-            # paint the candles
-            posx = self.width - 2
-            index = 0
-            while index < hist.length() and posx >= 0:
-                candle = hist.candles[index]
-                self.paint_candle(posx, candle)
-                index += 1
-                posx -= 1
+            # paint the candles, newest at the right
+            posx = self.width - 2 - count + 1
+            for candle in itertools.izip(opns, higs, lows, clss):
+                self.paint_candle(posx, *candle)
+                posx += 1
 
             # paint the y-axis labels
             posx = 0
@@ -911,6 +920,17 @@ class WinChart(Win):
             posy = self.price_to_screen(book.ask)
             self.addch(posy, posx, curses.ACS_HLINE, COLOR_PAIR["chart_down"])
 
+    def get_chart_candles(self):
+        """the CandleStore of the timeframe chosen with chart_timeframe
+        (minutes), the history timeframe if it is 0 or not available. All
+        timeframes are always kept up to date by the candle engine, so
+        switching does not need to download anything"""
+        engine = self.instance.candle_engine
+        timeframe = 60 * self.instance.config.get_int("pytrader", "chart_timeframe")
+        if timeframe in engine.timeframes:
+            return engine.get_store(timeframe)
+        return self.instance.history.candles
+
     def slot_history_changed(self, _sender, _data):
         """Slot for history changed"""
         self.change_type = TYPE_HISTORY
@@ -934,8 +954,9 @@ class WinStatus(Win):
         self.order_lag_txt = ""
         self.sorted_currency_list = []
         instance.signal_orderlag.connect(self.slot_orderlag)
+        rate = instance.config.get_float("pytrader", "max_repaint_rate")
         instance.signal_wallet.connect(self.slot_changed)
-        instance.orderbook.signal_changed.connect(self.slot_changed)
+        instance.orderbook.signal_changed.connect(self.slot_changed, max_rate=rate)
         Win.__init__(self, stdscr)
 
     def calc_size(self):
@@ -1034,6 +1055,10 @@ class WinStatus(Win):
         line2 += " | "
         line2 += "depth: %s / " % self.instance.orderbook.depth_updated
         line2 += "orders: %s" % self.instance.orderbook.orders_updated
+        if self.instance.dispatcher:
+            line2 += " | queue: %i (%.3f s)" % (
+                self.instance.dispatcher.get_depth(),
+                self.instance.dispatcher.get_lag())
 
         # self.addstr(0, 0, line1, COLOR_PAIR["status_text"])
         self.addstr(1, 0, line2, COLOR_PAIR["status_text"])
@@ -1265,7 +1290,7 @@ class TextBox():
         position. This is only a cosmetic problem but very annnoying. Try to
         force it into the edit field by repainting it very often."""
         while self.editing:
-            with api.Signal._lock:
+            with Win._lock:
                 curses.curs_set(2)
                 self.win.touchwin()
                 self.win.refresh()
@@ -1440,51 +1465,9 @@ class PrintHook():
             self.instance.signal_debug(self, string)
 
 
-#
-# dynamically (re)loadable strategy module
-#
-
-class StrategyManager():
-    """load the strategy module"""
-
-    def __init__(self, instance, strategy_name_list):
-        self.strategy_object_list = []
-        self.strategy_name_list = strategy_name_list
-        self.instance = instance
-        self.reload()
-
-    def unload(self):
-        """unload the strategy, will trigger its the __del__ method"""
-        self.instance.signal_strategy_unload(self, None)
-        self.strategy_object_list = []
-
-    def reload(self):
-        """reload and re-initialize the strategy module"""
-        self.unload()
-        for name in self.strategy_name_list:
-            name = name.replace(".py", "").strip()
-
-            try:
-                strategy_module = __import__(name)
-                try:
-                    reload(strategy_module)
-                    strategy_object = strategy_module.Strategy(self.instance)
-                    self.strategy_object_list.append(strategy_object)
-                    if hasattr(strategy_object, "name"):
-                        self.instance.strategies[strategy_object.name] = strategy_object
-
-                except Exception:
-                    self.instance.debug("### error while loading strategy %s.py, traceback follows:" % name)
-                    self.instance.debug(traceback.format_exc())
-
-            except ImportError:
-                self.instance.debug("### could not import %s.py, traceback follows:" % name)
-                self.instance.debug(traceback.format_exc())
-
-
 def toggle_setting(instance, alternatives, option_name, direction):
     """toggle a setting in the ini file"""
-    with api.Signal._lock:
+    with instance.lock:
         setting = instance.config.get_string("pytrader", option_name)
         try:
             newindex = (alternatives.index(setting) + direction) % len(alternatives)
@@ -1519,9 +1502,28 @@ def toggle_depth_sum(instance):
     toggle_setting(instance, alt, "depth_chart_sum_total", 1)
     instance.orderbook.signal_changed(instance.orderbook, None)
 
+def toggle_chart_timeframe(instance, direction):
+    """switch the history chart to the next shorter or longer timeframe"""
+    alt = [str(timeframe // 60) for timeframe in instance.candle_engine.timeframes]
+    toggle_setting(instance, alt, "chart_timeframe", direction)
+    instance.history.signal_changed(instance.history, None)
+
+def dump_signal_stats(instance):
+    """write the signal and http statistics to the logfile, if they are not yet
+    being collected then switch the collection on and dump them next time"""
+    if not api.Signal._stats_enabled:
+        instance.enable_signal_stats(True)
+        instance.debug("### signal statistics enabled, press I again to dump them")
+        return
+    for line in instance.format_signal_stats():
+        logging.info("signal stats: %s", line)
+    for line in instance.format_http_stats():
+        logging.info("http stats: %s", line)
+    instance.debug("### signal statistics written to the logfile")
+
 def set_ini(instance, setting, value, signal, signal_sender, signal_params):
     """set the ini value and then send a signal"""
-    with api.Signal._lock:
+    with instance.lock:
         instance.config.set("pytrader", setting, value)
         instance.config.save()
     signal(signal_sender, signal_params)
@@ -1532,6 +1534,17 @@ def set_ini(instance, setting, value, signal, signal_sender, signal_params):
 # main program
 #
 
+def apply_log_settings(config):
+    """translate the show_* settings and the log_level from the ini
+    into the log categories and level of api.BaseObject"""
+    for option, category in [("show_ticker", api.LOG_TICK),
+                             ("show_depth", api.LOG_DEPTH),
+                             ("show_trade", api.LOG_TRADE),
+                             ("show_trade_own", api.LOG_TRADE_OWN)]:
+        api.BaseObject.set_log_category(category, config.get_bool("pytrader", option))
+    level = config.get_string("pytrader", "log_level").upper()
+    api.BaseObject.set_log_level(getattr(logging, level, logging.DEBUG))
+
 def main():
     """main funtion, called at the start of the program"""
     debug_tb = []
@@ -1549,6 +1562,7 @@ def main():
         try:
             init_colors()
 
+            apply_log_settings(config)
             instance = api.Api(secret, config)
 
             logwriter = LogWriter(instance)
@@ -1560,7 +1574,7 @@ def main():
             statuswin = WinStatus(stdscr, instance)
             chartwin = WinChart(stdscr, instance)
 
-            strategy_manager = StrategyManager(instance, strat_mod_list)
+            strategy_manager = strategy.StrategyManager(instance, strat_mod_list)
 
             instance.start()
 
@@ -1575,7 +1589,7 @@ def main():
                 elif key == curses.KEY_F6:
                     DlgCancelOrders(stdscr, instance).modal()
                 elif key == curses.KEY_RESIZE:
-                    with api.Signal._lock:
+                    with instance.lock, Win._lock:
                         stdscr.erase()
                         stdscr.refresh()
                         conwin.resize()
@@ -1592,6 +1606,12 @@ def main():
                 elif key == ord("D"):
                     set_ini(instance, "display_right", "depth_chart", instance.orderbook.signal_changed, instance.orderbook, None)
 
+                # history chart timeframe
+                elif key == ord("<"):
+                    toggle_chart_timeframe(instance, -1)
+                elif key == ord(">"):
+                    toggle_chart_timeframe(instance, +1)
+
                 #  depth chart step
                 elif key == ord(","):  # zoom out
                     toggle_depth_group(instance, +1)
@@ -1610,6 +1630,9 @@ def main():
                 elif key == ord("T"):
                     toggle_depth_sum(instance)
 
+                elif key == ord("I"):
+                    dump_signal_stats(instance)
+
                 # lowercase keys go to the strategy module
                 elif key >= ord("a") and key <= ord("z"):
                     instance.signal_keypress(instance, (key))
@@ -1634,9 +1657,9 @@ def main():
         except Exception as exc:
             print("Failed to write stacktrace logs:", exc)
 
-        # we need the signal lock to be able to shut down. And we cannot
+        # we need the signal locks to be able to shut down. And we cannot
         # wait for any frozen slot to return, so try really hard to get
-        # the lock and if that fails then unlock it forcefully.
+        # the locks and if that fails then unlock them forcefully.
         try:
             try_get_lock_or_break_open()
         except Exception as exc:
@@ -0,0 +1,2 @@
+# -*- coding: utf-8 -*-
+""" the exchange clients, Api() imports the one that is configured """
@@ -0,0 +1,424 @@
+# -*- coding: utf-8 -*-
+""" Backtest Client, plays back recorded market data and simulates the exchange """
+
+import gzip
+import heapq
+import itertools
+import json
+import logging
+import threading
+import time
+from api import BaseObject, Signal, FixedPoint, TradeColumns, TradeTape, TapeView
+from api import LatencyHistogram, NoLock, get_fixed_point, LOG_ORDER
+from api import Scheduler, SimulatedScheduler
+
+# only the public market data of a recording is played back, the answers
+# to the private calls of the original session are made up by the simulator
+MARKET_OPS = ("depth", "trade", "ticker")
+
+
+class SimOrder():
+    """an order in the matching simulator"""
+
+    def __init__(self, oid, typ, price, volume, time_sent):
+        self.oid = oid
+        self.typ = typ
+        self.price = price  # 0 for market orders
+        self.volume = volume  # what is not filled yet
+        self.volume_orig = volume
+        self.time_sent = time_sent  # simulated time when the strategy sent it
+        self.time_open = None  # simulated time when it reached the exchange
+        self.time_filled = None  # simulated time of the first fill
+
+    def as_dict(self, curr_base, curr_quote):
+        """the open order like it is in an "orders" result"""
+        return {"oid": self.oid, "base": curr_base, "currency": curr_quote,
+                "type": self.typ, "price": self.price, "amount": self.volume,
+                "status": "open"}
+
+
+class BacktestClient(BaseObject):
+    """plays back a recording made with the record_feed option (see
+    api.FeedRecorder) or a trade tape (see api.TradeTape) as fast as
+    possible and simulates the exchange for the orders of the strategies.
+    Everything happens in the thread that calls run(), the Api uses a
+    NoLock for this exchange. The client installs a SimulatedScheduler
+    until stop(), so the timers of the Api and the strategies (and the
+    delayed calls of rate limited slots) run in simulated time, run()
+    fires them between the events when their time has come.
+
+    The simulated time is the time of the recorded event that is being
+    played back. Orders and cancels reach the exchange backtest_latency
+    seconds after they were sent (before the first event at or after that
+    time). Marketable orders are filled against the levels of the order
+    book at once (taker fee), market orders take what is there and the
+    rest is dropped. The book itself is not changed by own fills. Resting
+    orders are filled by public trades that trade through their price (or
+    at their price with backtest_fill_at_touch) at their own price (maker
+    fee), as much as the trade volume allows. Fees are paid in the quote
+    currency, the balances are not checked. Without depth (a trade tape)
+    the price of the last trade has unlimited volume."""
+
+    def __init__(self, curr_base, curr_quote, secret, config):
+        BaseObject.__init__(self)
+
+        # everything is emitted from the thread that calls run()
+        self.signal_recv = Signal(NoLock())
+        self.signal_fulldepth = Signal(NoLock())
+        self.signal_fullhistory = Signal(NoLock())
+        self.signal_ticker = Signal(NoLock())
+        self.signal_connected = Signal(NoLock())
+        self.signal_disconnected = Signal(NoLock())
+
+        self.secret = secret
+        self.config = config
+        self.curr_base = curr_base
+        self.curr_quote = curr_quote
+        self.filename = config.get_string("api", "replay_file")
+        self.latency = config.get_float("api", "backtest_latency")
+        self.fee_maker = config.get_float("api", "backtest_fee_maker")
+        self.fee_taker = config.get_float("api", "backtest_fee_taker")
+        self.fill_at_touch = config.get_bool("api", "backtest_fill_at_touch")
+
+        with open(self.filename, "rb") as file:
+            self.is_tape = file.read(4) == TradeTape.MAGIC
+        if self.is_tape:
+            self.fixed = get_fixed_point(config, 8, 8)
+            view = TapeView(self.filename)
+            time_begin = view.date(0) if len(view) else 0
+            view.close()
+        else:
+            with gzip.open(self.filename, "rb") as file:
+                header = json.loads(file.readline())
+            if (header["curr_base"], header["curr_quote"]) != (curr_base, curr_quote):
+                logging.warning("backtesting on %s%s but trading %s%s is configured",
+                                header["curr_base"], header["curr_quote"],
+                                curr_base, curr_quote)
+            self.fixed = FixedPoint(header["price_decimals"], header["volume_decimals"])
+            time_begin = header["time"]
+
+        self.wallet_start = {
+            curr_base: config.get_float("api", "backtest_balance_base"),
+            curr_quote: config.get_float("api", "backtest_balance_quote")}
+        self.wallet = dict(self.wallet_start)
+
+        self.orderbook = None  # the Api sets this, marketable orders take from it
+        self.history_last_candle = None
+        self._wait_for_next_info = False
+        self._terminating = False
+        self._actions = []  # heap of [due, seq, func, args]
+        self._seq = itertools.count()
+        self._time_event = 0  # wall clock time when the current event started
+        self.events = []  # (time, name, data), filled by start()
+        self.now = time_begin  # simulated time
+        self.last_price = 0
+        self.resting = {}  # oid -> SimOrder() that is open on the exchange
+        self.fills = []  # (time, oid, typ, price, volume, fee, is_maker)
+        self.total_fees = 0
+        self.count_orders = 0
+        self.count_canceled = 0
+        self.count_events = 0
+        self.latency_fill = LatencyHistogram()  # simulated, sent to first fill
+        self.latency_done = LatencyHistogram()  # simulated, sent to completely filled
+        self.reaction = LatencyHistogram()  # wall clock, event to order sent
+        self.time_load = 0
+        self.time_run = 0
+        self.finished = threading.Event()
+
+        # all timers that are started from now on run in simulated time
+        self.scheduler = SimulatedScheduler(lambda: self.now)
+        self._scheduler_previous = Scheduler.install(self.scheduler)
+
+    def start(self):
+        """read the whole feed into memory, run() then plays it back"""
+        time_start = time.time()
+        if self.is_tape:
+            self.events = self._load_tape()
+        else:
+            self.events = self._load_recording()
+        self.time_load = time.time() - time_start
+        self.debug("### loaded %i events in %.2f s" % (len(self.events), self.time_load))
+
+    def stop(self):
+        """stop playing back, timers run in real time again"""
+        self._terminating = True
+        if Scheduler.get() is self.scheduler:
+            Scheduler.install(self._scheduler_previous)
+
+    def _load_recording(self):
+        """the market data of a FeedRecorder file, the JSON of the
+        messages is already decoded"""
+        events = []
+        with gzip.open(self.filename, "rb") as file:
+            file.readline()  # the header
+            for line in file:
+                (tim, name, data) = json.loads(line)
+                if name == "recv":
+                    if not isinstance(data, dict):
+                        data = json.loads(data)
+                    if data.get("op") not in MARKET_OPS:
+                        continue
+                    if data["op"] == "trade":
+                        name = "trade"
+                elif name == "fullhistory":
+                    if isinstance(data, dict) and "trades" in data:
+                        data = TradeColumns(**data["trades"])
+                elif name == "ticker":
+                    data = tuple(data)
+                events.append((tim, name, data))
+        return events
+
+    def _load_tape(self):
+        """every trade of the tape becomes a trade message. A tape has no
+        depth and the Api would wait forever for the downloads before it
+        emits signal_ready, so an empty fulldepth and a fullhistory with
+        only the first trade (its trade message is left out) come first"""
+        view = TapeView(self.filename)
+        try:
+            trades = view.get_trades()
+        finally:
+            view.close()
+        if not len(trades):
+            return []
+        # side 1 is a buy, the clients send these as type "ask"
+        sides = trades.sides if len(trades.sides) else itertools.repeat(0)
+        date = trades.dates[0]
+        events = [(date, "connected", None),
+                  (date, "fulldepth", {"data": {"asks": [], "bids": []}}),
+                  (date, "fullhistory", TradeColumns(
+                      [date], [trades.prices[0]], [trades.amounts[0]]))]
+        for (date, price, amount, side) in itertools.islice(itertools.izip(
+                trades.dates, trades.prices, trades.amounts, sides), 1, None):
+            events.append((date, "trade", {"op": "trade", "trade": {
+                "type": "ask" if side > 0 else "bid",
+                "price": price,
+                "amount": amount,
+                "timestamp": date}}))
+        return events
+
+    def run(self):
+        """play back all events, return when done"""
+        actions = self._actions
+        timers = self.scheduler.heap
+        signal_recv = self.signal_recv
+        time_start = time.time()
+        count = 0
+        for (tim, name, data) in self.events:
+            if self._terminating:
+                break
+            if (actions and actions[0][0] <= tim) or (timers and timers[0][0] <= tim):
+                self._advance(tim)
+            self.now = tim
+            self._time_event = time.time()
+            if name == "trade":
+                signal_recv(self, data)
+                self.last_price = data["trade"]["price"]
+                if self.resting:
+                    self._match_trade(data["trade"])
+            elif name == "recv":
+                signal_recv(self, data)
+            else:
+                self._emit(name, data)
+            count += 1
+
+        # orders that were still on their way
+        while actions and not self._terminating:
+            self._advance(actions[0][0])
+        self.count_events = count
+        self.time_run = time.time() - time_start
+        self.debug("### backtest finished after %i events" % count)
+        self.finished.set()
+
+    def _emit(self, name, data):
+        """emit a recorded event that is not a message"""
+        if name == "fulldepth":
+            self.signal_fulldepth(self, (data))
+        elif name == "fullhistory":
+            self.signal_fullhistory(self, (data))
+        elif name == "ticker":
+            self.signal_ticker(self, (data))
+        elif name == "connected":
+            self.signal_connected(self, None)
+            self.request_info()
+            self.request_orders()
+            self._send({"op": "result", "id": "volume", "result": {
+                "volume": 0, "currency": self.curr_quote, "fee": self.fee_maker}})
+        elif name == "disconnected":
+            self.signal_disconnected(self, None)
+
+    def _send(self, msg):
+        """a message from the simulated exchange to the Api"""
+        self.signal_recv(self, (msg))
+
+    def _schedule(self, func, *args):
+        """call func(*args) when it reaches the exchange"""
+        heapq.heappush(self._actions, [self.now + self.latency, next(self._seq), func, args])
+
+    def _advance(self, tim):
+        """run the actions and fire the timers that are due up to the
+        simulated time tim, in the order of their due times"""
+        actions = self._actions
+        scheduler = self.scheduler
+        while not self._terminating:
+            due = scheduler.next_due()
+            if actions and actions[0][0] <= tim and (due is None or actions[0][0] <= due):
+                self._run_action()
+            elif due is not None and due <= tim:
+                if due > self.now:
+                    self.now = due
+                scheduler.fire_next()
+            else:
+                break
+
+    def _run_action(self):
+        """run the next due action at its simulated time"""
+        (due, _, func, args) = heapq.heappop(self._actions)
+        if due > self.now:
+            self.now = due
+        func(*args)
+
+    def send_order_add(self, typ, price, volume):
+        """send an order to the simulated exchange"""
+        self.reaction.add(time.time() - self._time_event)
+        price = self.fixed.round_price(price)
+        volume = self.fixed.round_volume(volume)
+        reqid = "order_add:%s:%s:%s" % (
+            typ, self.fixed.format_price(price), self.fixed.format_volume(volume))
+        self.log(LOG_ORDER, logging.DEBUG, "Sending %s", reqid)
+        self.count_orders += 1
+        order = SimOrder("BT-%i" % self.count_orders, typ, price, volume, self.now)
+        self._schedule(self._on_order_add, reqid, order)
+
+    def send_order_cancel(self, txid):
+        """cancel an order on the simulated exchange"""
+        self.log(LOG_ORDER, logging.DEBUG, "Sending order_cancel:%s", txid)
+        self._schedule(self._on_order_cancel, txid)
+
+    def send_signed_call(self, api_endpoint, params, reqid):
+        """the Api only sends info and orders again"""
+        if reqid == "info":
+            self.request_info()
+        elif reqid == "orders":
+            self.request_orders()
+
+    def request_info(self):
+        """the simulated balances"""
+        self._send({"op": "result", "id": "info", "result": dict(self.wallet)})
+
+    def request_orders(self):
+        """the open orders on the simulated exchange"""
+        orders = [order.as_dict(self.curr_base, self.curr_quote)
+                  for order in self.resting.itervalues()]
+        self._send({"op": "result", "id": "orders", "result": orders})
+
+    def force_reconnect(self):
+        """there is no connection"""
+        pass
+
+    def _on_order_add(self, reqid, order):
+        """the order has reached the exchange"""
+        order.time_open = self.now
+        self._send({"op": "result", "id": reqid, "result": order.oid})
+        self._take(order)
+        if order.volume > 0 and order.price:
+            self.resting[order.oid] = order
+            self._send_user_order(order)
+        elif order.volume < order.volume_orig:
+            self._send_removed(order, "completed_active")
+        else:
+            self._send_removed(order, "requested")  # market order, nothing to take
+
+    def _on_order_cancel(self, oid):
+        """the cancel has reached the exchange"""
+        reqid = "order_cancel:%s" % oid
+        order = self.resting.pop(oid, None)
+        if order is None:
+            self._send({"op": "remark", "success": False,
+                        "message": "Order not found", "id": reqid})
+            return
+        self.count_canceled += 1
+        self._send({"op": "result", "id": reqid, "result": True})
+        self._send_removed(order, "requested")
+
+    def _take(self, order):
+        """fill as much of the new order as the book has up to its price
+        (or at any price if it is a market order)"""
+        is_buy = order.typ == "bid"
+        side = None
+        if self.orderbook:
+            side = self.orderbook.asks if is_buy else self.orderbook.bids
+        if not side or not len(side):
+            price = self.last_price
+            if not price:
+                return
+            if order.price and (price > order.price if is_buy else price < order.price):
+                return
+            self._fill(order, order.volume, order.volume * price, False)
+            return
+
+        limit = order.price if order.price else side.prices[-1]
+        (available, cost) = side.get_total_up_to(limit)
+        if available <= 0:
+            return
+        volume = min(order.volume, available)
+        if volume < available:
+            cost = side.get_cost(volume)[0]
+        self._fill(order, volume, cost, False)
+
+    def _match_trade(self, trade):
+        """fill the resting orders that this public trade went through"""
+        price = trade["price"]
+        left = trade["amount"]
+        touch = self.fill_at_touch
+        crossed = []
+        for order in self.resting.itervalues():
+            if order.typ == "bid":
+                if order.price > price or (touch and order.price == price):
+                    crossed.append((-order.price, order.time_open, order))
+            else:
+                if order.price < price or (touch and order.price == price):
+                    crossed.append((order.price, order.time_open, order))
+        crossed.sort()
+        for (_, _, order) in crossed:
+            if left <= 0:
+                break
+            volume = min(order.volume, left)
+            left -= volume
+            self._fill(order, volume, volume * order.price, True)
+            if order.volume > 0:
+                self._send_user_order(order)
+            else:
+                del self.resting[order.oid]
+                self._send_removed(order, "completed_passive")
+
+    def _fill(self, order, volume, cost, is_maker):
+        """book a fill, cost is in quote currency without the fee"""
+        volume = self.fixed.round_volume(volume)
+        if volume <= 0:
+            return
+        fee = cost * (self.fee_maker if is_maker else self.fee_taker) / 100
+        if order.typ == "bid":
+            self.wallet[self.curr_base] += volume
+            self.wallet[self.curr_quote] -= cost + fee
+        else:
+            self.wallet[self.curr_base] -= volume
+            self.wallet[self.curr_quote] += cost - fee
+        self.total_fees += fee
+        order.volume = self.fixed.round_volume(order.volume - volume)
+        if order.time_filled is None:
+            order.time_filled = self.now
+            self.latency_fill.add(self.now - order.time_sent)
+        if order.volume <= 0:
+            self.latency_done.add(self.now - order.time_sent)
+        self.fills.append((self.now, order.oid, order.typ, cost / volume, volume, fee, is_maker))
+        self.request_info()
+
+    def _send_user_order(self, order):
+        """tell the Api about a new or partially filled open order"""
+        self._send({"op": "private", "private": "user_order",
+                    "user_order": order.as_dict(self.curr_base, self.curr_quote)})
+
+    def _send_removed(self, order, reason):
+        """tell the Api that the order is gone"""
+        self._send({"op": "private", "private": "user_order", "user_order": {
+            "oid": order.oid, "reason": reason}})
@@ -2,19 +2,60 @@
 """ Kraken Client """
 
 import json
+import logging
 import time
 import hmac
 import Queue
+import itertools
 import base64
 import hashlib
 import threading
 # import traceback
-from api import BaseObject, Signal, Timer, start_thread, http_request
-from api import FORCE_NO_FULLDEPTH, FORCE_NO_HISTORY
+from api import BaseObject, Signal, Timer, TokenBucket, start_thread, http_request, FETCH_POOL
+from api import get_fixed_point, TradeColumns
+from api import FORCE_NO_FULLDEPTH, FORCE_NO_HISTORY, LOG_ORDER
 from urllib import urlencode
 
 HTTP_HOST = "api.kraken.com"
 
+# Cost of the private calls in Kraken's call counter, everything that is not
+# listed here costs 1. Adding and canceling orders does not count there,
+# these are limited separately by the trading engine (see ORDER_CALLS).
+CALL_COST = {
+    "private/AddOrder": 0,
+    "private/CancelOrder": 0,
+    "private/Ledgers": 2,
+    "private/QueryLedgers": 2,
+    "private/TradesHistory": 2,
+    "private/QueryTrades": 2
+}
+
+ORDER_CALLS = ["private/AddOrder", "private/CancelOrder"]
+
+# (price decimals, volume decimals) of the pairs, Kraken rejects orders with
+# more decimals than that. Pairs that are not listed here use PAIR_DECIMALS_DEFAULT.
+PAIR_DECIMALS = {
+    "XXBTZUSD": (1, 8),
+    "XXBTZEUR": (1, 8),
+    "XETHXXBT": (5, 8),
+    "XETHZUSD": (2, 8),
+    "XETHZEUR": (2, 8),
+    "XLTCXXBT": (6, 8),
+    "XLTCZUSD": (2, 8),
+    "XLTCZEUR": (2, 8)
+}
+PAIR_DECIMALS_DEFAULT = (8, 8)
+
+# Queued private calls are sent in this order (lowest first),
+# so that orders never have to wait behind the balance polling.
+CALL_PRIORITY = {
+    "private/AddOrder": 0,
+    "private/CancelOrder": 0,
+    "private/OpenOrders": 1,
+    "private/Balance": 2,
+    "private/TradeVolume": 3
+}
+
 class PollClient(BaseObject):
     """Polling client class"""
 
@@ -53,17 +94,30 @@ class PollClient(BaseObject):
         self.curr_base = curr_base
         self.curr_quote = curr_quote
         self.pair = "%s%s" % (curr_base, curr_quote)
+        self.fixed = get_fixed_point(config, *PAIR_DECIMALS.get(self.pair, PAIR_DECIMALS_DEFAULT))
 
         self.secret = secret
         self.config = config
 
         use_ssl = self.config.get_bool("api", "use_ssl")
         self.proto = {True: "https", False: "http"}[use_ssl]
-        self.http_requests = Queue.Queue()
+        self.http_requests = Queue.PriorityQueue()
+        self._http_seq = itertools.count()
+        self._http_queued_polls = set()
+        self._http_queued_lock = threading.Lock()
+        # keep one call in reserve, the server counts our calls a little
+        # later than we do and the network latency is not always the same
+        self._call_limiter = TokenBucket(
+            self.config.get_int("api", "kraken_call_limit") - 1,
+            self.config.get_float("api", "kraken_call_decay"))
+        self._order_limiter = TokenBucket(
+            self.config.get_int("api", "kraken_order_limit"),
+            self.config.get_float("api", "kraken_order_decay"))
 
         self._http_thread = None
         self._terminating = False
         self.history_last_candle = None
+        self.history_cursor = None  # Kraken's "last" of the previous download
 
         self.request_info()
         self.request_volume()
@@ -96,7 +150,7 @@ class PollClient(BaseObject):
             return microtime
 
     def request_fulldepth(self):
-        """Start the fulldepth thread"""
+        """Request the full depth (in the fetch pool)"""
 
         def fulldepth_thread():
             """Request the full market depth, initialize the order book
@@ -118,33 +172,38 @@ class PollClient(BaseObject):
                     depth['data'] = {'asks': [], 'bids': []}
                     for ask in fulldepth['result'][self.pair]['asks']:
                         depth['data']['asks'].append({
-                            'price': float(ask[0]),
-                            'amount': float(ask[1])
+                            'price': self.fixed.round_price(float(ask[0])),
+                            'amount': self.fixed.round_volume(float(ask[1]))
                         })
                     for bid in reversed(fulldepth['result'][self.pair]['bids']):
                         depth['data']['bids'].append({
-                            'price': float(bid[0]),
-                            'amount': float(bid[1])
+                            'price': self.fixed.round_price(float(bid[0])),
+                            'amount': self.fixed.round_volume(float(bid[1]))
                         })
                     if depth:
                         self.signal_fulldepth(self, (depth))
                 except Exception as exc:
                     self.debug("### exception in fulldepth_thread:", exc)
 
-        start_thread(fulldepth_thread, "http request full depth")
+        FETCH_POOL.submit("depth:%s:%s" % (HTTP_HOST, self.pair), fulldepth_thread)
 
     def request_history(self):
-        """Start the trading history thread"""
+        """Request the trading history (in the fetch pool)"""
 
         # Api() will have set this field to the timestamp of the last
         # known candle, so we only request data since this time
         # since = self.history_last_candle
+        # After the first download we continue at Kraken's cursor, then
+        # we only get trades that we have not sent yet.
 
         def history_thread():
             """request trading history"""
 
+            cursor = self.history_cursor
             querystring = "?pair=%s" % self.pair
-            if not self.history_last_candle:
+            if cursor:
+                querystring += "&since=%s" % cursor
+            elif not self.history_last_candle:
                 querystring += "&since=%i" % ((time.time() - 172800) * 1e9)
                 # self.debug("Requesting history since: %s" % time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(time.time() - 172800)))
             else:
@@ -166,19 +225,22 @@ class PollClient(BaseObject):
                         return
 
                     # self.debug("History: %s" % raw_history)
-                    history = []
-                    for h in raw_history["result"][self.pair]:
-                        history.append({
-                            'price': float(h[0]),
-                            'amount': float(h[1]),
-                            'date': h[2]
-                        })
+                    raw = raw_history["result"][self.pair]
+                    round_price = self.fixed.round_price
+                    round_volume = self.fixed.round_volume
+                    history = TradeColumns(
+                        [h[2] for h in raw],
+                        [round_price(float(h[0])) for h in raw],
+                        [round_volume(float(h[1])) for h in raw],
+                        new_only=bool(cursor),
+                        sides=[1 if h[3] == "b" else -1 for h in raw])
+                    self.history_cursor = raw_history["result"].get("last", cursor)
                     if history:
                         self.signal_fullhistory(self, history)
                 except Exception as exc:
                     self.debug("### exception in history_thread:", exc)
 
-        start_thread(history_thread, "http request trade history")
+        FETCH_POOL.submit("history:%s:%s" % (HTTP_HOST, self.pair), history_thread)
 
     def request_ticker(self):
         """Request ticker"""
@@ -194,13 +256,13 @@ class PollClient(BaseObject):
                     answer = json.loads(json_ticker)
                     # self.debug("TICK %s" % answer)
                     if not answer["error"]:
-                        bid = float(answer['result'][self.pair]['b'][0])
-                        ask = float(answer['result'][self.pair]['a'][0])
+                        bid = self.fixed.round_price(float(answer['result'][self.pair]['b'][0]))
+                        ask = self.fixed.round_price(float(answer['result'][self.pair]['a'][0]))
                         self.signal_ticker(self, (bid, ask))
                 except Exception as exc:
                     self.debug("### exception in ticker_thread:", exc)
 
-        start_thread(ticker_thread, "http request ticker")
+        FETCH_POOL.submit("ticker:%s:%s" % (HTTP_HOST, self.pair), ticker_thread)
 
     def request_lag(self):
         """Request server time to calculate lag"""
@@ -227,7 +289,7 @@ class PollClient(BaseObject):
                 except Exception as exc:
                     self.debug("### exception in lag_thread:", exc)
 
-        start_thread(lag_thread, "http request lag")
+        FETCH_POOL.submit("lag:%s:%s" % (HTTP_HOST, self.pair), lag_thread)
 
     def _slot_timer_info_later(self, _sender, _data):
         """the slot for the request_info_later() timer signal"""
@@ -258,10 +320,22 @@ class PollClient(BaseObject):
         while not self._terminating:
             try:
                 # pop queued request from the queue and process it
-                (api_endpoint, params, reqid) = self.http_requests.get(True)
+                (_prio, _seq, (api_endpoint, params, reqid)) = self.http_requests.get(True)
+                with self._http_queued_lock:
+                    self._http_queued_polls.discard(reqid)
                 translated = None
 
+                self._wait_rate_limit(api_endpoint)
                 answer = self.http_signed_call(api_endpoint, params)
+                if self._is_rate_limit_error(answer):
+                    # we were wrong about the state of the counter (maybe
+                    # another program is using the same key), the call has
+                    # not been executed, so we can simply send it again.
+                    self.debug("### rate limit exceeded, retrying", reqid)
+                    self._drain_rate_limit(api_endpoint)
+                    self._put_http_request(api_endpoint, params, reqid)
+                    self.http_requests.task_done()
+                    continue
                 # self.debug("Result: %s" % answer)
                 if "result" in answer:
                     # the following will reformat the answer in such a way
@@ -278,8 +352,8 @@ class PollClient(BaseObject):
                                 'currency': "X" + tx['descr']['pair'][3:],
                                 'status': tx['status'],
                                 'type': 'bid' if tx['descr']['type'] == 'buy' else 'ask',
-                                'price': float(tx['descr']['price']),
-                                'amount': float(tx['vol'])
+                                'price': self.fixed.round_price(float(tx['descr']['price'])),
+                                'amount': self.fixed.round_volume(float(tx['vol']))
                             })
                             # self.debug("TX: %s" % result)
                     elif api_endpoint == 'private/TradeVolume':
@@ -324,10 +398,6 @@ class PollClient(BaseObject):
 
                 self.http_requests.task_done()
 
-                # Try to prevent going over API rate limiting, especially
-                # when cancelling and adding orders all at once
-                time.sleep(3)
-
             except Exception as exc:
                 # should this ever happen? HTTP 5xx wont trigger this,
                 # something else must have gone wrong, a totally malformed
@@ -347,9 +417,42 @@ class PollClient(BaseObject):
 
     def enqueue_http_request(self, api_endpoint, params, reqid):
         """enqueue a request for sending to the HTTP API, returns
-        immediately, behaves exactly like sending it over the websocket."""
+        immediately, behaves exactly like sending it over the websocket.
+        Polling requests (everything except orders) that are still waiting
+        in the queue will not be queued a second time."""
         if self.secret and self.secret.know_secret():
-            self.http_requests.put((api_endpoint, params, reqid), True, 10)
+            if not api_endpoint in ORDER_CALLS:
+                with self._http_queued_lock:
+                    if reqid in self._http_queued_polls:
+                        return
+                    self._http_queued_polls.add(reqid)
+            self._put_http_request(api_endpoint, params, reqid)
+
+    def _put_http_request(self, api_endpoint, params, reqid):
+        """put the request into the priority queue"""
+        prio = CALL_PRIORITY.get(api_endpoint, 1)
+        self.http_requests.put((prio, next(self._http_seq), (api_endpoint, params, reqid)))
+
+    def _wait_rate_limit(self, api_endpoint):
+        """block until the rate limit allows this call"""
+        if api_endpoint in ORDER_CALLS:
+            self._order_limiter.consume(1)
+        self._call_limiter.consume(CALL_COST.get(api_endpoint, 1))
+
+    def _drain_rate_limit(self, api_endpoint):
+        """the server says we have exceeded the limit for this call"""
+        if api_endpoint in ORDER_CALLS:
+            self._order_limiter.drain()
+        else:
+            self._call_limiter.drain()
+
+    def _is_rate_limit_error(self, answer):
+        """is this the answer to a call that exceeded the rate limit?"""
+        if answer and answer.get("error"):
+            for error in answer["error"]:
+                if "Rate limit exceeded" in error:
+                    return True
+        return False
 
     def http_signed_call(self, api_endpoint, params):
         """send a signed request to the HTTP API V2"""
@@ -387,23 +490,25 @@ class PollClient(BaseObject):
 
     def send_order_add(self, typ, price, volume):
         """send an order"""
-        reqid = "order_add:%s:%f:%f" % (typ, price, volume)
-        self.debug("Sending %s" % reqid)
+        price = self.fixed.format_price(price)
+        volume = self.fixed.format_volume(volume)
+        reqid = "order_add:%s:%s:%s" % (typ, price, volume)
+        self.log(LOG_ORDER, logging.DEBUG, "Sending %s", reqid)
         typ = "sell" if typ == "ask" else "buy"
-        if price > 0:
+        if float(price) > 0:
             params = {
                 "pair": self.pair,
                 "type": typ,
                 "ordertype": "limit",
-                "price": str(price),
-                "volume": str(volume)
+                "price": price,
+                "volume": volume
             }
         else:
             params = {
                 "pair": self.pair,
                 "type": typ,
                 "ordertype": "market",
-                "volume": str(volume)
+                "volume": volume
             }
 
         api = "private/AddOrder"
@@ -413,7 +518,7 @@ class PollClient(BaseObject):
         """cancel an order"""
         params = {"txid": txid}
         reqid = "order_cancel:%s" % txid
-        self.debug("Sending %s" % reqid)
+        self.log(LOG_ORDER, logging.DEBUG, "Sending %s", reqid)
         api = "private/CancelOrder"
         self.enqueue_http_request(api, params, reqid)
 
@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 """ Poloniex Client """
 
+import calendar
 import json
+import logging
 import time
 import hmac
 import Queue
@@ -9,7 +11,8 @@ import base64
 import hashlib
 import threading
 import traceback
-from api import BaseObject, Signal, Timer, start_thread, http_request
+from api import BaseObject, Signal, Timer, start_thread, http_request, FETCH_POOL
+from api import LOG_ORDER, LOG_TRADE, get_fixed_point, TradeColumns
 from urllib import urlencode
 from twisted.internet import reactor
 from twisted.internet.defer import inlineCallbacks
@@ -20,6 +23,24 @@ html_parser = HTMLParser.HTMLParser()
 WEBSOCKET_HOST = "api.poloniex.com"
 HTTP_HOST = "poloniex.com"
 
+# (price decimals, volume decimals), Poloniex uses 8 for all pairs
+PAIR_DECIMALS = (8, 8)
+
+_HOUR_CACHE = {}
+
+def parse_date(date):
+    """POSIX timestamp of a Poloniex date string "%Y-%m-%d %H:%M:%S" (local
+    time), the same as time.mktime(time.strptime(date, ...)) but strptime()
+    is only used once per hour, minutes and seconds are just added"""
+    hour = date[:13]
+    start = _HOUR_CACHE.get(hour)
+    if start is None:
+        if len(_HOUR_CACHE) > 1000:
+            _HOUR_CACHE.clear()
+        start = time.mktime(time.strptime(hour, "%Y-%m-%d %H"))
+        _HOUR_CACHE[hour] = start
+    return start + int(date[14:16]) * 60 + int(date[17:19])
+
 class PoloniexComponent(ApplicationSession):
 
     def onLeave(self, details):
@@ -61,8 +82,8 @@ class PoloniexComponent(ApplicationSession):
                     translated = {
                         "op": "ticker",
                         "ticker": {
-                            'bid': float(args[3]),
-                            'ask': float(args[2])
+                            'bid': client.fixed.round_price(float(args[3])),
+                            'ask': client.fixed.round_price(float(args[2]))
                         }
                     }
                     client.signal_recv(client, translated)
@@ -81,8 +102,8 @@ class PoloniexComponent(ApplicationSession):
                             'op': 'depth',
                             'depth': {
                                 'type': data['data']['type'],
-                                'price': float(data['data']['rate']),
-                                'volume': float(data['data']['amount']) if data['type'] == 'orderBookModify' else 0,
+                                'price': client.fixed.round_price(float(data['data']['rate'])),
+                                'volume': client.fixed.round_volume(float(data['data']['amount'])) if data['type'] == 'orderBookModify' else 0,
                                 'timestamp': timestamp
                             },
                             'id': "depth"
@@ -102,15 +123,15 @@ class PoloniexComponent(ApplicationSession):
                         #     type: 'newTrade'
                         # }
                         data = data['data']
-                        client.debug("newTrade:", data)
+                        client.log(LOG_TRADE, logging.DEBUG, "newTrade: %s", data)
                         translated = {
                             'op': 'trade',
                             'trade': {
                                 'id': data['tradeID'],
                                 'type': 'ask' if data['type'] == 'buy' else 'bid',
-                                'price': data['rate'],
-                                'amount': data['amount'],
-                                'timestamp': time.mktime(time.strptime(data['date'], "%Y-%m-%d %H:%M:%S"))
+                                'price': client.fixed.round_price(float(data['rate'])),
+                                'amount': client.fixed.round_volume(float(data['amount'])),
+                                'timestamp': parse_date(data['date'])
                             }
                         }
                         client.signal_recv(client, translated)
@@ -192,6 +213,7 @@ class BaseClient(BaseObject):
         self.curr_base = curr_base
         self.curr_quote = curr_quote
         self.pair = "%s_%s" % (curr_quote, curr_base)
+        self.fixed = get_fixed_point(config, *PAIR_DECIMALS)
 
         self.currency = curr_quote  # deprecated, use curr_quote instead
 
@@ -212,6 +234,7 @@ class BaseClient(BaseObject):
         self._time_last_received = 0
         self._time_last_subscribed = 0
         self.history_last_candle = None
+        self.history_last_date = None  # newest trade of the previous download (UTC)
 
     def start(self):
         """start the client"""
@@ -263,7 +286,7 @@ class BaseClient(BaseObject):
             return microtime
 
     def request_fulldepth(self):
-        """start the fulldepth thread"""
+        """request the full depth (in the fetch pool)"""
 
         def fulldepth_thread():
             """request the full market depth, initialize the order book
@@ -291,20 +314,20 @@ class BaseClient(BaseObject):
 
                     for ask in fulldepth['asks']:
                         depth['data']['asks'].append({
-                            'price': float(ask[0]),
-                            'amount': float(ask[1])
+                            'price': self.fixed.round_price(float(ask[0])),
+                            'amount': self.fixed.round_volume(float(ask[1]))
                         })
                     for bid in reversed(fulldepth['bids']):
                         depth['data']['bids'].append({
-                            'price': float(bid[0]),
-                            'amount': float(bid[1])
+                            'price': self.fixed.round_price(float(bid[0])),
+                            'amount': self.fixed.round_volume(float(bid[1]))
                         })
 
                     self.signal_fulldepth(self, depth)
                 except Exception as exc:
                     self.debug("### exception in fulldepth_thread:", exc)
 
-        start_thread(fulldepth_thread, "http request full depth")
+        FETCH_POOL.submit("depth:%s:%s" % (HTTP_HOST, self.pair), fulldepth_thread)
 
     def request_history(self):
         """request trading history"""
@@ -315,7 +338,10 @@ class BaseClient(BaseObject):
         def history_thread():
             """request trading history"""
 
-            if not self.history_last_candle:
+            if self.history_last_date:
+                # a minute of overlap, the trade ids tell which ones are new
+                querystring = "&start=%i" % (self.history_last_date - 60)
+            elif not self.history_last_candle:
                 querystring = "&start=%i&end=%i" % ((time.time() - 172800), (time.time() - 86400))
                 # self.debug("### requesting 2d history since %s" % time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(time.time() - 172800)))
             else:
@@ -334,13 +360,19 @@ class BaseClient(BaseObject):
 
                     # self.debug("History: %s" % raw_history)
 
-                    history = []
-                    for h in reversed(raw_history):
-                        history.append({
-                            'price': float(h['rate']),
-                            'amount': float(h['amount']),
-                            'date': time.mktime(time.strptime(h['date'], "%Y-%m-%d %H:%M:%S")) - 480
-                        })
+                    raw = raw_history[::-1]
+                    round_price = self.fixed.round_price
+                    round_volume = self.fixed.round_volume
+                    history = TradeColumns(
+                        [parse_date(h['date']) - 480 for h in raw],
+                        [round_price(float(h['rate'])) for h in raw],
+                        [round_volume(float(h['amount'])) for h in raw],
+                        [int(h['tradeID']) for h in raw],
+                        sides=[1 if h['type'] == 'buy' else -1 for h in raw])
+                    if raw:
+                        # the dates are UTC, the newest is the last one
+                        self.history_last_date = calendar.timegm(
+                            time.strptime(raw[-1]['date'], "%Y-%m-%d %H:%M:%S"))
 
                     # self.debug("History: %s" % history)
 
@@ -349,7 +381,7 @@ class BaseClient(BaseObject):
                 except Exception as exc:
                     self.debug("### exception in history_thread:", exc)
 
-        start_thread(history_thread, "http request trade history")
+        FETCH_POOL.submit("history:%s:%s" % (HTTP_HOST, self.pair), history_thread)
 
     def _recv_thread_func(self):
         """this will be executed as the main receiving thread, each type of
@@ -401,8 +433,8 @@ class BaseClient(BaseObject):
                                 'currency': "X" + tx['descr']['pair'][3:],
                                 'status': tx['status'],
                                 'type': 'bid' if tx['descr']['type'] == 'buy' else 'ask',
-                                'price': float(tx['descr']['price']),
-                                'amount': float(tx['vol'])
+                                'price': self.fixed.round_price(float(tx['descr']['price'])),
+                                'amount': self.fixed.round_volume(float(tx['vol']))
                             })
                             # self.debug("TX: %s" % result)
                     elif api_endpoint == 'private/TradeVolume':
@@ -509,7 +541,10 @@ class BaseClient(BaseObject):
 
     def send_order_add(self, typ, price, volume):
         """send an order"""
-        reqid = "order_add:%s:%f:%f" % (typ, price, volume)
+        price = self.fixed.format_price(price)
+        volume = self.fixed.format_volume(volume)
+        reqid = "order_add:%s:%s:%s" % (typ, price, volume)
+        self.log(LOG_ORDER, logging.DEBUG, "Sending %s", reqid)
         api = 'tradingApi'
         params = {
             'currencyPair': self.pair,
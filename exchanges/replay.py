@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+""" Replay Client, plays back a recording of the FeedRecorder """
+
+import gzip
+import json
+import logging
+import threading
+import time
+from api import BaseObject, Signal, FixedPoint, TradeColumns, start_thread
+from api import LOG_ORDER
+
+class ReplayClient(BaseObject):
+    """plays back a recording made with the record_feed option (see
+    api.FeedRecorder) instead of connecting to an exchange. All events are
+    emitted from one thread in the recorded order, as fast as they are
+    processed (replay_speed 0) or with the recorded time between them
+    divided by replay_speed (1 is real time). Orders are not sent anywhere,
+    the recording already contains the answers of the original session.
+    finished is set when everything has been played back."""
+
+    def __init__(self, curr_base, curr_quote, secret, config):
+        BaseObject.__init__(self)
+
+        self.signal_recv = Signal()
+        self.signal_fulldepth = Signal()
+        self.signal_fullhistory = Signal()
+        self.signal_ticker = Signal()
+        self.signal_connected = Signal()
+        self.signal_disconnected = Signal()
+
+        self.secret = secret
+        self.config = config
+        self.filename = config.get_string("api", "replay_file")
+        self.speed = config.get_float("api", "replay_speed")
+
+        with gzip.open(self.filename, "rb") as file:
+            self.header = json.loads(file.readline())
+        if (self.header["curr_base"], self.header["curr_quote"]) != (curr_base, curr_quote):
+            logging.warning("replaying %s%s but trading %s%s is configured",
+                            self.header["curr_base"], self.header["curr_quote"],
+                            curr_base, curr_quote)
+        self.curr_base = curr_base
+        self.curr_quote = curr_quote
+        self.fixed = FixedPoint(self.header["price_decimals"], self.header["volume_decimals"])
+
+        self.history_last_candle = None
+        self._wait_for_next_info = False
+        self._terminating = False
+        self._replay_thread = None
+        self.count_events = 0
+        self.finished = threading.Event()
+
+    def start(self):
+        """start playing back"""
+        self._replay_thread = start_thread(self._replay_thread_func, "replay thread")
+
+    def stop(self):
+        """stop playing back"""
+        self._terminating = True
+
+    def _replay_thread_func(self):
+        """read the recording line by line and emit the events"""
+        try:
+            with gzip.open(self.filename, "rb") as file:
+                file.readline()  # the header
+                time_first = None
+                time_start = time.time()
+                for line in file:
+                    if self._terminating:
+                        break
+                    (tim, name, data) = json.loads(line)
+                    if self.speed > 0:
+                        if time_first is None:
+                            time_first = tim
+                        wait = time_start + (tim - time_first) / self.speed - time.time()
+                        if wait > 0:
+                            time.sleep(wait)
+                    self._emit(name, data)
+                    self.count_events += 1
+            self.debug("### replay finished after %i events" % self.count_events)
+        except Exception as exc:
+            self.debug("### exception in replay thread:", exc)
+        finally:
+            self.finished.set()
+
+    def _emit(self, name, data):
+        """emit one recorded event"""
+        if name == "recv":
+            self.signal_recv(self, (data))
+        elif name == "fulldepth":
+            self.signal_fulldepth(self, (data))
+        elif name == "fullhistory":
+            if isinstance(data, dict) and "trades" in data:
+                data = TradeColumns(**data["trades"])
+            self.signal_fullhistory(self, (data))
+        elif name == "ticker":
+            self.signal_ticker(self, tuple(data))
+        elif name == "connected":
+            self.signal_connected(self, None)
+        elif name == "disconnected":
+            self.signal_disconnected(self, None)
+
+    def send_order_add(self, typ, price, volume):
+        """orders are not sent during a replay"""
+        self.log(LOG_ORDER, logging.DEBUG, "Replay, not sending order_add:%s:%s:%s",
+                 typ, self.fixed.format_price(price), self.fixed.format_volume(volume))
+
+    def send_order_cancel(self, txid):
+        """orders are not sent during a replay"""
+        self.log(LOG_ORDER, logging.DEBUG, "Replay, not sending order_cancel:%s", txid)
+
+    def send_signed_call(self, api_endpoint, params, reqid):
+        """nothing is sent during a replay"""
+        pass
+
+    def request_info(self):
+        """the recording has the answers"""
+        pass
+
+    def request_orders(self):
+        """the recording has the answers"""
+        pass
+
+    def force_reconnect(self):
+        """there is no connection"""
+        pass
@@ -2,22 +2,30 @@
 trading robot breadboard
 """
 
+import traceback
 import api
 
 class Strategy(api.BaseObject):
 
+    log_category = api.LOG_STRATEGY
+
     def __init__(self, instance):
         api.BaseObject.__init__(self)
         self.signal_debug.connect(instance.signal_debug)
-        instance.signal_keypress.connect(self.slot_keypress)
-        instance.signal_strategy_unload.connect(self.slot_before_unload)
-        instance.signal_ticker.connect(self.slot_tick)
-        instance.signal_depth.connect(self.slot_depth)
-        instance.signal_trade.connect(self.slot_trade)
-        instance.signal_userorder.connect(self.slot_userorder)
-        instance.orderbook.signal_owns_changed.connect(self.slot_owns_changed)
-        instance.history.signal_changed.connect(self.slot_history_changed)
-        instance.signal_wallet.connect(self.slot_wallet_changed)
+        for (signal, name) in [
+                (instance.signal_keypress, "slot_keypress"),
+                (instance.signal_strategy_unload, "slot_before_unload"),
+                (instance.signal_ticker, "slot_tick"),
+                (instance.signal_depth, "slot_depth"),
+                (instance.signal_trade, "slot_trade"),
+                (instance.signal_userorder, "slot_userorder"),
+                (instance.orderbook.signal_owns_changed, "slot_owns_changed"),
+                (instance.history.signal_changed, "slot_history_changed"),
+                (instance.signal_wallet, "slot_wallet_changed")]:
+            # the empty default slots below are not connected at all, some
+            # of these signals fire for every single depth or trade message
+            if getattr(self.__class__, name).im_func is not getattr(Strategy, name).im_func:
+                signal.connect(getattr(self, name))
         self.instance = instance
         self.name = "%s.%s" % (self.__class__.__module__, self.__class__.__name__)
         self.debug("%s loaded" % self.name)
@@ -97,3 +105,45 @@ class Strategy(api.BaseObject):
         to implement a stoploss or you could also use it for example to detect
         when a new candle is opened"""
         pass
+
+
+#
+# dynamically (re)loadable strategy module
+#
+
+class StrategyManager():
+    """load the strategy module"""
+
+    def __init__(self, instance, strategy_name_list):
+        self.strategy_object_list = []
+        self.strategy_name_list = strategy_name_list
+        self.instance = instance
+        self.reload()
+
+    def unload(self):
+        """unload the strategy, will trigger its the __del__ method"""
+        self.instance.signal_strategy_unload(self, None)
+        self.strategy_object_list = []
+
+    def reload(self):
+        """reload and re-initialize the strategy module"""
+        self.unload()
+        for name in self.strategy_name_list:
+            name = name.replace(".py", "").strip()
+
+            try:
+                strategy_module = __import__(name)
+                try:
+                    reload(strategy_module)
+                    strategy_object = strategy_module.Strategy(self.instance)
+                    self.strategy_object_list.append(strategy_object)
+                    if hasattr(strategy_object, "name"):
+                        self.instance.strategies[strategy_object.name] = strategy_object
+
+                except Exception:
+                    self.instance.debug("### error while loading strategy %s.py, traceback follows:" % name)
+                    self.instance.debug(traceback.format_exc())
+
+            except ImportError:
+                self.instance.debug("### could not import %s.py, traceback follows:" % name)
+                self.instance.debug(traceback.format_exc())
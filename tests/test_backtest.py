@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+"""
+BacktestClient: orders against the book (taker) and against the public
+trades (maker) with the simulated latency, and timers in simulated time
+"""
+
+import gzip
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import api
+
+TIME_BEGIN = 1400000000.0
+
+
+def trade(tim, price, amount):
+    """a recorded trade message"""
+    return (tim, "recv", {"op": "trade", "trade": {
+        "type": "bid", "price": price, "amount": amount, "timestamp": tim}})
+
+
+class TestBacktest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.instance = None
+
+    def tearDown(self):
+        if self.instance:
+            self.instance.stop()
+        shutil.rmtree(self.directory)
+
+    def make_api(self, events):
+        """an Api for the backtest of a recording of these events, after a
+        full depth with asks 101, 101.01 and bids 100, 99.99 (volume 1)"""
+        feed = os.path.join(self.directory, "feed.gz")
+        with gzip.open(feed, "wb") as file:
+            file.write(json.dumps({
+                "version": api.FeedRecorder.VERSION, "exchange": "kraken",
+                "curr_base": "XETH", "curr_quote": "XXBT",
+                "price_decimals": 5, "volume_decimals": 8, "time": TIME_BEGIN}) + "\n")
+            for (tim, name, data) in [
+                    (TIME_BEGIN, "connected", None),
+                    (TIME_BEGIN, "fulldepth", {"data": {
+                        "asks": [{"price": 101, "amount": 1.0}, {"price": 101.01, "amount": 1.0}],
+                        "bids": [{"price": 100, "amount": 1.0}, {"price": 99.99, "amount": 1.0}]}})] + events:
+                file.write(json.dumps([tim, name, data]) + "\n")
+        config = api.ApiConfig(os.path.join(self.directory, "test.ini"))
+        config.init_defaults([["pytrader", "exchange", "backtest"]])
+        config.set("api", "replay_file", feed)
+        self.instance = api.Api(api.Secret(config), config)
+        self.instance.start()
+        return self.instance
+
+    def on_trade(self, instance, count, func):
+        """call func() at the count-th public trade"""
+        seen = []
+
+        def slot_trade(_sender, _data):
+            seen.append(1)
+            if len(seen) == count:
+                func()
+        instance.signal_trade.connect(slot_trade)
+        return slot_trade  # keep it alive, signals only keep weak references
+
+    def test_market_buy_takes_from_book(self):
+        instance = self.make_api([trade(TIME_BEGIN + 1, 100.5, 0.1),
+                                  trade(TIME_BEGIN + 2, 100.5, 0.1)])
+        slot = self.on_trade(instance, 1, lambda: instance.buy(0, 1.5))
+        instance.client.run()
+        fills = instance.client.fills
+        self.assertEqual(len(fills), 1)
+        (tim, _oid, typ, price, volume, fee, is_maker) = fills[0]
+        self.assertEqual(tim, TIME_BEGIN + 1.25)
+        self.assertEqual((typ, volume, is_maker), ("bid", 1.5, False))
+        self.assertAlmostEqual(price, (101 + 0.5 * 101.01) / 1.5, 9)
+        self.assertAlmostEqual(fee, price * 1.5 * 0.26 / 100, 9)
+        self.assertAlmostEqual(instance.client.wallet["XETH"], 11.5, 9)
+        self.assertEqual(len(instance.orderbook.owns), 0)
+        del slot
+
+    def test_limit_buy_filled_by_trades(self):
+        """a resting bid is filled by trades below its price (not at it),
+        as much as their volume allows, at its own price"""
+        instance = self.make_api([trade(TIME_BEGIN + 1, 100.5, 0.1),
+                                  trade(TIME_BEGIN + 1.1, 100.2, 0.5),  # still on its way
+                                  trade(TIME_BEGIN + 2, 100.2, 0.6),
+                                  trade(TIME_BEGIN + 3, 100.3, 0.1),  # at the price
+                                  trade(TIME_BEGIN + 4, 100.1, 2.0)])
+        slot = self.on_trade(instance, 1, lambda: instance.buy(100.3, 1.0))
+        instance.client.run()
+        fills = [(tim, round(price, 8), volume, is_maker)
+                 for (tim, _oid, _typ, price, volume, _fee, is_maker) in instance.client.fills]
+        self.assertEqual(fills, [(TIME_BEGIN + 2, 100.3, 0.6, True),
+                                 (TIME_BEGIN + 4, 100.3, 0.4, True)])
+        self.assertEqual(len(instance.orderbook.owns), 0)
+        self.assertEqual(instance.client.resting, {})
+        del slot
+
+    def test_cancel_before_fill(self):
+        instance = self.make_api([trade(TIME_BEGIN + 1, 100.5, 0.1),
+                                  trade(TIME_BEGIN + 2, 100.5, 0.1),
+                                  trade(TIME_BEGIN + 3, 103, 5.0)])
+        slot1 = self.on_trade(instance, 1, lambda: instance.sell(102, 1.0))
+        slot2 = self.on_trade(instance, 2, lambda: instance.cancel_by_type())
+        instance.client.run()
+        self.assertEqual(instance.client.fills, [])
+        self.assertEqual(instance.client.count_canceled, 1)
+        self.assertEqual(len(instance.orderbook.owns), 0)
+        del slot1, slot2
+
+    def test_timer_in_simulated_time(self):
+        instance = self.make_api([trade(TIME_BEGIN + i, 100.5, 0.1) for i in range(1, 101)])
+        fired = []
+
+        def slot_timer(_sender, _data):
+            fired.append((instance.client.now, threading.current_thread()))
+        timer = api.Timer(10)
+        timer.connect(slot_timer)
+        instance.client.run()
+        self.assertEqual([tim for (tim, _) in fired],
+                         [TIME_BEGIN + 10 * i for i in range(1, 11)])
+        self.assertTrue(all(thread is threading.current_thread() for (_, thread) in fired))
+        timer.cancel()
+        instance.stop()
+        self.instance = None
+        self.assertFalse(isinstance(api.Scheduler.get(), api.SimulatedScheduler))
+
+
+if __name__ == "__main__":
+    unittest.main()
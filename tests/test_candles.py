@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""
+CandleEngine: live trades, deduplication of downloaded trades by id, polls
+with trades for older candles and a download after loading a checkpoint
+"""
+
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import api
+
+
+class FakeApi():
+    """just enough of Api() to create a CandleEngine()"""
+
+    def __init__(self):
+        self.lock = api.NoLock()
+        self.signal_trade = api.Signal()
+        self.signal_fullhistory = api.Signal()
+
+
+def candles(engine, timeframe):
+    """the candles of this timeframe as tuples, oldest first"""
+    return [(c.tim, c.opn, c.hig, c.low, c.cls, c.vol)
+            for c in reversed(list(engine.get_store(timeframe)))]
+
+
+def volume(engine, timeframe):
+    """total volume of all candles of this timeframe"""
+    return sum(c.vol for c in engine.get_store(timeframe))
+
+
+def download(first, last, ids=True):
+    """trades every 3 seconds from the dates first to last (excluding),
+    volume 1, with exchange ids (like Poloniex) or without"""
+    dates = range(first, last, 3)
+    rnd = random.Random(first)
+    return api.TradeColumns(dates, [rnd.uniform(99, 101) for _ in dates],
+                            [1.0] * len(dates), dates if ids else ())
+
+
+class TestCandleEngine(unittest.TestCase):
+
+    def test_live_trades(self):
+        engine = api.CandleEngine(FakeApi(), [60, 300])
+        for (date, price) in [(540, 100), (545, 102), (590, 99), (600, 101), (900, 98)]:
+            engine._apply_trade(date, price, 1.0)
+        self.assertEqual(candles(engine, 60), [(540, 100, 102, 99, 99, 3), (600, 101, 101, 101, 101, 1),
+                                               (900, 98, 98, 98, 98, 1)])
+        self.assertEqual(candles(engine, 300), [(300, 100, 102, 99, 99, 3), (600, 101, 101, 101, 101, 1),
+                                                (900, 98, 98, 98, 98, 1)])
+
+    def test_overlapping_downloads(self):
+        """trades that are already in the candles are not counted again"""
+        engine = api.CandleEngine(FakeApi(), [60, 300])
+        engine.slot_fullhistory(None, download(1000, 1600))
+        engine.slot_fullhistory(None, download(1300, 1900))
+        engine.slot_fullhistory(None, download(1870, 2000))
+        self.assertEqual(volume(engine, 60), len(range(1000, 2000, 3)))
+        self.assertEqual(volume(engine, 300), len(range(1000, 2000, 3)))
+
+    def test_new_only_poll_with_late_trade(self):
+        """a poll with a trade for an older candle adds it to that candle"""
+        engine = api.CandleEngine(FakeApi(), [60, 300])
+        for date in (540, 545, 600, 610):
+            engine._apply_trade(date, 100, 3.0)
+        engine.slot_fullhistory(None, api.TradeColumns([595, 670], [101, 99], [1.0, 1.0], new_only=True))
+        self.assertEqual(candles(engine, 60), [(540, 100, 101, 100, 100, 7), (600, 100, 100, 100, 100, 6),
+                                               (660, 99, 99, 99, 99, 1)])
+        self.assertEqual(candles(engine, 300), [(300, 100, 101, 100, 100, 7), (600, 100, 100, 99, 99, 7)])
+
+    def test_poll_fills_a_gap(self):
+        engine = api.CandleEngine(FakeApi(), [60])
+        for date in (540, 660):
+            engine._apply_trade(date, 100, 3.0)
+        engine.slot_fullhistory(None, api.TradeColumns([605, 610, 670], [90, 91, 92], [1.0] * 3, new_only=True))
+        self.assertEqual(candles(engine, 60), [(540, 100, 100, 100, 100, 3), (600, 90, 91, 90, 91, 2),
+                                               (660, 100, 100, 92, 92, 4)])
+
+    def test_download_after_checkpoint(self):
+        """the candles from a checkpoint contain the trades of an
+        overlapping download already, the ids are not known after the
+        reload. The volume must stay exact across reload and polls."""
+        engine = api.CandleEngine(FakeApi(), [60, 300])
+        engine.slot_fullhistory(None, download(1000, 1600))
+        self.assertEqual(volume(engine, 60), 200)
+        saved = dict((timeframe, [engine.get_store(timeframe).column(field).to_array()
+                                  for field in api.CandleStore.FIELDS])
+                     for timeframe in (60, 300))
+
+        engine = api.CandleEngine(FakeApi(), [60, 300])
+        for (timeframe, columns) in saved.items():
+            engine.load_candles(timeframe, columns)
+        engine.slot_fullhistory(None, download(1030, 1600))
+        self.assertEqual(volume(engine, 60), 200)
+        self.assertEqual(volume(engine, 300), 200)
+        engine.slot_fullhistory(None, download(1300, 1700))
+        self.assertEqual(volume(engine, 60), 234)
+        self.assertEqual(volume(engine, 300), 234)
+
+
+if __name__ == "__main__":
+    unittest.main()
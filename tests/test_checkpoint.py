@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+"""
+Checkpoint: book and candles written by one Api and loaded by the next one,
+and the final save at shutdown after a stuck lock had to be broken open
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import api
+
+
+class TestCheckpoint(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.instances = []
+
+    def tearDown(self):
+        for instance in self.instances:
+            instance.stop()
+        shutil.rmtree(self.directory)
+
+    def make_api(self, interval="60"):
+        """an Api for kraken that is not started (it does not connect)"""
+        config = api.ApiConfig(os.path.join(self.directory, "test.ini"))
+        config.init_defaults([["pytrader", "exchange", "kraken"]])
+        if interval is not None:
+            config.set("api", "checkpoint_interval", interval)
+        instance = api.Api(api.Secret(config), config)
+        self.instances.append(instance)
+        return instance
+
+    def fill(self, instance):
+        """some levels and trades, as if they had been downloaded"""
+        book = instance.orderbook
+        book.load_levels(([0.5, 0.49, 0.48], [1.0, 2.0, 3.0]),
+                         ([0.51, 0.52], [4.0, 5.0]))
+        book.stale = False
+        for (date, price) in [(540, 0.5), (545, 0.51), (600, 0.49), (4000, 0.5)]:
+            instance.candle_engine._apply_trade(date, price, 1.5)
+        instance.history.ready_history = True
+
+    def test_default_is_off(self):
+        instance = self.make_api(interval=None)
+        self.assertEqual(instance.timer_checkpoint, None)
+        self.assertFalse(instance.save_checkpoint())
+
+    def test_file_name(self):
+        instance = self.make_api()
+        self.assertEqual(instance.checkpoint_file,
+                         os.path.join(self.directory, "test.XETHXXBT.checkpoint"))
+
+    def test_round_trip(self):
+        instance = self.make_api()
+        self.fill(instance)
+        self.assertTrue(instance.save_checkpoint())
+
+        loaded = self.make_api()
+        self.assertTrue(loaded.load_checkpoint())
+        for side in ("bids", "asks"):
+            self.assertEqual(list(getattr(loaded.orderbook, side).prices),
+                             list(getattr(instance.orderbook, side).prices))
+            self.assertEqual(list(getattr(loaded.orderbook, side).volumes),
+                             list(getattr(instance.orderbook, side).volumes))
+        self.assertTrue(loaded.orderbook.stale)
+        for timeframe in (60, 3600):
+            self.assertEqual(
+                [(c.tim, c.opn, c.hig, c.low, c.cls, c.vol)
+                 for c in loaded.candle_engine.get_store(timeframe)],
+                [(c.tim, c.opn, c.hig, c.low, c.cls, c.vol)
+                 for c in instance.candle_engine.get_store(timeframe)])
+        self.assertTrue(loaded.history.stale)
+        self.assertFalse(loaded.save_checkpoint())  # nothing new to write
+
+    def test_background_save(self):
+        instance = self.make_api()
+        self.fill(instance)
+        self.assertTrue(instance.save_checkpoint(True))
+        instance._checkpoint_thread.join(10)
+        loaded = self.make_api()
+        self.assertTrue(loaded.load_checkpoint())
+        self.assertEqual(len(loaded.orderbook.asks), 2)
+
+    def test_save_after_breaking_lock_open(self):
+        """a slot in another thread is stuck with the lock, shutdown
+        replaces it and the final save must not wait for the old one"""
+        instance = self.make_api()
+        self.fill(instance)
+        stuck_lock = instance.lock
+        acquired = threading.Event()
+        release = threading.Event()
+
+        def stuck():
+            with stuck_lock:
+                acquired.set()
+                release.wait(10)
+        thread = threading.Thread(target=stuck)
+        thread.start()
+        acquired.wait(10)
+        try:
+            lock = threading.RLock()
+            lock.acquire()
+            api.Signal.replace_lock(stuck_lock, lock)
+            self.assertTrue(instance.lock is lock)
+            self.assertTrue(instance.signal_trade._lock is lock)
+            self.assertTrue(instance.save_checkpoint())
+        finally:
+            release.set()
+            thread.join()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+"""
+Dispatcher overflow policies: only events of lossy signals (the ticker) may
+be dropped or coalesced, all others must arrive, in order.
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import api
+
+
+class TestDispatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.received = []
+        self.started = threading.Event()
+        self.gate = threading.Event()
+        self.dispatcher = None
+
+    def tearDown(self):
+        self.gate.set()
+        if self.dispatcher:
+            self.dispatcher.stop()
+
+    def slot(self, sender, data):
+        """the first event waits at the gate, so the queue fills up"""
+        self.started.set()
+        self.gate.wait(10)
+        self.received.append((sender, data))
+
+    def make(self, overflow):
+        """a dispatcher with a queue of 2 and the signals recv and ticker,
+        the first recv event is already being dispatched (and stuck)"""
+        self.dispatcher = api.Dispatcher(2, 1, overflow)
+        lock = threading.RLock()
+        self.recv = api.Signal(lock)
+        self.ticker = api.Signal(lock)
+        self.recv.set_dispatcher(self.dispatcher)
+        self.ticker.set_dispatcher(self.dispatcher, lossy=True)
+        self.recv.connect(self.slot)
+        self.ticker.connect(self.slot)
+        self.recv("recv", 0)
+        self.started.wait(10)
+
+    def emit_blocked(self, signal, sender, data):
+        """emit in another thread, return the thread if it is blocked"""
+        thread = threading.Thread(target=lambda: signal(sender, data))
+        thread.daemon = True
+        thread.start()
+        thread.join(0.2)
+        self.assertTrue(thread.is_alive())
+        return thread
+
+    def finish(self, *threads):
+        """open the gate and wait until everything has been dispatched"""
+        self.gate.set()
+        for thread in threads:
+            thread.join(10)
+        time_end = time.time() + 10
+        while self.dispatcher.get_depth() and time.time() < time_end:
+            time.sleep(0.01)
+        time.sleep(0.05)
+        return self.received
+
+    def test_block(self):
+        self.make(api.DISPATCH_BLOCK)
+        self.ticker("ticker", 1)
+        self.recv("recv", 1)
+        thread = self.emit_blocked(self.ticker, "ticker", 2)
+        self.assertEqual(self.finish(thread), [
+            ("recv", 0), ("ticker", 1), ("recv", 1), ("ticker", 2)])
+
+    def test_drop_oldest_drops_only_lossy(self):
+        self.make(api.DISPATCH_DROP_OLDEST)
+        self.ticker("ticker", 1)
+        self.recv("recv", 1)
+        self.recv("recv", 2)  # drops ticker 1
+        thread = self.emit_blocked(self.recv, "recv", 3)
+        self.assertEqual(self.finish(thread), [
+            ("recv", 0), ("recv", 1), ("recv", 2), ("recv", 3)])
+        self.assertEqual(self.dispatcher.get_stats()["dropped"], 1)
+
+    def test_coalesce_only_lossy(self):
+        self.make(api.DISPATCH_COALESCE)
+        self.ticker("ticker", 1)
+        self.recv("recv", 1)
+        self.ticker("ticker", 2)  # replaces ticker 1 in the queue
+        thread = self.emit_blocked(self.recv, "recv", 2)
+        self.assertEqual(self.finish(thread), [
+            ("recv", 0), ("ticker", 2), ("recv", 1), ("recv", 2)])
+        self.assertEqual(self.dispatcher.get_stats()["coalesced"], 1)
+
+    def test_api_signals(self):
+        """Api makes only the ticker lossy"""
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        config = api.ApiConfig(os.path.join(directory, "test.ini"))
+        config.init_defaults([["pytrader", "exchange", "kraken"]])
+        config.set("api", "dispatch_queue_size", "10")
+        config.set("api", "dispatch_overflow", api.DISPATCH_DROP_OLDEST)
+        instance = api.Api(api.Secret(config), config)
+        self.addCleanup(instance.stop)
+        self.dispatcher = instance.dispatcher
+        client = instance.client
+        self.assertTrue(client.signal_ticker._dispatch_lossy)
+        for signal in [client.signal_recv, client.signal_fulldepth,
+                       client.signal_fullhistory, client.signal_connected]:
+            self.assertTrue(signal._dispatcher is self.dispatcher)
+            self.assertFalse(signal._dispatch_lossy)
+
+
+if __name__ == "__main__":
+    unittest.main()
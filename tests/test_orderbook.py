@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+the cumulative volume queries of BookSide (Fenwick trees with the overflow
+list for new prices) against a linear scan over the levels
+"""
+
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import api
+
+TICK = 0.00001
+
+
+def scan_cost(side, volume):
+    """(cost, price of the last level touched) by walking the levels"""
+    left = volume
+    cost = 0
+    for (price, vol) in zip(side.prices, side.volumes):
+        if vol <= 0:
+            continue
+        take = min(left, vol)
+        cost += take * price
+        left -= take
+        if left <= 0:
+            return (cost, price)
+    return None
+
+
+def scan_price_for_quote(side, quote):
+    """price of the level at which the quote volume reaches quote"""
+    total = 0
+    for (price, vol) in zip(side.prices, side.volumes):
+        if vol > 0 and total + vol * price >= quote:
+            return price
+        total += vol * price
+    return None
+
+
+class TestBookSide(unittest.TestCase):
+
+    def check_side(self, is_ask, num_levels):
+        """levels at every second tick, then new prices in between (they
+        go into the overflow list) and removals, with queries after each"""
+        rnd = random.Random(num_levels)
+        side = api.BookSide(is_ask, api.FixedPoint(5, 8))
+        sign = 1 if is_ask else -1
+        for i in range(num_levels):
+            side.append(round(0.5 + sign * 2 * (i + 1) * TICK, 5), rnd.uniform(0.1, 5))
+        side.get_cost(1)  # build the trees
+        for _ in range(300):
+            distance = rnd.randint(1, 2 * num_levels)
+            price = round(0.5 + sign * distance * TICK, 5)
+            (index, found) = side.find(price)
+            if found:
+                side.set_volume(index, rnd.choice([0, rnd.uniform(0.1, 5)]))
+            else:
+                side.insert(index, price, rnd.uniform(0.1, 5))
+            if found and not side.volumes[index] and not side.own_volumes[index]:
+                side.remove(index)
+
+            volume = rnd.uniform(0, sum(side.volumes) * 1.1)
+            expected = scan_cost(side, volume)
+            result = side.get_cost(volume)
+            if expected is None:
+                self.assertEqual(result, None)
+            else:
+                self.assertAlmostEqual(result[0], expected[0], 9)
+                self.assertEqual(result[1], expected[1])
+            quote = volume * 0.5
+            self.assertEqual(side.get_price_for_volume(quote, True),
+                             scan_price_for_quote(side, quote))
+            (total, total_quote) = side.get_total_up_to(price)
+            count = side.index_up_to(price) + 1
+            self.assertAlmostEqual(total, sum(side.volumes[:count]), 9)
+
+    def test_asks_with_new_levels(self):
+        self.check_side(True, 2000)
+
+    def test_bids_with_new_levels(self):
+        self.check_side(False, 2000)
+
+    def test_small_side(self):
+        self.check_side(True, 20)
+
+    def test_new_levels_do_not_rebuild(self):
+        """a query after inserting a new price uses the overflow list"""
+        side = api.BookSide(True, api.FixedPoint(5, 8))
+        for i in range(1000):
+            side.append(round(0.5 + 2 * (i + 1) * TICK, 5), 1.0)
+        side.get_cost(1)
+        slot_keys = side._slot_keys
+        (index, found) = side.find(0.50001)
+        self.assertFalse(found)
+        side.insert(index, 0.50001, 2.0)
+        (cost, price) = side.get_cost(2.5)
+        self.assertAlmostEqual(cost, 2 * 0.50001 + 0.5 * 0.50002, 12)
+        self.assertEqual(price, 0.50002)
+        self.assertEqual(side.get_price_for_volume(1.5), 0.50001)
+        self.assertTrue(side._slot_keys is slot_keys)
+        self.assertEqual(len(side._extra_keys), 1)
+
+    def test_changes_between_queries(self):
+        """changes are queued until the next query, more of them than
+        there are slots make it rebuild the trees instead"""
+        side = api.BookSide(True, api.FixedPoint(5, 8))
+        for i in range(100):
+            side.append(round(0.5 + (i + 1) * TICK, 5), 1.0)
+        side.get_cost(1)
+        for i in range(50):
+            side.set_volume(i, 2.0)
+        self.assertTrue(side._tree_valid)
+        self.assertEqual(len(side._tree_pending), 50)
+        self.assertAlmostEqual(side.get_total_up_to(0.501)[0], 150, 9)
+        self.assertEqual(len(side._tree_pending), 0)
+        for i in range(100):
+            side.set_volume(i, 3.0)
+        for i in range(50):
+            side.set_volume(i, 1.0)
+        self.assertFalse(side._tree_valid)
+        self.assertAlmostEqual(side.get_total_up_to(0.501)[0], 200, 9)
+        self.assertAlmostEqual(side.get_cost(60)[0], scan_cost(side, 60)[0], 9)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+"""
+Scheduler and DeliveryThread: stop() ends their threads, a timer that is
+firing while it happens does not start a new one, later calls do
+"""
+
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import api
+
+
+class TestScheduler(unittest.TestCase):
+
+    def test_stop_and_restart(self):
+        scheduler = api.Scheduler.get()
+        called = threading.Event()
+        scheduler.call_later(0, called.set)
+        self.assertTrue(called.wait(10))
+        thread = scheduler._thread
+        scheduler.stop()
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(scheduler._thread, None)
+
+        called.clear()
+        scheduler.call_later(0, called.set)
+        self.assertTrue(called.wait(10))
+        scheduler.stop()
+
+    def test_stop_while_timer_fires(self):
+        """the timer schedules its next firing from the ending thread"""
+        scheduler = api.Scheduler.get()
+        firing = threading.Event()
+        proceed = threading.Event()
+
+        def slot(_sender, _data):
+            firing.set()
+            proceed.wait(10)
+        timer = api.Timer(0.01)
+        timer.connect(slot)
+        self.assertTrue(firing.wait(10))
+        thread = threading.Thread(target=scheduler.stop)
+        thread.start()
+        time.sleep(0.1)
+        proceed.set()
+        thread.join(10)
+        self.assertEqual(scheduler._thread, None)
+        self.assertTrue(timer._entry in scheduler._heap)
+        timer.cancel()
+
+    def test_delivery_thread(self):
+        delivery = api.DeliveryThread.get()
+        called = threading.Event()
+        delivery.put(called.set)
+        self.assertTrue(called.wait(10))
+        thread = delivery._thread
+        delivery.stop()
+        self.assertFalse(thread.is_alive())
+        called.clear()
+        delivery.put(called.set)
+        self.assertTrue(called.wait(10))
+        delivery.stop()
+
+
+if __name__ == "__main__":
+    unittest.main()
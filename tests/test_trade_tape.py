@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+"""
+TradeTape and TapeView: trades written by the writer thread are read back,
+overlapping downloads (with and without ids) are not written twice and the
+retention cuts off old trades
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import api
+
+
+def read_all(filename):
+    """all trades on the tape"""
+    view = api.TapeView(filename)
+    try:
+        return view.get_trades()
+    finally:
+        view.close()
+
+
+class TestTradeTape(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "test.XETHXXBT.tape")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, *downloads, **kwargs):
+        """start a tape, queue the downloads and stop it again"""
+        tape = api.TradeTape(self.filename, "XETH", "XXBT", kwargs.get("retention", 0))
+        tape.start()
+        for trades in downloads:
+            tape.slot_fullhistory(None, trades)
+        tape.stop()
+        return tape
+
+    def test_round_trip_with_ids(self):
+        self.write(api.TradeColumns([10, 11, 12], [1.5, 1.6, 1.7], [1, 2, 3], [100, 101, 102],
+                                    sides=[1, -1, 1]),
+                   api.TradeColumns([11, 12, 13], [1.6, 1.7, 1.8], [2, 3, 4], [101, 102, 103],
+                                    sides=[-1, 1, -1]))
+        tape = self.write(api.TradeColumns([13, 14], [1.8, 1.9], [4, 5], [103, 104],
+                                           sides=[-1, -1]))
+        self.assertEqual(tape.count_written, 1)
+        trades = read_all(self.filename)
+        self.assertEqual(list(trades.dates), [10, 11, 12, 13, 14])
+        self.assertEqual(list(trades.prices), [1.5, 1.6, 1.7, 1.8, 1.9])
+        self.assertEqual(list(trades.amounts), [1, 2, 3, 4, 5])
+        self.assertEqual(list(trades.ids), [100, 101, 102, 103, 104])
+        self.assertEqual(list(trades.sides), [1, -1, 1, -1, -1])
+
+    def test_same_second_without_ids(self):
+        """a download that ends in the middle of a second, the next one
+        has the whole second (and more trades in it)"""
+        self.write(api.TradeColumns([10, 20, 20], [1.0, 2.0, 2.1], [1, 1, 1]))
+        tape = self.write(api.TradeColumns([20, 20, 20, 21], [2.0, 2.1, 2.2, 3.0], [1, 1, 1, 1]),
+                          api.TradeColumns([21, 21], [3.0, 3.1], [1, 1]))
+        self.assertEqual(tape.count_written, 3)
+        trades = read_all(self.filename)
+        self.assertEqual(list(trades.dates), [10, 20, 20, 20, 21, 21])
+        self.assertEqual(list(trades.prices), [1.0, 2.0, 2.1, 2.2, 3.0, 3.1])
+        self.assertEqual(len(trades.ids), 0)
+
+    def test_overlap_without_ids(self):
+        self.write(api.TradeColumns([10, 11, 12], [1.0, 1.1, 1.2], [1, 1, 1]))
+        tape = self.write(api.TradeColumns([10, 11, 12], [1.0, 1.1, 1.2], [1, 1, 1]))
+        self.assertEqual(tape.count_written, 0)
+        self.assertEqual(len(read_all(self.filename)), 3)
+
+    def test_retention(self):
+        self.write(api.TradeColumns(range(0, 1000, 10), [1.0] * 100, [1] * 100, range(100)),
+                   retention=500)
+        trades = read_all(self.filename)
+        self.assertEqual(trades.dates[0], 490)
+        self.assertEqual(trades.dates[-1], 990)
+        self.assertEqual(len(trades), 51)
+
+        # not cut off again until a quarter of the retention can go
+        tape = self.write(api.TradeColumns([1000, 1100], [1.0] * 2, [1] * 2, [100, 101]),
+                          retention=500)
+        self.assertEqual(tape.first_date, 490)
+        self.assertEqual(read_all(self.filename).dates[0], 490)
+        self.write(api.TradeColumns([1200], [1.0], [1], [102]), retention=500)
+        self.assertEqual(read_all(self.filename).dates[0], 700)
+        self.assertEqual(list(read_all(self.filename).ids)[-3:], [100, 101, 102])
+
+    def test_get_trades_range(self):
+        self.write(api.TradeColumns(range(0, 100, 10), range(10), [1] * 10))
+        view = api.TapeView(self.filename)
+        try:
+            trades = view.get_trades(25, 60)
+            self.assertEqual(list(trades.dates), [30, 40, 50])
+            self.assertEqual(view[-1][:3], (90, 9, 1))
+        finally:
+            view.close()
+
+
+if __name__ == "__main__":
+    unittest.main()